@@ -0,0 +1,201 @@
+"""
+Microbenchmarks of the display stack on the emulated hardware backend.
+
+Every case runs an operation against a fresh RecordingPWM and reports the time
+per call and the RPIO.PWM calls per call:
+
+	python bench.py            # print the numbers
+	python bench.py --save     # store them as the baseline
+	python bench.py --check    # fail if a case got slower or makes more RPIO calls
+
+The times depend on the machine, save the baseline where --check is run.
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import gc
+import sys
+import json
+from time import time
+
+from pwm_recorder import RecordingPWM
+import nixie
+import tracing
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+# --check fails above baseline * TOLERANCE + SLACK us per call, a few us are noise
+TOLERANCE = 1.5
+SLACK = 5
+ROUNDS = 200
+# The best of REPEATS timings, the others caught the scheduler
+REPEATS = 5
+
+
+def bench_channel_set_mask(pwm):
+	channel = nixie.DMAChannel(channel = nixie.nixie_channel, period = 10000, gpios = nixie.tube_gpios + nixie.digit_gpios, pwm = pwm)
+	return lambda i: channel.set_mask(nixie.digit_sets[i % 10], nixie.digit_mask, 100)
+
+def bench_channel_commit(pwm):
+	channel = nixie.DMAChannel(channel = nixie.nixie_channel, period = 10000, gpios = nixie.tube_gpios + nixie.digit_gpios, pwm = pwm,
+		double_buffered = True, gate_mask = nixie.tube_mask, window = nixie.default_layout.stride)
+	frames = [nixie.compile_display([1, 2, 3, i]) for i in range(0, 10)]
+	return lambda i: channel.commit(frames[i % 10])
+
+def bench_tube_set_digit(pwm):
+	channel = nixie.DMAChannel(channel = nixie.nixie_channel, period = 10000, gpios = nixie.tube_gpios + nixie.digit_gpios, pwm = pwm)
+	tube = nixie.Tube(channel, 0, 0)
+	return lambda i: tube.set_digit(i % 10)
+
+def bench_tube_set_brightness(pwm):
+	channel = nixie.DMAChannel(channel = nixie.nixie_channel, period = 10000, gpios = nixie.tube_gpios + nixie.digit_gpios, pwm = pwm)
+	tube = nixie.Tube(channel, 0, 0)
+	return lambda i: tube.set_brightness((30, 70)[i % 2])
+
+def bench_display_set_brightness(pwm):
+	display = nixie.Display(pwm = pwm)
+	return lambda i: display.set_brightness((30, 70)[i % 2])
+
+def bench_display_show(pwm):
+	display = nixie.Display(pwm = pwm)
+	return lambda i: display.show([1, 2, i / 10 % 6, i % 10])
+
+def bench_display_show_unchanged(pwm):
+	display = nixie.Display(pwm = pwm)
+	display.show([1, 2, 3, 4])
+	return lambda i: display.show([1, 2, 3, 4])
+
+def bench_dots_set_brightness(pwm):
+	dots = nixie.Dots(pwm = pwm)
+	return lambda i: dots.set_brightness((30, 70)[i % 2])
+
+def bench_dots_steady(pwm):
+	dots = nixie.Dots(pwm = pwm)
+	return lambda i: dots.steady(i % 2, 1, 1)
+
+def bench_dots_altern(pwm):
+	dots = nixie.Dots(pwm = pwm)
+	def step(i):
+		if i % 2:
+			dots.steady(1, 1, 1)
+		else:
+			dots.altern()
+	return step
+
+def bench_dots_show(pwm):
+	# Round of the pattern library
+	dots = nixie.Dots(pwm = pwm)
+	dots.prepare()
+	names = sorted(nixie.dot_patterns.keys())
+	return lambda i: dots.show(names[i % len(names)])
+
+def bench_compact_dots_show(pwm):
+	dots = nixie.CompactDots(pwm = pwm)
+	dots.prepare()
+	names = sorted(nixie.dot_patterns.keys())
+	return lambda i: dots.show(names[i % len(names)])
+
+def bench_display_number(pwm):
+	# A station flip: the number goes to the custom tubes, update() renders it
+	dt = nixie.DisplayThread(pwm = pwm)
+	def step(i):
+		dt.display_number(10000 + i % 100)
+		dt.update()
+	return step
+
+
+CASES = [
+	("DMAChannel.set_mask", bench_channel_set_mask),
+	("DMAChannel.commit", bench_channel_commit),
+	("Tube.set_digit", bench_tube_set_digit),
+	("Tube.set_brightness", bench_tube_set_brightness),
+	("Display.set_brightness", bench_display_set_brightness),
+	("Display.show", bench_display_show),
+	("Display.show unchanged", bench_display_show_unchanged),
+	("Dots.set_brightness", bench_dots_set_brightness),
+	("Dots.steady", bench_dots_steady),
+	("Dots.altern", bench_dots_altern),
+	("Dots.show", bench_dots_show),
+	("CompactDots.show", bench_compact_dots_show),
+	("DisplayThread.display_number", bench_display_number),
+]
+
+
+def run(case, rounds = ROUNDS):
+	pwm = RecordingPWM()
+	step = case(pwm)
+	# Warm up the frame caches, a cold cache is startup cost, not the cost of an operation
+	for i in range(0, 20):
+		step(i)
+	pwm.reset_calls()
+
+	best = None
+	# As timeit does
+	gc.disable()
+	for repeat in range(0, REPEATS):
+		start = time()
+		for i in range(0, rounds):
+			step(i)
+		elapsed = time() - start
+		if best == None or elapsed < best:
+			best = elapsed
+	gc.enable()
+	return { "us": best * 1000000 / rounds, "calls": float(pwm.count()) / (rounds * REPEATS) }
+
+def run_all(rounds = ROUNDS):
+	results = {}
+	# The display and the dots engines echo their setup to the console at INFO: only errors while timing
+	echo = tracing.trace.echo
+	tracing.trace.set_level(tracing.trace.level, tracing.ERROR)
+	try:
+		for (name, case) in CASES:
+			results[name] = run(case, rounds)
+	finally:
+		tracing.trace.set_level(tracing.trace.level, echo)
+	return results
+
+def dots_engines():
+	# Channel footprint and startup time of each dots engine
+	reports = []
+	for engine in (nixie.Dots, nixie.CompactDots):
+		start = time()
+		dots = engine(pwm = RecordingPWM())
+		report = dots.report()
+		report["init"] = time() - start
+		reports.append(report)
+	return reports
+
+def check(results, baseline, tolerance = TOLERANCE):
+	failures = []
+	for (name, case) in CASES:
+		if name not in baseline:
+			continue
+		result = results[name]
+		reference = baseline[name]
+		if result["calls"] > reference["calls"]:
+			failures.append("%s: %.1f RPIO calls per call, baseline %.1f" % (name, result["calls"], reference["calls"]))
+		if result["us"] > reference["us"] * tolerance + SLACK:
+			failures.append("%s: %.1fus per call, baseline %.1fus" % (name, result["us"], reference["us"]))
+	return failures
+
+
+if __name__ == "__main__":
+	results = run_all()
+	for (name, case) in CASES:
+		print("%-30s %10.1fus %8.1f calls" % (name, results[name]["us"], results[name]["calls"]))
+	for report in dots_engines():
+		print("%-30s %10d slots %8dkB DMA memory, init %.1fms" % (report["engine"], report["slots"], report["memory"] / 1024, report["init"] * 1000))
+
+	if "--save" in sys.argv:
+		with open(BASELINE, "w") as f:
+			json.dump(results, f, indent = 1, sort_keys = True)
+		print("baseline saved to %s" % BASELINE)
+
+	if "--check" in sys.argv:
+		with open(BASELINE) as f:
+			failures = check(results, json.load(f))
+		for failure in failures:
+			print("REGRESSION %s" % failure)
+		if failures:
+			sys.exit(1)
+		print("no regression")
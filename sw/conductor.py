@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+The conductor: turns the button, wheel and alarm events into what the radio plays
+and the tubes show, through the transition table of a StateMachine. The player is
+handed in, player.PlayerPool in main.py.
+"""
+from __future__ import unicode_literals, absolute_import, print_function
+import threading
+from time import localtime, mktime, sleep, strftime, time
+
+from nixie import DisplayThread
+from event_queue import EventQueue
+from state_machine import StateMachine
+import tracing
+
+WHEEL_STEPS = 100
+STEPS_PER_TURN = 96
+# Seconds
+FADE_TIME = 0.5
+ALARM_FADE_TIME = 3
+# The station of a pre-armed alarm has that long to answer, or the offline station plays
+ALARM_VERIFY_TIME = 20
+# Stations further on the wheel a station that never plays stands by after, in proportion of its unreliability
+UNRELIABLE_DISTANCE = 2
+
+class StateWheel:
+	VOLUME = 0
+
+class StateWheelSwitch:
+	PLAY = 0
+
+class RadioState:
+	DEFAULT = 0
+	VOLUME = 1
+	BRIGHTNESS = 2
+	NEXT = 3
+	STATION = 4
+	ALARM = 5
+	SNOOZE = 6
+	SLEEP = 7
+
+class RadioEvent:
+	TIMEOUT = 0
+	T = 1
+	M = 2
+	B = 3
+	WHEEL_MOVE = 4
+	WHEEL_PRESSED = 5
+	ALARM = 6
+	TMB = 7
+	FAILOVER = 8
+
+# Go ahead of the buttons and the wheel, and are never dropped
+URGENT_EVENTS = (RadioEvent.ALARM, RadioEvent.TMB, RadioEvent.FAILOVER)
+
+class Conductor(threading.Thread):
+	def __init__(self, wheel_setup_cb, player, dt = None):
+		threading.Thread.__init__(self, name = "conductor")
+		self.daemon = True
+
+		# The wheel only matters where it stopped
+		self.events = EventQueue(priorities = dict([(event, 1) for event in URGENT_EVENTS]), coalesced = (RadioEvent.WHEEL_MOVE, ),
+			urgent = URGENT_EVENTS)
+
+		self.player = player
+		if dt == None:
+			dt = DisplayThread()
+			dt.start()
+		self.dt = dt
+
+		self.wheel_setup_cb = wheel_setup_cb
+
+		self.alarm_mgr = None
+		# The offline station was armed, the alarm's did not answer
+		self.alarm_fallback = False
+		# Due time of the alarm ringing, and of the last one rung (the alarm manager rings after the pre-arm)
+		self.alarm_due = None
+		self.alarm_rung = None
+		self.alarm_lock = threading.Lock()
+
+		self.offline_station = 'file:///home/yannick/Music/01 - Il Y A.mp3'
+		self.stations = []
+		#self.stations.append('file:///home/yannick/Music/01 - Il Y A.mp3')
+		#self.stations.append('http://tsfjazz.ice.infomaniak.ch/tsfjazz-high.mp3')
+		#self.stations.append('http://direct.fipradio.fr/live/fip-midfi.mp3')
+		#self.stations.append('http://rivieraradio.ice.infomaniak.ch:80/rivieraradio-high')
+		self.current_station = None
+
+		self.state_offline = False
+		self.state_playing = False
+		self.state_wheel_switch = StateWheelSwitch.PLAY
+		self.state_wheel = StateWheel.VOLUME
+		self.state_brightness = 50
+		self.state_volume = 0
+		self.state_station = 1
+		self.state_blanked = False
+
+		self.alarm_value = None
+
+		self.machine = StateMachine(RadioState.DEFAULT, self.transitions(),
+			entries = { RadioState.DEFAULT: self.to_state_DEFAULT, RadioState.BRIGHTNESS: self.to_state_BRIGHTNESS,
+				RadioState.NEXT: self.to_state_NEXT, RadioState.STATION: self.to_state_STATION, RadioState.ALARM: self.to_state_ALARM },
+			exits = { RadioState.STATION: self.from_state_STATION, RadioState.ALARM: self.from_state_ALARM },
+			timeouts = { RadioState.VOLUME: 3, RadioState.BRIGHTNESS: 3, RadioState.NEXT: 4, RadioState.STATION: 3, RadioState.ALARM: 1800 },
+			state_names = names_of(RadioState), event_names = names_of(RadioEvent))
+
+		self.state_volume_change(WHEEL_STEPS / 2)
+
+	def transitions(self):
+		# (state, event) -> (action, next state), None: stays. The actions get the value of the event.
+		S = RadioState
+		E = RadioEvent
+		toggle_playing = lambda value: self.state_playing_toggle()
+		return {
+			(S.DEFAULT, E.T): (None, S.BRIGHTNESS),
+			(S.DEFAULT, E.M): (None, S.NEXT),
+			(S.DEFAULT, E.B): (None, S.STATION),
+			(S.DEFAULT, E.WHEEL_MOVE): (self.state_volume_change, S.VOLUME),
+			(S.DEFAULT, E.WHEEL_PRESSED): (toggle_playing, None),
+			(S.DEFAULT, E.ALARM): (self.alarm_rang, S.ALARM),
+			(S.DEFAULT, E.FAILOVER): (self.failed_over, None),
+
+			(S.VOLUME, E.TIMEOUT): (None, S.DEFAULT),
+			(S.VOLUME, E.T): (None, S.BRIGHTNESS),
+			(S.VOLUME, E.M): (None, S.NEXT),
+			(S.VOLUME, E.B): (None, S.STATION),
+			(S.VOLUME, E.WHEEL_MOVE): (self.state_volume_change, None),
+			(S.VOLUME, E.WHEEL_PRESSED): (toggle_playing, None),
+			(S.VOLUME, E.ALARM): (self.alarm_rang, S.ALARM),
+			(S.VOLUME, E.FAILOVER): (self.failed_over, None),
+
+			(S.BRIGHTNESS, E.TIMEOUT): (None, S.DEFAULT),
+			(S.BRIGHTNESS, E.T): (lambda value: self.state_blanking_toggle(), S.DEFAULT),
+			(S.BRIGHTNESS, E.M): (None, S.NEXT),
+			(S.BRIGHTNESS, E.B): (None, S.STATION),
+			(S.BRIGHTNESS, E.WHEEL_MOVE): (self.state_brightness_change, None),
+			(S.BRIGHTNESS, E.WHEEL_PRESSED): (toggle_playing, None),
+			(S.BRIGHTNESS, E.ALARM): (self.alarm_rang, S.ALARM),
+			(S.BRIGHTNESS, E.FAILOVER): (self.failed_over, None),
+
+			(S.NEXT, E.TIMEOUT): (None, S.DEFAULT),
+			(S.NEXT, E.T): (None, S.BRIGHTNESS),
+			(S.NEXT, E.B): (None, S.STATION),
+			(S.NEXT, E.ALARM): (self.alarm_rang, S.ALARM),
+			(S.NEXT, E.FAILOVER): (self.failed_over, None),
+
+			(S.STATION, E.TIMEOUT): (None, S.DEFAULT),
+			(S.STATION, E.T): (None, S.BRIGHTNESS),
+			(S.STATION, E.M): (None, S.NEXT),
+			(S.STATION, E.WHEEL_MOVE): (self.station_selected, None),
+			(S.STATION, E.WHEEL_PRESSED): (toggle_playing, None),
+			(S.STATION, E.ALARM): (self.alarm_rang, S.ALARM),
+			(S.STATION, E.FAILOVER): (self.failed_over, None),
+
+			(S.ALARM, E.TIMEOUT): (None, S.DEFAULT),
+			(S.ALARM, E.TMB): (None, S.DEFAULT),
+			(S.ALARM, E.FAILOVER): (self.failed_over, None),
+		}
+
+	def attach_alarm_mgr(self, alarm_mgr):
+		self.alarm_mgr = alarm_mgr
+		self.stations = self.alarm_mgr.get_all_stations()
+		if len(self.stations) > 0:
+			self.current_station = self.stations[0]
+
+
+	def state_station_change(self, new_station):
+		self.dt.display_number(10000 + new_station.id_)
+		if new_station == self.current_station:
+			return
+
+		self.current_station = new_station
+		if self.state_playing == True:
+			# Instant when it was standing by
+			self.play_current()
+
+	def station_selected(self, index):
+		self.state_station_change(self.stations[index])
+		self.prepare_neighbours()
+
+	def prepare_neighbours(self):
+		# The current station and the ones around it on the wheel stand by, nearest and most reliable first
+		if self.state_offline:
+			return
+		i = [s.id_ for s in self.stations].index(self.current_station.id_)
+		around = []
+		for distance in range(1, len(self.stations)):
+			for j in (i + distance, i - distance):
+				if 0 <= j < len(self.stations):
+					station = self.stations[j]
+					around.append((distance + UNRELIABLE_DISTANCE * (1 - self.player.reliability(station.url)), station))
+		around.sort(key = lambda entry: entry[0])
+		self.player.prepare([self.current_station.url] + [station.url for (rank, station) in around])
+
+	def play_current(self):
+		if self.state_offline:
+			self.player.play(self.offline_station, self.state_volume)
+		else:
+			self.player.play(self.current_station.url, self.state_volume)
+		self.player.set_volume(self.state_volume)
+
+	def state_playing_change(self, new_state):
+		if new_state == self.state_playing:
+			return
+
+		if new_state == True:
+			self.play_current()
+			tracing.info("player", 'Playing music')
+		else:
+			self.player.stop()
+			tracing.info("player", 'Stopping music')
+
+		self.state_playing = new_state
+
+
+	def state_playing_toggle(self):
+		self.state_playing_change(not self.state_playing)
+
+	def state_blanking_toggle(self):
+		self.state_blanked = not self.state_blanked
+		if self.state_blanked:
+			self.dt.blank(fade = FADE_TIME)
+		else:
+			self.dt.unblank(fade = FADE_TIME)
+
+
+	def state_volume_change(self, new_volume):
+		self.dt.display_number(new_volume)
+		if new_volume == self.state_volume:
+			return
+
+		self.state_volume = new_volume * 100 / WHEEL_STEPS
+
+		tracing.debug("volume", "volume: %s", self.state_volume)
+
+		if self.state_playing:
+			self.player.set_volume(self.state_volume)
+
+	def state_brightness_change(self, new_brightness):
+		self.dt.display_number(new_brightness)
+		if new_brightness == self.state_brightness:
+			return
+
+		self.state_brightness = new_brightness * 100 / WHEEL_STEPS
+		self.dt.set_brightness(self.state_brightness)
+		self.dt.set_dots_brightness(self.state_brightness)
+
+		tracing.debug("brightness", "brightness: %s", self.state_brightness)
+
+
+	def wheel_turned(self, val):
+		if self.state_wheel == StateWheel.VOLUME:
+			self.state_volume_change(val)
+
+
+	def wheel_switch_pressed(self):
+		if self.state_wheel_switch == StateWheelSwitch.PLAY:
+			self.state_playing_toggle()
+
+	def online(self):
+		tracing.info("network", "Back online")
+		self.state_offline = False
+		# Back from the offline station, a timeshifted stream reconnected by itself
+		if self.state_playing and not self.player.timeshifting():
+			self.state_playing_change(False)
+			self.state_playing_change(True)
+
+	def offline(self):
+		tracing.info("network", "Went offline")
+		self.state_offline = True
+		# A timeshifted stream plays on from the lead in its ring while it reconnects,
+		# one without a lead yet falls back to the offline station like any other
+		if self.state_playing and not self.player.timeshifting():
+			self.state_playing_change(False)
+			self.state_playing_change(True)
+
+	def station_failed(self, uri):
+		# From the supervisor thread of the player, the conductor's thread plays the offline station
+		self.raise_event(RadioEvent.FAILOVER, uri)
+
+	def failed_over(self, uri):
+		# The player gave up on the stream playing: the offline station plays until a station is chosen again
+		if uri == self.offline_station or not self.state_playing:
+			return
+		tracing.warning("player", "%s is out, playing the offline station", uri)
+		self.player.play(self.offline_station, self.state_volume)
+
+	def raise_event(self, event, value = None):
+		self.events.put(event, value)
+
+	def event_T(self):
+		self.raise_event(RadioEvent.T)
+
+	def event_M(self):
+		self.raise_event(RadioEvent.M)
+
+	def event_B(self):
+		self.raise_event(RadioEvent.B)
+
+	def event_WHEEL_PRESSED(self):
+		self.raise_event(RadioEvent.WHEEL_PRESSED)
+
+	def event_WHEEL_MOVE(self, new_val):
+		self.raise_event(RadioEvent.WHEEL_MOVE, new_val)
+
+	def event_ALARM(self, alarm_item):
+		due = alarm_due(alarm_item, time())
+		with self.alarm_lock:
+			if due == self.alarm_rung:
+				return
+			self.alarm_rung = due
+		self.raise_event(RadioEvent.ALARM, alarm_item)
+
+	def event_PREARM(self, alarm_item):
+		# Offset alert of the alarm manager, some minutes before the alarm
+		thread = threading.Thread(target = self.prearm, args = (alarm_item, ), name = "prearm")
+		thread.daemon = True
+		thread.start()
+
+	def prearm(self, alarm_item):
+		# Connects and pre-rolls the alarm's station, then rings on the second
+		due = alarm_due(alarm_item, time())
+		station = self.alarm_mgr.get_station(alarm_item.station_id)
+		tracing.info("alarm", "Pre-arming %s for %s", station.name, strftime("%H:%M:%S", localtime(due)))
+		uri = self.offline_station if self.state_offline else station.url
+		self.alarm_fallback = False
+		if not self.player.arm(uri, ALARM_VERIFY_TIME) and uri != self.offline_station:
+			tracing.warning("alarm", "%s does not answer, the alarm plays the offline station", station.name)
+			self.player.arm(self.offline_station, ALARM_VERIFY_TIME)
+			self.alarm_fallback = True
+
+		sleep_until(due - 1)
+		next_alarm = self.alarm_mgr.get_next_alarm()
+		if next_alarm == None or alarm_due(next_alarm, time()) != due:
+			tracing.info("alarm", "Alarm gone, disarmed")
+			self.player.disarm()
+			self.alarm_fallback = False
+			return
+		sleep_until(due)
+		self.event_ALARM(alarm_item)
+
+	def event_TMB(self):
+		self.raise_event(RadioEvent.TMB)
+
+	def alarm_rang(self, alarm_item):
+		self.alarm_value = alarm_item
+		self.alarm_due = alarm_due(alarm_item, time())
+
+
+	def to_state_DEFAULT(self):
+		self.wheel_setup_cb(0, self.state_volume, WHEEL_STEPS, (WHEEL_STEPS + 23) / 24, STEPS_PER_TURN, self.event_WHEEL_MOVE)
+		if self.state_blanked:
+			self.dt.blank(fade = FADE_TIME)
+		self.dt.dots_steady(0, 1, 1)
+		self.dt.show_time()
+
+	def to_state_BRIGHTNESS(self):
+		self.wheel_setup_cb(0, self.state_brightness, WHEEL_STEPS, (WHEEL_STEPS + 23) / 24, STEPS_PER_TURN, self.event_WHEEL_MOVE)
+		self.state_brightness_change(self.state_brightness)
+		self.dt.dots_steady(1, 1, 1)
+
+	def to_state_NEXT(self):
+		alarm_item = self.alarm_mgr.get_next_alarm()
+		self.dt.display_number(alarm_item.hour*100 + alarm_item.minute)
+		self.dt.dots_altern()
+
+	def to_state_STATION(self):
+		self.wheel_setup_cb(0, [s.id_ for s in self.stations].index(self.current_station.id_), len(self.stations) - 1, (len(self.stations) - 1 + 23) / 24, 8*(len(self.stations) - 1), self.event_WHEEL_MOVE)
+		self.state_station_change(self.current_station)
+		self.prepare_neighbours()
+		self.dt.dots_steady(0, 1, 1)
+
+	def from_state_STATION(self):
+		# Standing by holds connections and buffers, only worth it while browsing
+		self.player.prepare([])
+
+	def to_state_ALARM(self):
+		station = self.alarm_mgr.get_station(self.alarm_value.station_id)
+		# '\a' is a request to the terminal to beep
+		tracing.info("alarm", '\n\nRING RING RING ' + station.name + ' !!!!\a')
+
+		self.state_volume_change(WHEEL_STEPS / 2)
+		# The player logs how late the audio comes
+		self.player.expect(self.alarm_due)
+		self.state_station_change(station)
+		if self.alarm_fallback:
+			self.alarm_fallback = False
+			self.player.play(self.offline_station, self.state_volume)
+			self.player.set_volume(self.state_volume)
+			self.state_playing = True
+			tracing.info("player", 'Playing music')
+		else:
+			self.state_playing_change(True)
+		self.player.expect(None)
+
+		self.dt.show_time()
+		if self.state_blanked:
+			self.dt.set_brightness(0)
+			self.dt.unblank()
+		self.dt.fade(100, ALARM_FADE_TIME)
+		self.dt.dots_altern()
+
+	def from_state_ALARM(self):
+		self.state_playing_change(False)
+
+		self.dt.set_brightness(self.state_brightness)
+		self.dt.set_dots_brightness(self.state_brightness)
+
+	def run(self):
+		self.machine.start()
+
+		while True:
+			pending = self.events.get(self.machine.timeout())
+			if pending == None:
+				pending = (RadioEvent.TIMEOUT, None, [])
+			event, value, stamps = pending
+			tracing.latency.adopt(stamps)
+			tracing.latency.mark("queue")
+
+			self.machine.dispatch(event, value)
+			tracing.latency.mark("transition")
+
+	def stats(self):
+		return { "events": self.events.stats(), "states": self.machine.stats() }
+
+
+def alarm_due(alarm_item, now):
+	# Wall time of the occurrence of the alarm nearest to now
+	t = localtime(now)
+	today = mktime((t.tm_year, t.tm_mon, t.tm_mday, alarm_item.hour, alarm_item.minute, 0, 0, 0, -1))
+	return min([today - 86400, today, today + 86400], key = lambda due: abs(due - now))
+
+def sleep_until(at):
+	# Wall time, in steps so that a clock set meanwhile is followed
+	delay = at - time()
+	while delay > 0:
+		sleep(min(delay, 1))
+		delay = at - time()
+
+def names_of(constants):
+	# Value -> name of the constants of a class such as RadioState
+	return dict([(value, name) for (name, value) in vars(constants).items() if not name.startswith("_")])
@@ -0,0 +1,85 @@
+"""
+Bounded queue of the events fed to the conductor.
+
+Events come out by priority, then in the order they were put. Each carries its own
+value (the wheel position, the alarm) and the latency stamps of the inputs behind it:
+
+	queue = EventQueue(priorities = { ALARM: 1 }, coalesced = (WHEEL_MOVE, ), urgent = (ALARM, ))
+	queue.put(WHEEL_MOVE, 12)
+	queue.put(ALARM, alarm)
+	queue.get(3)   # -> (ALARM, alarm, stamps), None after 3s without an event
+
+A coalesced kind keeps one pending event, a newer one replaces its value in place.
+Beyond size pending events the newest is dropped, unless it is urgent: urgent events
+are never dropped nor coalesced. Pure Python, no hardware or GStreamer needed.
+"""
+
+import heapq
+import itertools
+import threading
+
+import tracing
+
+
+class EventQueue(object):
+	SIZE = 16
+	def __init__(self, priorities = None, coalesced = (), urgent = (), size = SIZE):
+		# kind -> priority, higher first, 0 for the kinds not listed
+		self.priorities = priorities or {}
+		self.coalescing = set(coalesced)
+		self.urgent = set(urgent)
+		self.size = size
+		self.condition = threading.Condition(threading.Lock())
+		# Heap of [-priority, sequence, kind, value, stamps]
+		self.entries = []
+		self.sequence = itertools.count()
+		self.puts = 0
+		self.gets = 0
+		self.coalesced = 0
+		# kind -> events dropped
+		self.dropped = {}
+		self.max_depth = 0
+
+	def put(self, kind, value = None):
+		stamps = tracing.latency.current()
+		with self.condition:
+			self.puts += 1
+			if kind in self.coalescing:
+				for entry in self.entries:
+					if entry[2] == kind:
+						entry[3] = value
+						entry[4] = (entry[4] + stamps)[-tracing.Latency.CARRIED:]
+						self.coalesced += 1
+						return True
+			if len(self.entries) >= self.size and kind not in self.urgent:
+				self.dropped[kind] = self.dropped.get(kind, 0) + 1
+				tracing.warning("events", "event %s dropped, %d pending", kind, len(self.entries))
+				return False
+			heapq.heappush(self.entries, [-self.priorities.get(kind, 0), next(self.sequence), kind, value, list(stamps)])
+			self.max_depth = max(self.max_depth, len(self.entries))
+			self.condition.notify()
+		return True
+
+	def get(self, timeout = None):
+		# Next (kind, value, stamps), None once timeout seconds passed without any (None: waits for one)
+		with self.condition:
+			if not self.entries:
+				self.condition.wait(timeout)
+			if not self.entries:
+				return None
+			priority, sequence, kind, value, stamps = heapq.heappop(self.entries)
+			self.gets += 1
+			return (kind, value, stamps)
+
+	def pending(self):
+		# Kinds waiting, in the order get() returns them
+		with self.condition:
+			return [entry[2] for entry in sorted(self.entries)]
+
+	def depth(self):
+		return len(self.entries)
+
+	def stats(self):
+		with self.condition:
+			return { "put": self.puts, "got": self.gets, "coalesced": self.coalesced, "dropped": dict(self.dropped),
+				"depth": len(self.entries), "max_depth": self.max_depth }
@@ -0,0 +1,24 @@
+"""
+Hardware backend: the RPIO, RPIO.PWM and MPR121 modules on the Pi, or their
+pure Python emulation (rpio_emulator) when NIXIE_BACKEND=emulator, to run and
+benchmark the clock anywhere:
+
+	NIXIE_BACKEND=emulator python bench.py
+"""
+
+import os
+
+BACKEND = os.environ.get("NIXIE_BACKEND", "rpio")
+
+if BACKEND == "emulator":
+	import rpio_emulator
+	RPIO = rpio_emulator.RPIO
+	PWM = rpio_emulator.PWM
+	# Used like the Adafruit module: MPR121.MPR121()
+	MPR121 = rpio_emulator
+elif BACKEND == "rpio":
+	import RPIO
+	import RPIO.PWM as PWM
+	import MPR121
+else:
+	raise ImportError("unknown NIXIE_BACKEND %s, use rpio or emulator" % BACKEND)
@@ -17,19 +17,41 @@ import getopt
 import thread
 import platform
 import threading
-import subprocess
 from time import sleep
 from LightUpAlarm import AlarmCli
 from LightUpAlarm import AlarmManager
 from LightUpServer import Server
 from user_input import UI, Wheel
-from nixie import DisplayThread
+from conductor import Conductor, WHEEL_STEPS, STEPS_PER_TURN
+from player import PlayerPool
+from network import ConnectivityMonitor, commands
+import tracing
 from gi import require_version
 require_version('Gst', '1.0')
 from gi.repository import GObject, Gst
 
-WHEEL_STEPS = 100
-STEPS_PER_TURN = 96
+# Pipelines kept, the playing one and the stations around it, and their bytes of network buffering
+PLAYER_POOL_SIZE = 3
+PLAYER_POOL_BUDGET = 3 * 1024 * 1024
+# Network streams play through a ring file of that many bytes each, None: directly. On tmpfs,
+# the rings never write to the SD card: 4 of them take 32MB of memory
+PLAYER_TIMESHIFT_DIR = "/dev/shm"
+PLAYER_TIMESHIFT_SIZE = 8 * 1024 * 1024
+# Seconds a station stays out, reconnecting, before the offline station plays instead
+PLAYER_FAILOVER = 30
+# Cathode anti-poisoning sweep: seconds between sweeps (whole minutes, from midnight) and seconds of each
+CATHODE_CYCLING_EVERY = 3600
+CATHODE_CYCLING_DURATION = 10
+# The alarm's station is connected and pre-rolled that long before the alarm
+ALARM_PREARM_MINUTES = 1
+# The gateway answers a TCP connect, even refusing it
+NETWORK_TARGET = ("gate", 80)
+# Recovery, once that many probes failed in a row: the Wi-Fi interface, then its driver
+NETWORK_STAGES = [
+	(6, "restarting wlan0", commands("ifdown wlan0", "ifup wlan0")),
+	(12, "reloading mt7601u", commands("ifdown wlan0", "rmmod mt7601u", "sleep 1", "modprobe mt7601u", "ifup wlan0")),
+]
+
 """
 from mplayer import Player
 
@@ -68,13 +90,13 @@ class CliThread(threading.Thread):
 
 	def run(self):
 		if self.cli_instance is None:
-			print('ERROR: Need to attach an AlarmManager instance using the '
-				  'attach_alarm_mgr method.', file=sys.stderr)
+			tracing.error("cli", 'ERROR: Need to attach an AlarmManager instance using the '
+				  'attach_alarm_mgr method.')
 			return
 		self.cli_instance.cmdloop()
 		# Exit from cli returns here. User has requested the app to exit, and
 		# this thread needs to request a keyboard interrupt to the main thread.
-		print("Exiting from CLI...")
+		tracing.info("cli", "Exiting from CLI...")
 		thread.interrupt_main()
 
 	def callback_event(self):
@@ -84,427 +106,6 @@ class CliThread(threading.Thread):
 		sys.stdout.write('\n%s' % self.cli_instance.prompt)
 
 
-class GstPlayer(object):
-	def __init__(self):
-		self.player = Gst.ElementFactory.make('playbin', 'player')
-
-	def play(self, uri, volume):
-		self.player.set_property("uri", uri)
-		#self.player.set_property("volume", volume/100.0)
-		self.player.set_state(Gst.State.PLAYING)
-
-	def stop(self):
-		self.player.set_state(Gst.State.NULL)
-
-	def set_volume(self, new_volume):
-		self.player.set_property("volume", new_volume/100.0)
-
-
-class Watchdog(threading.Thread):
-	def __init__(self, online, offline):
-		threading.Thread.__init__(self, name = "watchdog")
-		self.daemon = True
-		self.current_status = 1
-		self.offline = offline
-		self.online = online
-
-	def run(self):
-		timeout = 2
-		dev_null = open("/dev/null")
-		hostname = "gate"
-		cmd_str =  "ping -c1 -w2 " + hostname
-
-		while True:
-			return_code = subprocess.call(cmd_str.split(), stderr= dev_null, stdout = dev_null)
-
-			if return_code != 0 and self.current_status == 1:
-				self.current_status = 0
-				self.offline()
-				subprocess.call('ifdown wlan0'.split())
-				subprocess.call('rmmod mt7601u'.split())
-				sleep(1)
-				subprocess.call('modprobe mt7601u'.split())
-				subprocess.call('ifup wlan0'.split())
-
-			if return_code == 0 and self.current_status == 0:
-				self.current_status = 1
-				self.online()
-
-			sleep(timeout)
-
-
-class StateWheel:
-	VOLUME = 0
-
-class StateWheelSwitch:
-	PLAY = 0
-
-class RadioState:
-	DEFAULT = 0
-	VOLUME = 1
-	BRIGHTNESS = 2
-	NEXT = 3
-	STATION = 4
-	ALARM = 5
-	SNOOZE = 6
-	SLEEP = 7
-
-class RadioEvent:
-	TIMEOUT = 0
-	T = 1
-	M = 2
-	B = 3
-	WHEEL_MOVE = 4
-	WHEEL_PRESSED = 5
-	ALARM = 6
-	TMB = 7
-
-class Conductor(threading.Thread):
-	def __init__(self, wheel_setup_cb):
-		threading.Thread.__init__(self, name = "conductor")
-		self.daemon = True
-
-		GObject.threads_init()
-		Gst.init(None)
-
-		self.threading_event = threading.Event()
-
-		self.player = GstPlayer()
-		self.dt = DisplayThread()
-		self.dt.start()
-
-		self.wheel_setup_cb = wheel_setup_cb
-
-		self.alarm_mgr = None
-
-		self.offline_station = 'file:///home/yannick/Music/01 - Il Y A.mp3'
-		self.stations = []
-		#self.stations.append('file:///home/yannick/Music/01 - Il Y A.mp3')
-		#self.stations.append('http://tsfjazz.ice.infomaniak.ch/tsfjazz-high.mp3')
-		#self.stations.append('http://direct.fipradio.fr/live/fip-midfi.mp3')
-		#self.stations.append('http://rivieraradio.ice.infomaniak.ch:80/rivieraradio-high')
-		self.current_station = None
-
-		self.state_offline = False
-		self.state_playing = False
-		self.state_wheel_switch = StateWheelSwitch.PLAY
-		self.state_wheel = StateWheel.VOLUME
-		self.state_brightness = 50
-		self.state_volume = 0
-		self.state_station = 1
-		self.state_blanked = False
-
-		self.wheel_value = 50
-		self.alarm_value = None
-
-
-		self.state_volume_change(WHEEL_STEPS / 2)
-
-	def attach_alarm_mgr(self, alarm_mgr):
-		self.alarm_mgr = alarm_mgr
-		self.stations = self.alarm_mgr.get_all_stations()
-		if len(self.stations) > 0:
-			self.current_station = self.stations[0]
-
-
-	def state_station_change(self, new_station):
-		self.dt.display_number(10000 + new_station.id_)
-		if new_station == self.current_station:
-			return
-
-		self.current_station = new_station
-		if self.state_playing == True:
-			self.state_playing_change(False)
-			self.state_playing_change(True)
-
-	def state_playing_change(self, new_state):
-		if new_state == self.state_playing:
-			return
-
-		if new_state == True:
-			if self.state_offline:
-				self.player.play(self.offline_station, self.state_volume)
-			else:
-				self.player.play(self.current_station.url, self.state_volume)
-			self.player.set_volume(self.state_volume)
-			print('Playing music')
-		else:
-			self.player.stop()
-			print('Stopping music')
-
-		self.state_playing = new_state
-
-
-	def state_playing_toggle(self):
-		self.state_playing_change(not self.state_playing)
-
-	def state_blanking_toggle(self):
-		self.state_blanked = not self.state_blanked
-		if self.state_blanked:
-			self.dt.blank()
-		else:
-			self.dt.unblank()
-
-
-	def state_volume_change(self, new_volume):
-		self.dt.display_number(new_volume)
-		if new_volume == self.state_volume:
-			return
-
-		self.state_volume = new_volume * 100 / WHEEL_STEPS
-
-		print("volume: %s" % self.state_volume)
-
-		if self.state_playing:
-			self.player.set_volume(self.state_volume)
-
-	def state_brightness_change(self, new_brightness):
-		self.dt.display_number(new_brightness)
-		if new_brightness == self.state_brightness:
-			return
-
-		self.state_brightness = new_brightness * 100 / WHEEL_STEPS
-		self.dt.display.set_brightness(self.state_brightness)
-		self.dt.dots.set_brightness(self.state_brightness)
-
-		print("brightness: %s" % self.state_brightness)
-
-
-	def wheel_turned(self, val):
-		if self.state_wheel == StateWheel.VOLUME:
-			self.state_volume_change(val)
-
-
-	def wheel_switch_pressed(self):
-		if self.state_wheel_switch == StateWheelSwitch.PLAY:
-			self.state_playing_toggle()
-
-	def online(self):
-		print("Back online")
-		self.state_offline = False
-		if self.state_playing:
-			self.state_playing_change(False)
-			self.state_playing_change(True)
-
-	def offline(self):
-		print("Went offline")
-		self.state_offline = True
-		if self.state_playing:
-			self.state_playing_change(False)
-			self.state_playing_change(True)
-
-	def event_T(self):
-		self.event = RadioEvent.T
-		self.threading_event.set()
-
-	def event_M(self):
-		self.event = RadioEvent.M
-		self.threading_event.set()
-
-	def event_B(self):
-		self.event = RadioEvent.B
-		self.threading_event.set()
-
-	def event_WHEEL_PRESSED(self):
-		self.event = RadioEvent.WHEEL_PRESSED
-		self.threading_event.set()
-
-	def event_WHEEL_MOVE(self, new_val):
-		self.wheel_value = new_val
-		self.event = RadioEvent.WHEEL_MOVE
-		self.threading_event.set()
-
-	def event_ALARM(self, alarm_item):
-		self.alarm_value = alarm_item
-		self.event = RadioEvent.ALARM
-		self.threading_event.set()
-
-	def event_TMB(self):
-		self.event = RadioEvent.TMB
-		self.threading_event.set()
-
-
-	def to_state_DEFAULT(self):
-		self.wheel_setup_cb(0, self.state_volume, WHEEL_STEPS, (WHEEL_STEPS + 23) / 24, STEPS_PER_TURN, self.event_WHEEL_MOVE)
-		if self.state_blanked:
-			self.dt.blank()
-		self.dt.dots.steady(0, 1, 1)
-		self.dt.show_time()
-		self.state = RadioState.DEFAULT
-		self.timeout = None
-
-	def to_state_BRIGHTNESS(self):
-		self.wheel_setup_cb(0, self.state_brightness, WHEEL_STEPS, (WHEEL_STEPS + 23) / 24, STEPS_PER_TURN, self.event_WHEEL_MOVE)
-		self.state_brightness_change(self.state_brightness)
-		self.dt.dots.steady(1, 1, 1)
-		self.state = RadioState.BRIGHTNESS
-		self.timeout = 3
-
-	def to_state_NEXT(self):
-		alarm_item = self.alarm_mgr.get_next_alarm()
-		self.dt.display_number(alarm_item.hour*100 + alarm_item.minute)
-		self.dt.dots.altern()
-		self.state = RadioState.NEXT
-		self.timeout = 4
-
-	def to_state_STATION(self):
-		self.wheel_setup_cb(0, [s.id_ for s in self.stations].index(self.current_station.id_), len(self.stations) - 1, (len(self.stations) - 1 + 23) / 24, 8*(len(self.stations) - 1), self.event_WHEEL_MOVE)
-		self.state_station_change(self.current_station)
-		self.dt.dots.steady(0, 1, 1)
-		self.state = RadioState.STATION
-		self.timeout = 3
-
-	def to_state_ALARM(self):
-		station = self.alarm_mgr.get_station(self.alarm_value.station_id)
-		# '\a' is a request to the terminal to beep
-		print('\n\nRING RING RING ' + station.name + ' !!!!\a')
-
-		self.state_volume_change(WHEEL_STEPS / 2)
-		self.state_station_change(station)
-		self.state_playing_change(True)
-
-		self.dt.show_time()
-		self.dt.display.set_brightness(100)
-		self.dt.dots.set_brightness(100)
-		self.dt.dots.altern()
-		if self.state_blanked:
-			self.dt.unblank()
-
-		self.state = RadioState.ALARM
-		self.timeout = 1800
-
-	def from_state_ALARM(self):
-		self.state_playing_change(False)
-
-		self.dt.display.set_brightness(self.state_brightness)
-		self.dt.dots.set_brightness(self.state_brightness)
-
-	def run(self):
-		event_raised = False
-		self.event = RadioEvent.TIMEOUT
-		self.to_state_DEFAULT()
-
-		while True:
-			event_raised = self.threading_event.wait(self.timeout)
-			if not event_raised:
-				self.event = RadioEvent.TIMEOUT
-
-			print("State: %s  Event: %s timeout %s" % (self.state, self.event, self.timeout))
-			if self.state == RadioState.DEFAULT:
-				if self.event == RadioEvent.T:
-					self.to_state_BRIGHTNESS()
-
-				elif self.event == RadioEvent.M:
-					self.to_state_NEXT()
-
-				elif self.event == RadioEvent.B:
-					self.to_state_STATION()
-
-				elif self.event == RadioEvent.WHEEL_MOVE:
-					self.state_volume_change(self.wheel_value)
-					self.state = RadioState.VOLUME
-					self.timeout = 3
-
-				elif self.event == RadioEvent.WHEEL_PRESSED:
-					self.state_playing_toggle()
-
-				elif self.event == RadioEvent.ALARM:
-					self.to_state_ALARM()
-
-			elif self.state == RadioState.VOLUME:
-				if self.event == RadioEvent.TIMEOUT:
-					self.to_state_DEFAULT()
-
-				elif self.event == RadioEvent.T:
-					self.to_state_BRIGHTNESS()
-
-				elif self.event == RadioEvent.M:
-					self.to_state_NEXT()
-
-				elif self.event == RadioEvent.B:
-					self.to_state_STATION()
-
-				elif self.event == RadioEvent.WHEEL_MOVE:
-					self.state_volume_change(self.wheel_value)
-
-				elif self.event == RadioEvent.WHEEL_PRESSED:
-					self.state_playing_toggle()
-
-				elif self.event == RadioEvent.ALARM:
-					self.to_state_ALARM()
-
-
-			elif self.state == RadioState.BRIGHTNESS:
-				if self.event == RadioEvent.TIMEOUT:
-					self.to_state_DEFAULT()
-
-				elif self.event == RadioEvent.T:
-					self.state_blanking_toggle()
-					self.to_state_DEFAULT()
-
-				elif self.event == RadioEvent.M:
-					self.to_state_NEXT()
-
-				elif self.event == RadioEvent.B:
-					self.to_state_STATION()
-
-				elif self.event == RadioEvent.WHEEL_MOVE:
-					self.state_brightness_change(self.wheel_value)
-
-				elif self.event == RadioEvent.WHEEL_PRESSED:
-					self.state_playing_toggle()
-
-				elif self.event == RadioEvent.ALARM:
-					self.to_state_ALARM()
-
-
-			elif self.state == RadioState.NEXT:
-				if self.event == RadioEvent.TIMEOUT:
-					self.to_state_DEFAULT()
-
-				elif self.event == RadioEvent.T:
-					self.to_state_BRIGHTNESS()
-
-				elif self.event == RadioEvent.B:
-					self.to_state_STATION()
-
-				elif self.event == RadioEvent.ALARM:
-					self.to_state_ALARM()
-
-
-			elif self.state == RadioState.STATION:
-				if self.event == RadioEvent.TIMEOUT:
-					self.to_state_DEFAULT()
-
-				elif self.event == RadioEvent.T:
-					self.to_state_BRIGHTNESS()
-
-				elif self.event == RadioEvent.M:
-					self.to_state_NEXT()
-
-				elif self.event == RadioEvent.WHEEL_MOVE:
-					self.state_station_change(self.stations[self.wheel_value])
-
-				elif self.event == RadioEvent.WHEEL_PRESSED:
-					self.state_playing_toggle()
-
-				elif self.event == RadioEvent.ALARM:
-					self.to_state_ALARM()
-
-
-			elif self.state == RadioState.ALARM:
-				if self.event == RadioEvent.TIMEOUT:
-					self.from_state_ALARM()
-					self.to_state_DEFAULT()
-
-				elif self.event == RadioEvent.TMB:
-					self.from_state_ALARM()
-					self.to_state_DEFAULT()
-
-
-			print("New state: %s  Timeout: %s" % (self.state, self.timeout))
-			self.threading_event.clear()
-
 def parsing_args(argv):
 	"""
 	Processes the command line arguments. Arguments supported:
@@ -512,23 +113,25 @@ def parsing_args(argv):
 	-c / --cli
 	-s / --server
 	-b / --both
+	-t / --trace
 	:return: dictionary with available options(keys) and value(value)
 	"""
 	option_dict = {}
 	try:
 		opts, args = getopt.getopt(
-			argv, 'hscb', ['help', 'server', 'cli', 'both'])
+			argv, 'hscbt', ['help', 'server', 'cli', 'both', 'trace'])
 	except getopt.GetoptError as e:
-		print('There was a problem parsing the command line arguments:')
-		print('\t%s' % e)
+		tracing.error("main", 'There was a problem parsing the command line arguments:')
+		tracing.error("main", '\t%s' % e)
 		sys.exit(1)
 
 	for opt, arg in opts:
 		if opt in ('-h', '--help'):
-			print('Choose between running the application in command line ' +
+			tracing.info("main", 'Choose between running the application in command line ' +
 				  'interface, to launch the HTTP server, or both.\n' +
 				  '\t-c Command Line Interface\n\t-s Launch HTTP server\n'
-				  '\t-b Both command line and server')
+				  '\t-b Both command line and server\n'
+				  '\t-t Record the trace from start (kill -USR1 dumps it, -USR2 toggles it)')
 			sys.exit(0)
 		elif opt in ('-c', '--cli'):
 				option_dict['cli'] = None
@@ -536,12 +139,14 @@ def parsing_args(argv):
 				option_dict['server'] = None
 		elif opt in ('-b', '--both'):
 				option_dict['both'] = None
+		elif opt in ('-t', '--trace'):
+				option_dict['trace'] = None
 		else:
-			print('Flag ' + opt + ' not recognised.')
+			tracing.warning("main", 'Flag ' + opt + ' not recognised.')
 
 		# It only takes the server or the cli flag, so check
 		if 'server' in option_dict and 'cli' in option_dict:
-			print('Both server and cli flags detected, you can use the flag '
+			tracing.warning("main", 'Both server and cli flags detected, you can use the flag '
 				  '-b/--both for both.')
 	return option_dict
 
@@ -550,35 +155,45 @@ def main(argv):
 	"""
 	Gets the argument flags and launches the server or command line interface.
 	"""
-	print('Running Python version ' + platform.python_version())
+	tracing.install_signals()
+	tracing.info("main", 'Running Python version ' + platform.python_version())
 
 	# This variable is used to select between the different modes, defaults both
 	start = 'both'
 
 	# Checking command line arguments in order of priority
-	print('\n======= Parsing Command line arguments =======')
+	tracing.info("main", '\n======= Parsing Command line arguments =======')
 	if len(argv) > 0:
 		arguments = parsing_args(argv)
+		if 'trace' in arguments:
+			tracing.trace.set_level(tracing.DEBUG)
 		if 'both' in arguments:
-			print('Command line and server selected')
+			tracing.info("main", 'Command line and server selected')
 			start = 'both'
 		elif 'cli' in arguments:
-			print('Command line selected')
+			tracing.info("main", 'Command line selected')
 			start = 'cli'
 		elif 'server' in arguments:
-			print('Server selected')
+			tracing.info("main", 'Server selected')
 			start = 'server'
 	else:
-		print('No flags defaults to the command line interface.')
+		tracing.info("main", 'No flags defaults to the command line interface.')
 
 	# Loading the settings
-	print('\n=========== Launching Nixie Alarm Clock ==========')
+	tracing.info("main", '\n=========== Launching Nixie Alarm Clock ==========')
 
 	ui = UI()
 
-	conductor = Conductor(ui.wheel.setup)
+	GObject.threads_init()
+	Gst.init(None)
 
-	watchdog = Watchdog(conductor.online, conductor.offline)
+	conductor = Conductor(ui.wheel.setup, PlayerPool(size = PLAYER_POOL_SIZE, budget = PLAYER_POOL_BUDGET,
+		timeshift_dir = PLAYER_TIMESHIFT_DIR, timeshift_size = PLAYER_TIMESHIFT_SIZE, failover = PLAYER_FAILOVER))
+	conductor.player.set_failover_callback(conductor.station_failed)
+	conductor.dt.schedule_cathode_cycling(CATHODE_CYCLING_EVERY, CATHODE_CYCLING_DURATION)
+
+	monitor = ConnectivityMonitor(conductor.online, conductor.offline, target = NETWORK_TARGET,
+		health = conductor.player.healthy, stages = NETWORK_STAGES)
 
 	ui.set_wheel_pressed_callback(conductor.event_WHEEL_PRESSED)
 	ui.wheel.setup(0, WHEEL_STEPS / 2, WHEEL_STEPS, (WHEEL_STEPS + 23) / 24, STEPS_PER_TURN, conductor.state_volume_change)
@@ -600,11 +215,12 @@ def main(argv):
 		cli_thread = CliThread()
 		alarm_mgr = AlarmManager.AlarmManager(
 			alert_callback=conductor.event_ALARM,
-			offset_alert_callback=None)
+			offset_alert_callback=conductor.event_PREARM)
+		alarm_mgr.set_offset_alert_time(ALARM_PREARM_MINUTES)
 		conductor.attach_alarm_mgr(alarm_mgr)
 		cli_thread.attach_alarm_mgr(alarm_mgr)
 		conductor.start()
-		watchdog.start()
+		monitor.start()
 		cli_thread.start()
 
 		# Infinite loop can be the Flask server, or just a loop
@@ -618,7 +234,10 @@ def main(argv):
 				while cli_thread.isAlive():
 					sleep(0.2)
 		except (KeyboardInterrupt, SystemExit):
-			print("Exiting...")
+			tracing.info("main", "Exiting...")
+			tracing.info("main", "Conductor: %s", conductor.stats())
+			tracing.info("main", "Player: %s", conductor.player.stats())
+			tracing.info("main", "Network: %s", monitor.stats())
 			conductor.dt.blank()
 			conductor.player.stop()
 			# Allow the clean exit from the CLI interface to execute
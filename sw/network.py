@@ -0,0 +1,234 @@
+"""
+Connectivity monitor: probes the network from within the process, no ping forked.
+
+A probe is a non-blocking TCP connect (a refused connection is an answer too) or a
+UDP datagram (a DNS query by default) to the target, resolved once by a thread that
+is waited for timeout seconds at most. The stream playing counts as well: when health()
+says it flows, the network is up whatever the probe says, when it says the stream broke
+that is a failure too.
+
+	monitor = ConnectivityMonitor(conductor.online, conductor.offline, target = ("gate", 80),
+		health = player.healthy, stages = [(6, "restart wlan0", commands("ifdown wlan0", "ifup wlan0"))])
+	monitor.start()
+
+offline() is called after DOWN_AFTER failures in a row, online() after UP_AFTER successes.
+While probes fail, the next one waits twice as long, up to MAX_INTERVAL. stages are the
+recovery actions, (failures in a row, name, action): each runs once an outage, the last
+one again every time as many failures follow.
+
+	python network.py    # against a local stand-in server, with failures injected
+"""
+
+import sys
+import errno
+import socket
+import select
+import threading
+import subprocess
+from time import sleep
+
+import tracing
+from tracing import Histogram, monotonic
+
+# Query of the root name servers, any DNS server answers it
+DNS_QUERY = b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00\x01"
+# Seconds an outage lasted
+OUTAGES = (1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+
+def tcp_probe(address, timeout):
+	# Seconds to an answer of the host, accepting or refusing the connection, None without one
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.setblocking(0)
+	try:
+		start = monotonic()
+		error = s.connect_ex(address)
+		if error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+			readable, writable, failed = select.select([], [s], [], timeout)
+			if not writable:
+				return None
+			error = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if error in (0, errno.ECONNREFUSED):
+			return monotonic() - start
+		return None
+	finally:
+		s.close()
+
+def udp_probe(address, timeout, payload = DNS_QUERY):
+	# Seconds to a reply, or to the port being refused
+	s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	s.setblocking(0)
+	try:
+		start = monotonic()
+		s.connect(address)
+		s.send(payload)
+		readable, writable, failed = select.select([s], [], [], timeout)
+		if not readable:
+			return None
+		try:
+			s.recv(512)
+		except socket.error as e:
+			if e.errno != errno.ECONNREFUSED:
+				return None
+		return monotonic() - start
+	except socket.error:
+		return None
+	finally:
+		s.close()
+
+def commands(*lines):
+	# Recovery action running the commands one after the other
+	def run():
+		with open("/dev/null", "w") as dev_null:
+			for line in lines:
+				subprocess.call(line.split(), stdout = dev_null, stderr = dev_null)
+	return run
+
+
+class ConnectivityMonitor(threading.Thread):
+	INTERVAL = 5
+	MAX_INTERVAL = 60
+	TIMEOUT = 2
+	DOWN_AFTER = 3
+	UP_AFTER = 2
+
+	def __init__(self, online, offline, target = ("gate", 80), protocol = "tcp", health = None, stages = (),
+		interval = INTERVAL, max_interval = MAX_INTERVAL, timeout = TIMEOUT, down_after = DOWN_AFTER, up_after = UP_AFTER):
+		threading.Thread.__init__(self, name = "network")
+		self.daemon = True
+		self.online = online
+		self.offline = offline
+		self.target = target
+		self.protocol = protocol
+		# Returns True when the stream playing flows, False when it broke, None: no opinion
+		self.health = health
+		self.stages = list(stages)
+		self.interval = interval
+		self.max_interval = max_interval
+		self.timeout = timeout
+		self.down_after = down_after
+		self.up_after = up_after
+		self.stopping = threading.Event()
+		# Resolved once, by the resolver thread: getaddrinfo() blocks as long as the resolver takes
+		self.address = None
+		self.resolver = None
+		self.injected = 0
+
+		self.up = True
+		self.failures = 0
+		self.successes = 0
+		self.probes = 0
+		self.failed = 0
+		self.last_rtt = None
+		self.rtt = Histogram()
+		self.outages = 0
+		self.outage_start = None
+		self.outage = Histogram(OUTAGES, unit = "s")
+		self.recoveries = dict([(name, 0) for (failures, name, action) in self.stages])
+
+	def resolve(self):
+		# Address of the target, None until resolved: a lookup that takes longer goes on for the next probe
+		if self.address == None:
+			if self.resolver == None or not self.resolver.is_alive():
+				self.resolver = threading.Thread(target = self.lookup, name = "resolver")
+				self.resolver.daemon = True
+				self.resolver.start()
+			self.resolver.join(self.timeout)
+		return self.address
+
+	def lookup(self):
+		try:
+			self.address = socket.getaddrinfo(self.target[0], self.target[1], socket.AF_INET)[0][4]
+		except socket.error:
+			pass
+
+	def probe(self):
+		# Seconds to an answer, None without one
+		address = self.resolve()
+		if address == None:
+			return None
+		if self.protocol == "udp":
+			return udp_probe(address, self.timeout)
+		return tcp_probe(address, self.timeout)
+
+	def inject(self, count):
+		# The next count probes fail, to test
+		self.injected = count
+
+	def step(self):
+		# One probe, returns the seconds until the next one is due
+		self.probes += 1
+		if self.injected:
+			self.injected -= 1
+			rtt = None
+		else:
+			rtt = self.probe()
+		if rtt != None:
+			self.last_rtt = rtt
+			self.rtt.add(rtt)
+		healthy = self.health() if self.health else None
+
+		if healthy == True or (rtt != None and healthy != False):
+			self.failures = 0
+			self.successes += 1
+			if not self.up and self.successes >= self.up_after:
+				self.up = True
+				self.outage.add(monotonic() - self.outage_start)
+				tracing.info("network", "Online again after %.0fs", monotonic() - self.outage_start)
+				self.online()
+		else:
+			self.failed += 1
+			self.failures += 1
+			self.successes = 0
+			if self.up and self.failures >= self.down_after:
+				self.up = False
+				self.outages += 1
+				self.outage_start = monotonic()
+				self.offline()
+			self.recover()
+		return self.delay()
+
+	def recover(self):
+		for i, (failures, name, action) in enumerate(self.stages):
+			if self.failures == failures or (i == len(self.stages) - 1 and self.failures % failures == 0):
+				tracing.warning("network", "%d probes failed in a row, %s", self.failures, name)
+				self.recoveries[name] += 1
+				action()
+
+	def delay(self):
+		if self.failures == 0:
+			return self.interval
+		return min(self.interval * 2 ** (self.failures - 1), self.max_interval)
+
+	def run(self):
+		while not self.stopping.wait(self.step()):
+			pass
+
+	def stop(self):
+		self.stopping.set()
+
+	def stats(self):
+		return { "up": self.up, "probes": self.probes, "failed": self.failed, "failures": self.failures, "last_rtt": self.last_rtt,
+			"rtt": self.rtt.stats(), "outages": self.outages, "outage": self.outage.stats(), "recoveries": dict(self.recoveries) }
+
+
+if __name__ == "__main__":
+	# Stand-in server on the loopback, failures injected, recovery stages only traced
+	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.bind(("127.0.0.1", 0))
+	server.listen(5)
+	def serve():
+		while True:
+			server.accept()[0].close()
+	thread = threading.Thread(target = serve, name = "server")
+	thread.daemon = True
+	thread.start()
+	monitor = ConnectivityMonitor(lambda: sys.stdout.write("online\n"), lambda: sys.stdout.write("offline\n"), target = server.getsockname(),
+		stages = [(4, "stage 1", lambda: None), (6, "stage 2", lambda: None)], interval = 0.05, max_interval = 0.4)
+	for (label, failures, probes) in (("up", 0, 5), ("blip", 2, 5), ("outage", 14, 14), ("back", 0, 3)):
+		monitor.inject(failures)
+		for i in range(0, probes):
+			sleep(monitor.step())
+		stats = monitor.stats()
+		print("%-6s up %s, %d of %d probes failed, %d outages (longest %.1fs), recoveries %s, rtt %.2fms" % (label, stats["up"], stats["failed"],
+			stats["probes"], stats["outages"], stats["outage"]["max"], stats["recoveries"], stats["rtt"]["max"] * 1000))
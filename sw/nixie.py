@@ -1,9 +1,16 @@
 #! /usr/bin/python -u
 
 import threading
-import RPIO.PWM as PWM
-import RPIO
-from time import localtime, sleep, struct_time
+from collections import OrderedDict, deque
+from math import cos, pi
+from time import localtime, sleep, struct_time, time
+
+from hardware import RPIO, PWM
+import tracing
+from tracing import Histogram, monotonic
+
+# Imported first thing by main.py, close enough to process start for the startup report
+startup_time = time()
 
 # Dots GPIOs
 dot_top = 23
@@ -20,6 +27,8 @@ cathode_D = 9
 
 nixie_channel = 7
 dots_channel = 6
+# Cathode anti-poisoning sweeps, idle (empty buffer) the rest of the time
+poison_channel = 5
 
 tube_gpios = (anode_a, anode_b, anode_c)
 digit_gpios = (cathode_A, cathode_B, cathode_C, cathode_D)
@@ -52,18 +61,156 @@ tube_mask = (1 << tube_gpios[0]) | (1 << tube_gpios[1]) | (1 << tube_gpios[2])
 
 dots_mask = (1 << dot_top) | ( 1 << dot_bot)
 
+# Multiplexing layout of the nixie channel. Each tube gets a window of stride slots:
+#   0                 cathodes set to the digit
+#   LEAD              anode on
+#   LEAD + length     anode off (length: 1 slot to tube_length, following the brightness)
+#   digit_length      cathodes cleared
+#   stride            next tube
+# dead_time_us between the anode going off and the next window lets the tube deionize,
+# the cathodes are cleared digit_gap_us before the next window so they never change under a lit anode.
+# The defaults give the original 4 tubes at 100Hz: stride 250, tube length 170, digit length 240.
+class Layout:
+	LEAD = 1
+	MIN_DEAD_TIME_US = 200
+	def __init__(self, tube_count = 4, refresh_hz = 100, pulse_incr_us = 10, dead_time_us = 790, digit_gap_us = 100, anodes = tubes):
+		if tube_count > len(anodes):
+			# The default anodes are the codes of the 4 tubes of the clock, more tubes need anodes passed
+			raise ValueError("%d tubes need %d anode codes, only %d %s" % (tube_count, tube_count, len(anodes),
+				"in the default anodes, pass anodes" if anodes is tubes else "given"))
+		if dead_time_us < Layout.MIN_DEAD_TIME_US:
+			raise ValueError("dead time of %dus would ghost, at least %dus needed" % (dead_time_us, Layout.MIN_DEAD_TIME_US))
+
+		self.tubes = tube_count
+		self.pulse_incr_us = pulse_incr_us
+		self.slots = int(round(1000000.0 / refresh_hz / pulse_incr_us))
+		self.period = self.slots * pulse_incr_us
+		self.refresh_hz = 1000000.0 / self.period
+		self.stride = self.slots / tube_count
+		self.lead = Layout.LEAD
+		self.dead = (dead_time_us + pulse_incr_us - 1) / pulse_incr_us
+		self.tube_length = self.stride - self.lead - self.dead
+		self.digit_length = self.stride - (digit_gap_us + pulse_incr_us - 1) / pulse_incr_us
+		self.tube_sets = tube_sets[:tube_count] if anodes is tubes else \
+			map(lambda (a,b,c): (a << tube_gpios[0]) | (b << tube_gpios[1]) | (c << tube_gpios[2]), anodes[:tube_count])
+
+		if self.tube_length < 1:
+			raise ValueError("%d tubes at %dHz overlap: %d slot windows cannot hold the anode lead and dead time" % (tube_count, refresh_hz, self.stride))
+		if self.digit_length <= self.lead + self.tube_length or self.digit_length >= self.stride:
+			raise ValueError("cathodes would change while the anode is lit (digit length %d, tube length %d, stride %d)" % (self.digit_length, self.tube_length, self.stride))
+
+	def report(self):
+		# Duty cycle of one tube at full brightness, brightness steps, and DMA use:
+		# RPIO spends two 32 byte control blocks and a 4 byte sample on every slot of a subcycle
+		return { "tubes": self.tubes, "refresh_hz": self.refresh_hz, "period_us": self.period,
+			"slots": self.slots, "stride": self.stride, "tube_length": self.tube_length,
+			"dead_time_us": self.dead * self.pulse_incr_us, "digit_length": self.digit_length,
+			"duty_cycle": float(self.tube_length) / self.slots,
+			"brightness_us": (self.pulse_incr_us, self.tube_length * self.pulse_incr_us),
+			"brightness_steps": self.tube_length,
+			"slots_used": 4 * self.tubes, "dma_bytes": self.slots * (2 * 32 + 4) }
+
+default_layout = Layout()
+
+empty_slot = (0, False)
+
+# In-memory image of a DMA channel buffer: {slot: (gpio bits, set_on)}.
+# Only occupied slots are stored, a display subcycle has about 20 of its 1000 slots in use.
+# It exposes the same writers as DMAChannel so the Tube/Dots code can draw into either.
+class Frame:
+	def __init__(self, slots = None):
+		self.slots = dict(slots) if slots else {}
+
+	def get(self, position):
+		return self.slots.get(position, empty_slot)
+
+	def put(self, position, bits, on):
+		if bits or on:
+			self.slots[position] = (bits, on)
+		else:
+			self.slots.pop(position, None)
+
+	def set_on(self, position):
+		bits, on = self.get(position)
+		self.put(position, bits, True)
+
+	def set_off(self, position):
+		bits, on = self.get(position)
+		self.put(position, bits, False)
+
+	def assign(self, gpios, position):
+		bits, on = self.get(position)
+		for gpio in gpios:
+			bits |= 1 << gpio
+		self.put(position, bits, on)
+
+	def set_mask(self, set, mask, position):
+		bits, on = self.get(position)
+		self.put(position, (bits & ~mask) | (set & mask), on)
+
+	def diff(self, other):
+		# Slots to write to go from self to other, in buffer order
+		changes = []
+		for position in sorted(set(self.slots) | set(other.slots)):
+			new = other.get(position)
+			if new != self.get(position):
+				changes.append((position, new))
+		return changes
+
+	def table(self, length):
+		# Complete slot table, as the DMA engine sees it
+		return [self.get(position) for position in range(0, length)]
+
+	def __eq__(self, other):
+		return isinstance(other, Frame) and self.slots == other.slots
+
+	def __ne__(self, other):
+		return not self == other
+
+
+# Double buffered channels draw into a shadow frame and publish it with swap().
+# RPIO gives no way to flip buffers or to know where the DMA engine is in the subcycle, so the swap
+# is a gated burst: the gates (set_on slots of gate_mask GPIOs, i.e. tube anodes) of every window
+# whose other slots change are switched off first, and once a window has passed (an anode lit before
+# has met its off slot) the window is rewritten and the gates are switched back on. A window where only
+# anode-off slots move (brightness) keeps its old ones next to the new ones instead: the anode goes off
+# at the first of them, the tube never goes dark. Only when a new off slot comes before an old one is
+# there a window to wait before the old ones go.
+# A refresh caught in the middle of the burst shows a dark or a shorter lit tube, never a wrong digit or a ghost.
+# The waits hold the calling thread (the display thread): at most two windows a commit, 2.5ms each for
+# 4 tubes at 100 Hz, none for a brightness going up. waits and waited (us) count them.
 class DMAChannel:
-	def __init__(self, channel = 0, period = 10000, gpios = ()):
+	def __init__(self, channel = 0, period = 10000, gpios = (), pwm = None, double_buffered = False, gate_mask = 0, window = 0):
 		self.channel = channel
+		self.period = period
 		self.gpios = gpios
-
-		PWM.init_channel(channel, period)
-		PWM.print_channel(channel)
+		self.pwm = pwm or PWM
+		self.mask = 0
+		for gpio in gpios:
+			self.mask |= 1 << gpio
+		# Mirror of what has been written to the DMA buffer
+		self.frame = Frame()
+		self.writes = 0
+		self.double_buffered = double_buffered
+		self.shadow = Frame()
+		self.gate_mask = gate_mask
+		self.window = window
+		self.swaps = 0
+		self.waits = 0
+		self.waited = 0
+
+		self.pwm.init_channel(channel, period)
+		self.pwm.print_channel(channel)
+		self.slots = period / self.pwm.get_pulse_incr_us()
 
 		# Calling clear channel on a gpio that was not used with add_channel_pulse triggers an error,
 		# so avoid it by adding/removing all gpios at channel init time
 		for gpio in gpios:
-			PWM.add_channel_pulse(self.channel, gpio, 0, 1)
+			self.pwm.add_channel_pulse(self.channel, gpio, 0, 1)
+			self.frame.assign((gpio,), 0)
+			self.frame.set_on(0)
+			self.frame.assign((gpio,), 1)
+			self.frame.set_off(1)
 		self.reset()
 
 	def apply(self, gpio_sets, gpios = None):
@@ -76,124 +223,539 @@ class DMAChannel:
 			for i in range(0, len(gpios)):
 				#print i
 				if gpio_set[i] == 1:
-					PWM.add_channel_pulse(self.channel, gpios[i], start, width)
+					self.pwm.add_channel_pulse(self.channel, gpios[i], start, width)
+					self.frame.assign((gpios[i],), start)
+					self.frame.set_on(start)
+					self.frame.assign((gpios[i],), start + width)
+					self.frame.set_off(start + width)
+		self.shadow = Frame(self.frame.slots)
 
 	def set_on(self, position):
-		PWM.buffer_set_on(self.channel, position)
+		if self.double_buffered:
+			self.shadow.set_on(position)
+			return
+		self.pwm.buffer_set_on(self.channel, position)
+		self.frame.set_on(position)
+		self.writes += 1
 
 	def set_off(self, position):
-		PWM.buffer_set_off(self.channel, position)
+		if self.double_buffered:
+			self.shadow.set_off(position)
+			return
+		self.pwm.buffer_set_off(self.channel, position)
+		self.frame.set_off(position)
+		self.writes += 1
 
 	def assign(self, gpios, position):
+		if self.double_buffered:
+			self.shadow.assign(gpios, position)
+			return
 		for gpio in gpios:
-			PWM.buffer_assign(self.channel, gpio, position)
+			self.pwm.buffer_assign(self.channel, gpio, position)
+			self.writes += 1
+		self.frame.assign(gpios, position)
 
 	def set_mask(self, set, mask, position):
-		PWM.buffer_set_mask(self.channel, set, mask, position)
+		if self.double_buffered:
+			self.shadow.set_mask(set, mask, position)
+			return
+		self.pwm.buffer_set_mask(self.channel, set, mask, position)
+		self.frame.set_mask(set, mask, position)
+		self.writes += 1
+
+	def write(self, frame, changes = None):
+		# Bring the DMA buffer to frame, writing only the slots (and within them, the mask or the
+		# on/off switch) that differ from the mirrored buffer.
+		# changes: frame.diff() from the mirrored buffer, when the caller has it already
+		writes = 0
+		if changes == None:
+			changes = self.frame.diff(frame)
+		for position, (bits, on) in changes:
+			old_bits, old_on = self.frame.get(position)
+			if bits != old_bits:
+				self.pwm.buffer_set_mask(self.channel, bits, self.mask, position)
+				writes += 1
+			if on != old_on:
+				if on:
+					self.pwm.buffer_set_on(self.channel, position)
+				else:
+					self.pwm.buffer_set_off(self.channel, position)
+				writes += 1
+		self.frame = Frame(frame.slots)
+		self.writes += writes
+		return writes
+
+	def gates(self, frame, windows):
+		return [position for position, (bits, on) in frame.slots.items()
+			if on and bits & self.gate_mask and position / self.window in windows]
+
+	def anode_off(self, slot):
+		# Empty, or only switching gates off
+		bits, on = slot
+		return not on and not bits & ~self.gate_mask
+
+	def wait_window(self):
+		# Until the DMA engine is out of the window it is scanning
+		us = self.period * self.window / self.slots
+		self.waits += 1
+		self.waited += us
+		if hasattr(self.pwm, "elapse"):
+			self.pwm.elapse(self.channel, us)
+		else:
+			sleep(us / 1000000.0)
+
+	def earlier_off(self, frame, position, gates):
+		# Whether frame switches one of the gates off before position, in its window
+		return any([p < position and p / self.window == position / self.window and not on and bits & gates
+			for p, (bits, on) in frame.slots.items()])
+
+	def commit(self, frame, changes = None):
+		# Returns the number of writes
+		if not self.double_buffered or not self.gate_mask or not self.window:
+			writes = self.write(frame, changes)
+		else:
+			if changes == None:
+				changes = self.frame.diff(frame)
+			rewired = set()
+			moved = set()
+			for position, slot in changes:
+				if self.anode_off(slot) and self.anode_off(self.frame.get(position)):
+					moved.add(position / self.window)
+				else:
+					rewired.add(position / self.window)
+			moved -= rewired
+
+			dark = Frame(self.frame.slots)
+			for position in self.gates(self.frame, rewired):
+				dark.set_off(position)
+			writes = self.write(dark)
+			if writes:
+				self.wait_window()
+
+			bridge = Frame(frame.slots)
+			for position in self.gates(frame, rewired):
+				bridge.set_off(position)
+			# A refresh that meets a new off slot after the old one is gone would miss both
+			early = False
+			for position, (bits, on) in self.frame.slots.items():
+				if not on and bits & self.gate_mask and position / self.window in moved:
+					new_bits, new_on = bridge.get(position)
+					gates = bits & self.gate_mask & ~new_bits
+					if gates:
+						bridge.put(position, new_bits | gates, new_on)
+						early = early or self.earlier_off(frame, position, gates)
+			writes += self.write(bridge)
+			if early:
+				self.wait_window()
+			writes += self.write(frame)
+
+		if self.double_buffered:
+			self.shadow = Frame(frame.slots)
+			self.swaps += 1
+		# Lets a simulated backend tell complete frames from torn ones
+		if hasattr(self.pwm, "publish"):
+			self.pwm.publish(self.channel)
+		return writes
+
+	def swap(self):
+		# Publish what has been drawn in the shadow frame
+		return self.commit(self.shadow)
+
+	def torn_frames(self):
+		# Only a simulated backend can watch the DMA engine scan the buffer, None on hardware
+		return getattr(self.pwm, "torn", {}).get(self.channel)
 
 	def reset(self):
 		for gpio in reversed(self.gpios):
-			PWM.clear_channel_gpio(self.channel, gpio)
+			self.pwm.clear_channel_gpio(self.channel, gpio)
+			for position, (bits, on) in list(self.frame.slots.items()):
+				self.frame.put(position, bits & ~(1 << gpio), on)
+		self.shadow = Frame(self.frame.slots)
+
+	def memory(self):
+		# Bytes RPIO maps for the channel: two 32 bytes control blocks and a 4 bytes sample per slot, in pages
+		return (self.slots * (2 * 32 + 4) + 4095) / 4096 * 4096
+
+
+# Brightness fades: the brightness of every step is worked out (and its frame compiled) up front,
+# a single fader thread then only commits them on time. Deadlines are monotonic, a clock step
+# neither freezes nor rushes a fade.
+
+def linear(x):
+	return x
+
+def ease_in(x):
+	return x * x
+
+def ease_out(x):
+	return x * (2 - x)
+
+def ease_in_out(x):
+	return x * x * (3 - 2 * x)
+
+def fade_schedule(start, end, duration, easing = ease_in_out, rate = 100):
+	# [(seconds from the start of the fade, brightness)], only the steps where the brightness changes
+	steps = max(int(duration * rate), 1)
+	schedule = []
+	previous = start
+	for step in range(1, steps + 1):
+		brightness = int(round(start + (end - start) * easing(float(step) / steps)))
+		if brightness != previous or step == steps:
+			schedule.append((float(step) / rate, brightness))
+			previous = brightness
+	return schedule
+
+class Fader(threading.Thread):
+	def __init__(self, dispatch = None):
+		# dispatch(target, generation, deadline, brightness, done): hands a due step over to the thread
+		# writing the channels, which commits it with step(). Without it the fader commits them itself.
+		threading.Thread.__init__(self, name = "fader")
+		self.daemon = True
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.dispatch = dispatch or self.step
+		# target -> [deadline, brightness, ...] steps still to come, and the callback once done
+		self.fades = {}
+		# target -> fade number, steps of an older fade are dropped
+		self.generations = {}
+		# Seconds each step was committed after its deadline
+		self.lateness = deque(maxlen = 1000)
+
+	def play(self, target, schedule, done = None, start = None):
+		# Replaces any fade running on target. start: monotonic time the schedule offsets count from (default now)
+		if start == None:
+			start = monotonic()
+		with self.lock:
+			self.fades[target] = ([(start + offset, brightness) for (offset, brightness) in schedule], done)
+			self.generations[target] = self.generations.get(target, 0) + 1
+		self.event.set()
+
+	def cancel(self, target):
+		with self.lock:
+			self.fades.pop(target, None)
+			self.generations[target] = self.generations.get(target, 0) + 1
+
+	def playing(self, target):
+		with self.lock:
+			return target in self.fades
+
+	def run(self):
+		while True:
+			with self.lock:
+				deadlines = [steps[0][0] for (steps, done) in self.fades.values()]
+			if not deadlines:
+				self.event.wait()
+				self.event.clear()
+				continue
+
+			delay = min(deadlines) - monotonic()
+			if delay > 0:
+				self.event.wait(delay)
+				self.event.clear()
+				continue
+
+			now = monotonic()
+			with self.lock:
+				due = []
+				for target, (steps, done) in list(self.fades.items()):
+					# A late step is skipped when the next one is due as well
+					while len(steps) > 1 and steps[1][0] <= now:
+						steps.pop(0)
+					if steps[0][0] <= now:
+						deadline, brightness = steps.pop(0)
+						if not steps:
+							del self.fades[target]
+						due.append((target, self.generations[target], deadline, brightness, done if not steps else None))
+			for (target, generation, deadline, brightness, done) in due:
+				self.dispatch(target, generation, deadline, brightness, done)
+
+	def step(self, target, generation, deadline, brightness, done):
+		with self.lock:
+			if self.generations.get(target) != generation:
+				return
+		target.fade_step(brightness)
+		self.lateness.append(monotonic() - deadline)
+		if done:
+			done()
+
+	def stats(self):
+		lateness = sorted(self.lateness)
+		if not lateness:
+			return { "steps": 0 }
+		return { "steps": len(lateness), "mean": sum(lateness) / len(lateness),
+			"p99": lateness[len(lateness) * 99 / 100], "max": lateness[-1] }
 
 
 # Put set_on at regular intervals (100 Hz) at init time (never moved)
 # Put set_off based on brightness, assign both dots on every set_off
 # Assign dots to set_on based on requested sequence
 
+def dot_pattern(*phases):
+	# phases: (dots, milliseconds) played one after the other over the second of the dots channel.
+	# dots: the GPIO set to light, or (GPIO set, percentage of the dot length) to dim them.
+	pattern = []
+	for (dots, duration) in phases:
+		pattern += [dots] * (duration * Dots.MARKERS / 1000)
+	return tuple(pattern)
+
+def breathing_pattern(markers):
+	# Fades in and out once a second
+	return tuple([(dots_mask, int(50 - 50 * cos(2 * pi * i / markers))) for i in range(0, markers)])
+
 class Dots:
 	PERIOD = 1000000
 	DOT_LENGTH = 999
+	INTERVAL = 1000
+	MARKERS = PERIOD / 10 / INTERVAL
 	STRIDE = 0
-	def __init__(self):
+	TEMPLATE = None
+	CACHE_SIZE = 128
+	# Switches between two frames, as the slots to write
+	TRANSITIONS = 64
+	def __init__(self, pwm = None, fader = None, cache_size = CACHE_SIZE):
 		self.dot_length = Dots.DOT_LENGTH
-		self.channel = DMAChannel(channel = dots_channel, period = Dots.PERIOD, gpios = (dot_top, dot_bot))
-
-		i = 0
-		while i < Dots.PERIOD / 10:
-			mod = i % 1000
-			if mod == 0:
-				self.channel.assign((dot_top, dot_bot), i)
-				self.channel.set_on(i)
-			if mod == self.dot_length:
-				self.channel.assign((dot_top, dot_bot), i)
-				self.channel.set_off(i)
-			i += 1
+		self.brightness = 100
+		self.pattern = dot_patterns["on"]
+		self.fader = fader
+		self.cache = FrameCache(cache_size, compile_dots)
+		self.channel = DMAChannel(channel = dots_channel, period = Dots.PERIOD, gpios = (dot_top, dot_bot), pwm = pwm)
+		# (from state, to state) -> changes, most recently used last
+		self.transitions = OrderedDict()
+		self.state = None
+
+		# Both dots on, full length: the markers go straight to their slots, no need to walk the whole buffer
+		if Dots.TEMPLATE == None:
+			Dots.TEMPLATE = compile_dots(Dots.DOT_LENGTH, dot_patterns["on"])
+		self.channel.commit(Dots.TEMPLATE)
+		self.state = (Dots.DOT_LENGTH, dot_patterns["on"])
 
 	def reset(self):
 		self.channel.reset()
-
-	def set_brightness(self, percentage):
+		self.state = None
+
+	def report(self):
+		return { "engine": self.__class__.__name__, "slots": self.channel.slots, "memory": self.channel.memory(), "cached": len(self.cache.frames) }
+
+	def prepare(self):
+		# Compiles the library at the current brightness, a switch to any of its patterns is then a cache hit
+		for pattern in dot_patterns.values():
+			self.cache.get(self.dot_length, pattern)
+
+	def render(self):
+		state = (self.dot_length, tuple(self.pattern))
+		if state == self.state:
+			return 0
+		frame = self.cache.get(*state)
+		transition = (self.state, state)
+		changes = self.transitions.pop(transition, None)
+		if changes == None or self.state == None:
+			changes = self.channel.frame.diff(frame)
+		self.transitions[transition] = changes
+		if len(self.transitions) > Dots.TRANSITIONS:
+			self.transitions.popitem(last = False)
+		self.state = state
+		tracing.latency.mark("render")
+		writes = self.channel.commit(frame, changes)
+		tracing.latency.mark("dma")
+		return writes
+
+	def length(self, percentage):
 		dot_length = (min(max(percentage, 0), 100) * Dots.DOT_LENGTH) / 100
-		dot_length = max(dot_length, 1)
+		return max(dot_length, 1)
 
-		if dot_length != self.dot_length:
-			old_pos = self.dot_length
-			new_pos = dot_length
-			while old_pos < Dots.PERIOD / 10:
-				self.channel.set_mask(dots_mask, dots_mask, new_pos)
-				self.channel.set_off(new_pos)
-
-				self.channel.set_mask(0, dots_mask, old_pos)
-				self.channel.set_off(old_pos) #TODO implement set_none
+	def set_brightness(self, percentage):
+		if self.fader:
+			self.fader.cancel(self)
+		self.fade_step(percentage)
 
-				old_pos += 1000
-				new_pos += 1000
+	def fade_step(self, percentage):
+		self.brightness = percentage
+		dot_length = self.length(percentage)
 
+		if dot_length != self.dot_length:
 			self.dot_length = dot_length
+			self.render()
+
+	def fade(self, start, end, duration, easing = ease_in_out, done = None):
+		if start == None:
+			start = self.brightness
+		schedule = fade_schedule(start, end, duration, easing)
+		for (offset, brightness) in schedule:
+			self.cache.get(self.length(brightness), tuple(self.pattern))
+		self.fader.play(self, schedule, done)
 
 	def steady(self, val, top, bot):
 		mask =  (top << dot_top) | (bot << dot_bot)
 		value =  ((val & top) << dot_top) | ((val & bot) << dot_bot)
 
-		pos = 0
-		while pos < Dots.PERIOD / 10:
-			self.channel.set_mask(value, mask, pos)
-			pos += 1000
+		pattern = []
+		for marker in self.pattern:
+			if isinstance(marker, tuple):
+				pattern.append(((marker[0] & ~mask) | value, marker[1]))
+			else:
+				pattern.append((marker & ~mask) | value)
+		self.pattern = tuple(pattern)
+		self.render()
+
+	def show(self, name):
+		# A pattern of dot_patterns
+		self.pattern = dot_patterns[name]
+		self.render()
 
 	def altern(self):
-		pos = 0
+		self.show("alternate")
+
+
+# The dots patterns, more can be added with define_dot_pattern()
+dot_patterns = {
+	"on": dot_pattern((dots_mask, 1000)),
+	"off": dot_pattern((0, 1000)),
+	"blink": dot_pattern((dots_mask, 500), (0, 500)),
+	"alternate": dot_pattern((1 << dot_top, 250), (1 << dot_bot, 250), (1 << dot_top, 250), (1 << dot_bot, 250)),
+	"heartbeat": dot_pattern((dots_mask, 100), (0, 100), (dots_mask, 100), (0, 700)),
+	# The channel does not start on a second of the clock, the pulse is not in phase with the seconds
+	"seconds": dot_pattern((dots_mask, 100), (0, 900)),
+	"breathing": breathing_pattern(Dots.MARKERS),
+}
+
+def define_dot_pattern(name, *phases):
+	# phases: as for dot_pattern(), or a complete pattern of Dots.MARKERS values
+	if len(phases) == 1 and len(phases[0]) == Dots.MARKERS:
+		pattern = tuple(phases[0])
+	else:
+		pattern = dot_pattern(*phases)
+	if len(pattern) != Dots.MARKERS:
+		raise ValueError("dot pattern %s lasts %d markers, not %d" % (name, len(pattern), Dots.MARKERS))
+	dot_patterns[name] = pattern
+
+
+def dot_phases(pattern, shortest = 50):
+	# The runs of equal markers of a pattern, as (marker, seconds) phases.
+	# shortest: milliseconds, a pattern changing faster is sampled at that rate.
+	step = max(shortest * Dots.MARKERS / 1000, 1)
+	phases = []
+	for i in range(0, len(pattern), step):
+		duration = float(min(step, len(pattern) - i)) / Dots.MARKERS
+		if phases and phases[-1][0] == pattern[i]:
+			phases[-1] = (pattern[i], phases[-1][1] + duration)
+		else:
+			phases.append((pattern[i], duration))
+	if len(phases) > 1 and phases[0][0] == phases[-1][0]:
+		# The last run goes on into the first one
+		phases[0] = (phases[0][0], phases[0][1] + phases[-1][1])
+		phases.pop()
+	return phases
+
 
-		value = (1 << dot_top)
-		while pos < Dots.PERIOD / 40:
-			self.channel.set_mask(value, dots_mask, pos)
-			pos += 1000
+class PhaseTimer:
+	# Fader target stepping the phases of CompactDots, its own brightness fades use the dots as target
+	def __init__(self, dots):
+		self.dots = dots
 
-		value = (1 << dot_bot)
-		while pos < Dots.PERIOD / 20:
-			self.channel.set_mask(value, dots_mask, pos)
-			pos += 1000
+	def fade_step(self, phase):
+		self.dots.phase = phase
+		self.dots.render_phase()
 
-		value = (1 << dot_top)
-		while pos < 3 * Dots.PERIOD / 40:
-			self.channel.set_mask(value, dots_mask, pos)
-			pos += 1000
 
-		value = (1 << dot_bot)
-		while pos < Dots.PERIOD / 10:
-			self.channel.set_mask(value, dots_mask, pos)
-			pos += 1000
+# Dots on a 10ms channel holding a single marker: the pattern is played as its phases, each a frame
+# of a couple of slots committed on time by the fader thread. A hundredth of the DMA memory of Dots
+# and no startup walk of a second long buffer; the DMA reads the same number of slots per second.
+class CompactDots(Dots):
+	PERIOD = 10000
+	CACHE_SIZE = 64
+	# Milliseconds, breathing gets sampled to 20 phases a second
+	SHORTEST_PHASE = 50
+	def __init__(self, pwm = None, fader = None, cache_size = CACHE_SIZE):
+		self.dot_length = Dots.DOT_LENGTH
+		self.brightness = 100
+		self.pattern = dot_patterns["on"]
+		self.fader = fader
+		self.cache = FrameCache(cache_size, compile_dots)
+		self.channel = DMAChannel(channel = dots_channel, period = CompactDots.PERIOD, gpios = (dot_top, dot_bot), pwm = pwm)
+		self.timer = PhaseTimer(self)
+		self.played = None
+		self.phases = []
+		self.phase = 0
+		self.state = None
+		self.render()
+
+	def reset(self):
+		if self.fader:
+			self.fader.cancel(self.timer)
+		self.channel.reset()
+		self.played = None
+		self.state = None
+
+	def report(self):
+		report = Dots.report(self)
+		report["phases"] = len(self.phases)
+		return report
+
+	def prepare(self):
+		for pattern in dot_patterns.values():
+			for (marker, duration) in dot_phases(pattern, CompactDots.SHORTEST_PHASE):
+				self.cache.get(self.dot_length, (marker, ))
+
+	def render(self):
+		pattern = tuple(self.pattern)
+		if pattern != self.played:
+			self.played = pattern
+			self.phases = dot_phases(pattern, CompactDots.SHORTEST_PHASE)
+			self.phase = 0
+			self.loop()
+		return self.render_phase()
+
+	def render_phase(self):
+		state = (self.dot_length, (self.phases[self.phase][0], ))
+		if state == self.state:
+			return 0
+		self.state = state
+		return self.channel.commit(self.cache.get(*state))
+
+	def loop(self, start = None):
+		# Phase 0 is on now (or at monotonic time start), the fader steps through the others and comes back for the next second
+		if not self.fader:
+			return
+		if len(self.phases) < 2:
+			self.fader.cancel(self.timer)
+			return
+		if start == None:
+			start = monotonic()
+		schedule = []
+		offset = 0
+		for i in range(1, len(self.phases)):
+			offset += self.phases[i - 1][1]
+			schedule.append((offset, i))
+		schedule.append((offset + self.phases[-1][1], 0))
+		self.fader.play(self.timer, schedule, lambda: self.loop(start + schedule[-1][0]), start)
+
+	def fade(self, start, end, duration, easing = ease_in_out, done = None):
+		# Phase frames are a couple of slots, compiling them on the way is cheap
+		if start == None:
+			start = self.brightness
+		self.fader.play(self, fade_schedule(start, end, duration, easing), done)
 
 
 class Tube:
-	TUBE_LENGTH = 170
-	DIGIT_LENGTH = 240
-	def __init__(self, channel, tube = 0, offset = 0):
+	def __init__(self, channel, tube = 0, offset = 0, layout = default_layout):
 		self.start = offset
-		self.tube_length = Tube.TUBE_LENGTH
+		self.layout = layout
+		self.lead = layout.lead
+		self.tube_length = layout.tube_length
 		self.channel = channel
 		self.dual_pos = -1
 		# Digits
 		channel.set_on(self.start)
 
-		channel.assign(digit_gpios, self.start + self.DIGIT_LENGTH)
-		channel.set_off(self.start + self.DIGIT_LENGTH)
+		channel.assign(digit_gpios, self.start + layout.digit_length)
+		channel.set_off(self.start + layout.digit_length)
 
 		# Tubes
-		channel.set_mask(tube_sets[tube], tube_mask, self.start + 1)
-		channel.set_on(self.start + 1)
+		channel.set_mask(layout.tube_sets[tube], tube_mask, self.start + self.lead)
+		channel.set_on(self.start + self.lead)
 
-		channel.set_mask(tube_mask, tube_mask, self.start + 1 + self.tube_length)
-		channel.set_off(self.start + 1 + self.tube_length)
+		channel.set_mask(tube_mask, tube_mask, self.start + self.lead + self.tube_length)
+		channel.set_off(self.start + self.lead + self.tube_length)
 
 	def set_digit(self, digit = 0):
 		self.clear_dual()
@@ -202,21 +764,21 @@ class Tube:
 
 	def blank(self):
 		# TODO: implement set_none and use it rather than clearing the GPIOs, since they should already be clear
-		self.channel.set_off(self.start + 1)
+		self.channel.set_off(self.start + self.lead)
 
 	def unblank(self):
-		self.channel.set_on(self.start + 1)
+		self.channel.set_on(self.start + self.lead)
 
 	def set_brightness(self, percentage):
-		tube_length = (min(max(percentage, 0), 100) * Tube.TUBE_LENGTH) / 100
+		tube_length = (min(max(percentage, 0), 100) * self.layout.tube_length) / 100
 		tube_length = max(tube_length, 1)
 
 		if tube_length != self.tube_length:
-			self.channel.set_mask(tube_mask, tube_mask, self.start + 1 + tube_length)
-			self.channel.set_off(self.start + 1 + tube_length)
+			self.channel.set_mask(tube_mask, tube_mask, self.start + self.lead + tube_length)
+			self.channel.set_off(self.start + self.lead + tube_length)
 
-			self.channel.set_mask(0, tube_mask, self.start + 1 + self.tube_length)
-			self.channel.set_off(self.start + 1 + self.tube_length) #TODO implement set_none
+			self.channel.set_mask(0, tube_mask, self.start + self.lead + self.tube_length)
+			self.channel.set_off(self.start + self.lead + self.tube_length) #TODO implement set_none
 
 			self.tube_length = tube_length
 
@@ -242,165 +804,644 @@ class Tube:
 			self.dual_pos = -1
 
 
+# Frame compilers: build the complete buffer image of a channel from the state to display
+
+def compile_display(digits, blanked = 0, brightness = 100, duals = None, layout = default_layout):
+	# digits: one digit per tube, blanked: bit i set blanks tube i,
+	# duals: per tube None or (second digit, percentage of the tube length showing the first one)
+	frame = Frame()
+	duals = duals or [None] * len(digits)
+	for i in range(0, len(digits)):
+		tube = Tube(frame, i, i * layout.stride, layout)
+		tube.set_brightness(brightness)
+		if duals[i] != None:
+			tube.set_dual(digits[i], duals[i][0], duals[i][1])
+		else:
+			tube.set_digit(digits[i])
+		if blanked & (1 << i):
+			tube.blank()
+	return frame
+
+def compile_dots(dot_length, pattern):
+	# pattern: dots to light (as a GPIO set, or GPIO set and percentage of dot_length) for each of the Dots.MARKERS periods
+	frame = Frame()
+	position = 0
+	for value in pattern:
+		length = dot_length
+		if isinstance(value, tuple):
+			value, percentage = value
+			length = max((dot_length * percentage) / 100, 1)
+		frame.set_mask(value, dots_mask, position)
+		frame.set_on(position)
+		frame.assign((dot_top, dot_bot), position + length)
+		frame.set_off(position + length)
+		position += Dots.INTERVAL
+	return frame
+
+
+def compile_sweep(brightness = 100, layout = default_layout):
+	# Slot machine over a CathodeCycler.period(layout) buffer: every tube rolls through the ten cathodes,
+	# each one held for CathodeCycler.STEP, refreshed with the same tube windows as the display
+	frame = Frame()
+	refreshes = CathodeCycler.STEP / layout.period
+	for step in range(0, 10):
+		for refresh in range(0, refreshes):
+			base = (step * refreshes + refresh) * layout.slots
+			for i in range(0, layout.tubes):
+				tube = Tube(frame, i, base + i * layout.stride, layout)
+				tube.set_brightness(brightness)
+				tube.set_digit((step + i) % 10)
+	return frame
+
+
+# Bounded LRU cache of compiled frames, keyed by the arguments of the compiler.
+# The clock keeps coming back to the same states (minutes, volume, brightness, stations),
+# a hit returns the frame compiled the first time. A frame is a couple of KB, size 0 disables the cache.
+class FrameCache:
+	def __init__(self, size = 256, compiler = compile_display):
+		self.size = size
+		self.compiler = compiler
+		self.frames = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, *state):
+		if state in self.frames:
+			frame = self.frames.pop(state)
+			self.hits += 1
+		else:
+			self.misses += 1
+			frame = self.compiler(*state)
+			if self.size <= 0:
+				return frame
+			if len(self.frames) >= self.size:
+				self.frames.popitem(last = False)
+				self.evictions += 1
+		self.frames[state] = frame
+		return frame
+
+	def clear(self):
+		self.frames.clear()
+
+	def stats(self):
+		return { "size": self.size, "frames": len(self.frames), "hits": self.hits, "misses": self.misses, "evictions": self.evictions }
+
+
 class Display:
-	PERIOD = 10000
-	STRIDE = 250
-	def __init__(self):
-		self.channel = DMAChannel(channel = nixie_channel, period = Display.PERIOD, gpios = tube_gpios + digit_gpios)
-		self.tubes = []
-		for i in range(0,4):
-			self.tubes.append(Tube(self.channel, i, i * Display.STRIDE))
+	CACHE_SIZE = 256
+	def __init__(self, pwm = None, double_buffered = True, cache_size = CACHE_SIZE, fader = None, layout = default_layout):
+		self.layout = layout
+		self.tubes = layout.tubes
+		self.cache = FrameCache(cache_size, self.compile)
+		self.fader = fader
+		self.channel = DMAChannel(channel = nixie_channel, period = layout.period, gpios = tube_gpios + digit_gpios, pwm = pwm,
+			double_buffered = double_buffered, gate_mask = tube_mask, window = layout.stride)
+		self.digits = [0] * self.tubes
+		self.blanked = 0
+		self.brightness = 100
+		self.duals = [None] * self.tubes
+		# Per tube (digit, blanked, dual, brightness) last written to the channel
+		self.committed = [None] * self.tubes
+		self.applied = 0
+		self.skipped = 0
+		self.suspended = False
+		self.render()
+
+	def compile(self, digits, blanked, brightness, duals):
+		return compile_display(digits, blanked, brightness, duals, self.layout)
+
+	def tube_state(self, tube):
+		return (self.digits[tube], bool(self.blanked & (1 << tube)), self.duals[tube], self.brightness)
+
+	def render(self):
+		if self.suspended:
+			return 0
+		# Only tubes whose state changed have slots to rewrite, when none did the frame is not even looked up
+		states = [self.tube_state(i) for i in range(0, self.tubes)]
+		dirty = len([i for i in range(0, self.tubes) if states[i] != self.committed[i]])
+		self.applied += dirty
+		self.skipped += self.tubes - dirty
+		if not dirty:
+			return 0
+
+		self.committed = states
+		frame = self.cache.get(tuple(self.digits), self.blanked, self.brightness, tuple(self.duals))
+		tracing.latency.mark("render")
+		writes = self.channel.commit(frame)
+		tracing.latency.mark("dma")
+		return writes
+
+	def stats(self):
+		return { "tubes_applied": self.applied, "tubes_skipped": self.skipped, "writes": self.channel.writes, "waits": self.channel.waits,
+			"waited": self.channel.waited, "cache": self.cache.stats() }
+
+	def show(self, digits, blanked = 0, duals = None):
+		self.digits = list(digits)
+		self.blanked = blanked
+		self.duals = list(duals) if duals else [None] * self.tubes
+		return self.render()
 
 	def set_brightness(self, brightness):
-		for i in range(0,4):
-			self.tubes[i].set_brightness(brightness)
+		if self.fader:
+			self.fader.cancel(self)
+		self.fade_step(brightness)
+
+	def fade_step(self, brightness):
+		self.brightness = brightness
+		self.render()
+
+	def fade(self, start, end, duration, easing = ease_in_out, done = None):
+		if start == None:
+			start = self.brightness
+		schedule = fade_schedule(start, end, duration, easing)
+		# Every intermediate frame is compiled now, the fader thread only gets cache hits
+		for (offset, brightness) in schedule:
+			self.cache.get(tuple(self.digits), self.blanked, brightness, tuple(self.duals))
+		self.fader.play(self, schedule, done)
 
 	def set_tube(self, tube = 0, digit = 0):
-		self.tubes[tube].set_digit(digit)
+		self.digits[tube] = digit
+		self.duals[tube] = None
+		self.render()
+
+	def set_dual(self, tube, i, j, percentage):
+		self.digits[tube] = i
+		self.duals[tube] = (j, percentage)
+		self.render()
 
 	def blank_tube(self, tube):
-		self.tubes[tube].blank()
+		self.blanked |= 1 << tube
+		self.render()
 
 	def unblank_tube(self, tube):
-		self.tubes[tube].unblank()
-
-
+		self.blanked &= ~(1 << tube)
+		self.render()
+
+	def suspend(self):
+		# Hand the tubes over to another channel: the buffer is emptied, state changes are kept for resume()
+		self.suspended = True
+		self.committed = [None] * self.tubes
+		return self.channel.commit(Frame())
+
+	def resume(self):
+		self.suspended = False
+		return self.render()
+
+
+# Cathode poisoning: a cathode that stays off for months gets covered and does not glow anymore.
+# The whole sweep sits in the buffer of its own DMA channel, so playing it costs no Python work
+# per step: only starting (one commit of the sweep, the display channel emptied) and stopping
+# (sweep channel emptied, the display restored to its current state).
+# Sweeps start DELAY seconds after a minute rollover and stop before the next one.
+class CathodeCycler:
+	STEP = 50000
+	DELAY = 1
+	def __init__(self, display, pwm = None, every = 3600, duration = 10, hour = None):
+		# every: seconds between sweeps, whole minutes aligned on midnight (3600: every hour on the hour)
+		# hour: sweep once a day at that hour instead
+		CathodeCycler.check(every, hour)
+		self.display = display
+		self.every = every
+		self.hour = hour
+		self.duration = min(duration, 60 - 2 * CathodeCycler.DELAY)
+		self.channel = DMAChannel(channel = poison_channel, period = CathodeCycler.period(display.layout), gpios = tube_gpios + digit_gpios, pwm = pwm)
+		self.sweep = None
+		self.running = False
+		self.runs = 0
+		self.next = self.next_start(time())
+		self.stop_at = None
+
+	@staticmethod
+	def check(every, hour):
+		# A sweep starts DELAY after a minute rollover and ends before the next one, the display suspended
+		if hour == None and (every < 60 or every % 60):
+			raise ValueError("sweeps every %ss would straddle a minute rollover, use whole minutes" % every)
+		if hour != None and not 0 <= hour < 24:
+			raise ValueError("no hour %s in a day" % hour)
+
+	@staticmethod
+	def period(layout):
+		# Ten steps of whole display refreshes
+		return 10 * (CathodeCycler.STEP / layout.period) * layout.period
+
+	def next_start(self, now):
+		current_time = localtime(now)
+		midnight = int(now) - (current_time.tm_hour * 3600 + current_time.tm_min * 60 + current_time.tm_sec)
+		if self.hour != None:
+			start = midnight + self.hour * 3600 + CathodeCycler.DELAY
+			period = 86400
+		else:
+			start = midnight + CathodeCycler.DELAY
+			period = self.every
+		while start <= now:
+			start += period
+		return start
+
+	def window(self, now):
+		# Seconds into the minute, and the time the sweep has to be over by: DELAY before the next rollover
+		second = localtime(now).tm_sec + now - int(now)
+		return second, now - second + 60 - CathodeCycler.DELAY
+
+	def start(self, now, end):
+		brightness = self.display.brightness
+		if self.sweep == None or self.sweep[0] != brightness:
+			self.sweep = (brightness, compile_sweep(brightness, self.display.layout))
+		self.display.suspend()
+		self.channel.commit(self.sweep[1])
+		self.running = True
+		self.runs += 1
+		self.stop_at = min(now + self.duration, end)
+
+	def stop(self, now):
+		self.channel.commit(Frame())
+		self.display.resume()
+		self.running = False
+		self.next = self.next_start(now)
+
+	def poll(self, now, idle = True):
+		# Starts or stops the sweep when due, returns the seconds until it has to be polled again.
+		# Not idle (user showing something, or tubes blanked): the sweep is stopped or skipped.
+		if self.running and (now >= self.stop_at or not idle):
+			self.stop(now)
+		elif not self.running and now >= self.next:
+			# Polled late, or the wall clock stepped: never within DELAY of a rollover, cut short before the next one
+			second, end = self.window(now)
+			if idle and second >= CathodeCycler.DELAY and end > now:
+				self.start(now, end)
+			else:
+				self.next = self.next_start(now)
+		if self.running:
+			return self.stop_at - now
+		return self.next - now
+
+
+# Wall clock boundaries (every second or minute) turned into monotonic deadlines: waits are not
+# stretched or shortened by NTP steps, and a step is noticed as a change of the wall - monotonic offset.
+class ClockSchedule:
+	# Clock steps bigger than this are jumps
+	JUMP = 0.5
+	def __init__(self, unit = 60):
+		self.unit = unit
+		self.offset = time() - monotonic()
+		# Wall clock time of the next boundary and its monotonic deadline
+		self.boundary = None
+		self.deadline = None
+		self.jumps = 0
+		self.lateness = Histogram()
+
+	def jumped(self):
+		offset = time() - monotonic()
+		if abs(offset - self.offset) > ClockSchedule.JUMP:
+			self.offset = offset
+			self.jumps += 1
+			self.boundary = None
+			return True
+		return False
+
+	def rolled_over(self, now):
+		# To call once what has to show at wall clock time now is displayed
+		if self.boundary != None and now >= self.boundary:
+			self.lateness.add(now - self.boundary)
+
+	def plan(self, now):
+		# Next boundary after wall clock time now, returns the seconds until it
+		if self.boundary == None or now >= self.boundary:
+			self.boundary = (int(now) / self.unit + 1) * self.unit
+			self.deadline = monotonic() + self.boundary - now
+		elif monotonic() >= self.deadline:
+			# Due, but the wall clock is still short of the boundary (drift, a slew below JUMP): what it lacks
+			self.deadline = monotonic() + self.boundary - now
+		return max(self.deadline - monotonic(), 0)
+
+	def stats(self):
+		return { "unit": self.unit, "jumps": self.jumps, "lateness": self.lateness.stats() }
+
+
+# All changes to the display go through the display thread: the other threads post commands, the
+# thread applies them and is the only one writing the DMA channels. A command replaces the pending one
+# of the same kind, so a burst of wheel steps renders only the last number.
 class DisplayThread(threading.Thread):
-	def __init__(self):
+	# Seconds from process start to the time showing on the tubes
+	STARTUP_BUDGET = 2.0
+	# Event.wait() polls on Python 2: wake up that much before a deadline and sleep the rest
+	WAKE_MARGIN = 0.06
+	def __init__(self, pwm = None, layout = default_layout, compact_dots = False):
+		# compact_dots: CompactDots instead of Dots
 		threading.Thread.__init__(self, name = "nixie")
 		self.daemon = True
+		if layout.tubes < 4:
+			raise ValueError("the clock needs at least 4 tubes, layout has %d" % layout.tubes)
+		self.tubes = layout.tubes
+
+		# kind -> (handler, args) still to apply, in posting order
+		self.commands = OrderedDict()
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.posted = 0
+		self.coalesced = 0
+		self.applied = 0
+		self.max_depth = 0
+
+		self.startup = []
+		step = time()
+		self.pwm = pwm or PWM
+		self.pwm.setup(pulse_incr_us=layout.pulse_incr_us)
+		self.startup.append(("PWM.setup", time() - step))
+
+		self.fader = Fader(self.post_fade_step)
+		self.fader.start()
+
+		# Show the time right away, the dots can come afterwards
+		step = time()
+		self.seconds = False
+		self.schedule = ClockSchedule(60)
+		self.display = Display(pwm = self.pwm, fader = self.fader, layout = layout)
+		self.display_time(localtime())
+		self.startup.append(("Display()", time() - step))
+		self.time_on_tubes = time() - startup_time
 
-		PWM.setup(pulse_incr_us=10)
-
-		self.display = Display()
 		self.blanked = False
 		self.custom = False
-		self.custom_tubes = [ 0, 0, 0, 0 ]
-		self.custom_event = threading.Event()
-
-		self.dots = Dots()
+		# Digits the time mode showed last, None to redraw
+		self.shown = None
+		self.custom_tubes = [0] * self.tubes
+		self.cycler = None
+		# Brightness to get back to once a fade out has blanked the tubes
+		self.unfaded = None
+
+		step = time()
+		self.dots = (CompactDots if compact_dots else Dots)(pwm = self.pwm, fader = self.fader)
+		self.startup.append(("Dots()", time() - step))
+		step = time()
+		self.dots.prepare()
+		self.startup.append(("Dots.prepare()", time() - step))
+		tracing.info("startup", "dots: %(engine)s, %(slots)d slots, %(memory)d bytes of DMA memory" % self.dots.report())
+		tracing.info("startup", self.startup_report())
+
+	def startup_report(self):
+		steps = ["%s %.1fms" % (name, duration * 1000) for (name, duration) in self.startup]
+		report = "startup: %s, time on tubes %.3fs" % (", ".join(steps), self.time_on_tubes)
+		if self.time_on_tubes > DisplayThread.STARTUP_BUDGET:
+			report += " over the %.1fs budget" % DisplayThread.STARTUP_BUDGET
+		return report
+
+	def time_digits(self, current_time):
+		# HHMM on the first four tubes, any other tube blanked.
+		# Seconds mode: HHMMSS with 6 tubes or more, MMSS otherwise.
+		hour = [current_time.tm_hour / 10, current_time.tm_hour % 10]
+		minute = [current_time.tm_min / 10, current_time.tm_min % 10]
+		second = [current_time.tm_sec / 10, current_time.tm_sec % 10]
+		blanked = 0
+		if not self.seconds:
+			digits = hour + minute
+			if current_time.tm_hour < 10:
+				blanked |= 1
+		elif self.tubes >= 6:
+			digits = hour + minute + second
+			if current_time.tm_hour < 10:
+				blanked |= 1
+		else:
+			digits = minute + second
+		blanked |= ((1 << self.tubes) - 1) & ~((1 << len(digits)) - 1)
+		digits += [0] * (self.tubes - len(digits))
+		return (digits, blanked)
+
+	def display_time(self, current_time):
+		digits, blanked = self.time_digits(current_time)
+		self.display.show(digits, blanked)
+
+	# Command queue
+
+	def post(self, kind, handler, *args):
+		# The command carries the latency stamps of the inputs it comes from, and of those it replaces
+		stamps = tracing.latency.current()
+		with self.lock:
+			if kind in self.commands:
+				stamps = self.commands.pop(kind)[2] + stamps
+				self.coalesced += 1
+			self.commands[kind] = (handler, args, stamps)
+			self.posted += 1
+			self.max_depth = max(self.max_depth, len(self.commands))
+		self.wakeup.set()
+
+	def post_fade_step(self, target, generation, deadline, brightness, done):
+		self.post(("fade step", target), self.fader.step, target, generation, deadline, brightness, done)
+
+	def apply_commands(self):
+		with self.lock:
+			commands = self.commands.values()
+			self.commands = OrderedDict()
+		stamps = []
+		for (handler, args, command_stamps) in commands:
+			stamps += command_stamps
+		tracing.latency.adopt(stamps)
+		tracing.latency.mark("display")
+		for (handler, args, command_stamps) in commands:
+			handler(*args)
+		self.applied += len(commands)
+
+	def depth(self):
+		with self.lock:
+			return len(self.commands)
+
+	def stats(self):
+		return { "depth": self.depth(), "max_depth": self.max_depth, "posted": self.posted,
+			"coalesced": self.coalesced, "applied": self.applied, "clock": self.schedule.stats() }
 
 
 	def run(self):
-		current_time = localtime()
-		previous_time = localtime(0)
-		event = False
-
 		while True:
-			timeout = None
-			if self.custom:
-				print("custom")
-				previous_time = localtime(0)
-
-				if self.custom_tubes[0] == -1:
-					self.display.blank_tube(0)
-				elif self.custom_tubes[0] == 18:
-					self.display.unblank_tube(0)
-					self.display.tubes[0].set_dual(1, 8, 50)
-				else:
-					self.display.unblank_tube(0)
-					self.display.set_tube(0, self.custom_tubes[0])
+			timeout = self.update()
 
-				if self.custom_tubes[1] == -1:
-					self.display.blank_tube(1)
-				else:
-					self.display.unblank_tube(1)
-					self.display.set_tube(1, self.custom_tubes[1])
+			tracing.debug("timeout", "timeout %s", timeout)
+			self.wait(timeout)
 
-				if self.custom_tubes[2] == -1:
-					self.display.blank_tube(2)
+	def wait(self, timeout):
+		# Until a command is posted or timeout seconds have passed
+		if timeout == None:
+			self.wakeup.wait()
+		else:
+			deadline = monotonic() + timeout
+			if timeout <= DisplayThread.WAKE_MARGIN or not self.wakeup.wait(timeout - DisplayThread.WAKE_MARGIN):
+				sleep(max(deadline - monotonic(), 0))
+		# Commands posted after the wake up stay queued, the next update() applies them
+		self.wakeup.clear()
+
+	def update(self):
+		# Applies the pending commands and renders what has to be shown,
+		# returns the seconds until the next update is due (None: only on a command)
+		self.apply_commands()
+
+		timeout = None
+		if self.custom:
+			tracing.debug("mode", "custom")
+			self.shown = None
+
+			# Blanked tubes keep their digit, so that unblanking alone does not rewrite it
+			digits = list(self.display.digits)
+			blanked = 0
+			duals = [None] * self.tubes
+			for i in range(0, self.tubes):
+				if self.custom_tubes[i] == -1:
+					blanked |= 1 << i
+				elif self.custom_tubes[i] == 18:
+					digits[i] = 1
+					duals[i] = (8, 50)
 				else:
-					self.display.unblank_tube(2)
-					self.display.set_tube(2, self.custom_tubes[2])
+					digits[i] = self.custom_tubes[i]
+			self.display.show(digits, blanked, duals)
 
-				if self.custom_tubes[3] == -1:
-					self.display.blank_tube(3)
-				else:
-					self.display.unblank_tube(3)
-					self.display.set_tube(3, self.custom_tubes[3])
+		elif self.blanked:
+			tracing.debug("mode", "blanked")
+			self.shown = None
 
-			elif self.blanked:
-				print("blanked")
-				previous_time = localtime(0)
+			self.display.show(self.display.digits, (1 << self.tubes) - 1, self.display.duals)
 
-				self.display.blank_tube(0)
-				self.display.blank_tube(1)
-				self.display.blank_tube(2)
-				self.display.blank_tube(3)
+		else:
+			tracing.debug("mode", "time")
+			# A clock step redraws at once and starts a new schedule, it is not a late rollover
+			if self.schedule.jumped():
+				self.shown = None
+			now = time()
+			digits, blanked = self.time_digits(localtime(now))
+			if (digits, blanked) != self.shown:
+				self.display.show(digits, blanked)
+				if self.shown != None:
+					self.schedule.rolled_over(now)
+				self.shown = (digits, blanked)
+
+			timeout = self.schedule.plan(now)
+
+		if self.cycler:
+			delay = self.cycler.poll(time(), not self.custom and not self.blanked)
+			# A wake up for the cycler must not end custom mode
+			if not self.custom and (timeout == None or delay < timeout):
+				timeout = delay
+
+		tracing.latency.finish()
+		return timeout
+
+	# Commands, callable from any thread
+
+	def schedule_cathode_cycling(self, every = 3600, duration = 10, hour = None):
+		# Checked here, the display thread must not die of it
+		CathodeCycler.check(every, hour)
+		self.post("cycling", self.apply_cathode_cycling, every, duration, hour)
 
-			else:
-				print("time")
-				current_time = localtime()
-				if current_time.tm_hour != previous_time.tm_hour or current_time.tm_min != previous_time.tm_min:
+	def display_number(self, number = 0):
+		# Number and time share a kind: the latest of them is what shows
+		self.post("mode", self.apply_number, number)
 
-					if current_time.tm_hour >= 10:
-						self.display.unblank_tube(0)
-						self.display.set_tube(0, current_time.tm_hour / 10)
-					else:
-						self.display.blank_tube(0)
+	def display_brightness(self, brightness):
+		self.display_number(brightness)
 
-					self.display.unblank_tube(1)
-					self.display.set_tube(1, current_time.tm_hour % 10)
+	def show_time(self):
+		self.post("mode", self.apply_show_time)
 
-					self.display.unblank_tube(2)
-					self.display.set_tube(2, current_time.tm_min / 10)
+	def show_seconds(self, seconds = True):
+		# Time mode with the seconds, updated on every second
+		self.post("seconds", self.apply_seconds, seconds)
 
-					self.display.unblank_tube(3)
-					self.display.set_tube(3, current_time.tm_min % 10)
+	def blank(self, fade = 0):
+		# fade: seconds to fade the tubes out before blanking them, if they are lit
+		self.post("blank", self.apply_blank, fade)
 
-				previous_time = current_time
-				timeout = 60 - current_time.tm_sec
+	def unblank(self, fade = 0):
+		# fade: seconds to fade the tubes in from 0 to their brightness
+		self.post("blank", self.apply_unblank, fade)
 
-			print("timeout %s" % timeout)
-			event = self.custom_event.wait(timeout)
-			if not event:
-				self.custom = False	 # There is a race condition here
-			self.custom_event.clear()
+	def set_brightness(self, brightness):
+		self.post("brightness", self.display.set_brightness, brightness)
 
+	def set_dots_brightness(self, brightness):
+		self.post("dots brightness", self.dots.set_brightness, brightness)
 
-	def display_number(self, number = 0):
+	def fade(self, end, duration):
+		# Tubes and dots from their brightness to end
+		self.post("fade", self.apply_fade, end, duration)
+
+	def dots_steady(self, val, top, bot):
+		# Both dots replace the whole pattern, one dot only its own half of it
+		kind = "dots" if top and bot else ("dots", top, bot)
+		self.post(kind, self.dots.steady, val, top, bot)
+
+	def dots_altern(self):
+		self.post("dots", self.dots.altern)
+
+	def dots_pattern(self, name):
+		# One of dot_patterns
+		self.post("dots", self.dots.show, name)
+
+	# Command handlers, run by the display thread
+
+	def apply_cathode_cycling(self, every, duration, hour):
+		if self.cycler == None:
+			self.cycler = CathodeCycler(self.display, self.pwm, every, duration, hour)
+		else:
+			self.cycler.every = every
+			self.cycler.duration = min(duration, 60 - 2 * CathodeCycler.DELAY)
+			self.cycler.hour = hour
+			self.cycler.next = self.cycler.next_start(time())
+
+	def apply_number(self, number):
+		# Right aligned without leading zeros, from 10000 on the first tube shows the 1/8 station mark
+		first = 0
 		if number >= 10000:
 			self.custom_tubes[0] = 18
 			number -= 10000
-		elif number >= 1000:
-			self.custom_tubes[0] = number / 1000
-		else:
-			self.custom_tubes[0] = -1
+			first = 1
 
-		if number >= 100:
-			self.custom_tubes[1] = (number % 1000) / 100
-		else:
-			self.custom_tubes[1] = -1
+		for i in reversed(range(first, self.tubes)):
+			if number > 0 or i == self.tubes - 1:
+				self.custom_tubes[i] = number % 10
+			else:
+				self.custom_tubes[i] = -1
+			number /= 10
 
-		if number >= 10:
-			self.custom_tubes[2] = (number % 100) / 10
-		else:
-			self.custom_tubes[2] = -1
+		self.custom = True
 
-		self.custom_tubes[3] = number % 10
+	def apply_show_time(self):
+		self.custom = False
 
-		self.custom = True
-		self.custom_event.set()
+	def apply_seconds(self, seconds):
+		self.seconds = seconds
+		self.schedule = ClockSchedule(1 if seconds else 60)
+		self.shown = None
 
-	def display_brightness(self, brightness):
-		self.display_number(brightness)
+	def apply_blank(self, fade = 0):
+		if fade and (self.custom or not self.blanked):
+			if not self.fader.playing(self.display) or self.unfaded == None:
+				self.unfaded = self.display.brightness
+				self.display.fade(None, 0, fade, ease_in, self.faded_out)
+			return
 
-	def blank(self):
 		self.blanked = True
 		self.custom = False
 
-		self.custom_event.set()
+	def faded_out(self):
+		self.display.show(self.display.digits, (1 << self.tubes) - 1, self.display.duals)
+		self.display.fade_step(self.unfaded)
+		self.unfaded = None
+		self.apply_blank()
+
+	def apply_unblank(self, fade = 0):
+		if fade:
+			if self.unfaded != None:
+				brightness = self.unfaded
+				self.unfaded = None
+			else:
+				brightness = self.display.brightness
+			if self.blanked:
+				self.display.fade_step(0)
+			self.display.fade(None, brightness, fade, ease_out)
 
-	def unblank(self):
 		self.blanked = False
 		self.custom = False
 
-		self.custom_event.set()
-
-	def show_time(self):
-		self.custom = False
-
-		self.custom_event.set()
+	def apply_fade(self, end, duration):
+		self.display.fade(None, end, duration)
+		self.dots.fade(None, end, duration)
 
 if __name__ == "__main__":
 	try:
@@ -0,0 +1,688 @@
+"""
+GStreamer player keeping the stations likely to be played next pre-rolled.
+
+Every source gets its own pipeline (a playbin for a URI). The ones handed to prepare()
+stand by in PAUSED, connected and buffered, and play() of one of them only takes it to
+PLAYING and pauses the one that was playing. A source that is not standing by starts
+cold. The latency from play() to the first audio buffer is recorded, for warm and cold
+starts apart:
+
+	pool = PlayerPool(size = 3)
+	pool.play(stations[4].url, 50)
+	pool.prepare([stations[3].url, stations[5].url])
+
+With a timeshift directory, network streams play through a Ring on tmpfs
+(timeshift.py), some way behind what is received: the ring plays on through short
+outages while the stream reconnects, and pause() of live radio, like switching back to
+a station left, goes on where it was. A stream started cold first waits for a couple
+of seconds in its ring: until it has that lead, an outage falls back as for any stream.
+
+The bus of every stream is watched without a GLib main loop, from the threads posting
+the messages: errors, ends of stream, buffering, bitrate and underruns go to the
+stream_health.Health of the station. A stream pauses while it buffers and plays again once
+its buffer is full, it is only out (an underrun) after STALL seconds paused or without a
+buffer going out. A thread of the pool reconnects the stream playing once it broke,
+after a jittered backoff, and hands it to the failover callback when it is still out
+failover seconds later.
+
+A source that is not a URI is a pipeline description, to test without a network:
+
+	python player.py file:///home/yannick/Music/a.mp3 "audiotestsrc freq=440"
+	python player.py --standin a.mp3    # through an HTTP stand-in dropping its connections
+"""
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+from time import sleep, time
+
+from gi import require_version
+require_version('Gst', '1.0')
+from gi.repository import GObject, Gst
+
+import tracing
+from tracing import Histogram, monotonic
+from timeshift import Ring
+from stream_health import Health, StandInServer, backoff
+
+
+class Stream(object):
+	# One pipeline: playing, or standing by in PAUSED
+	# Seconds paused for buffering, or without a buffer going out, before it counts as out
+	STALL = 5
+
+	def __init__(self, source, buffer_size, health):
+		self.source = source
+		# StationHealth of the source
+		self.health = health
+		if Gst.uri_is_valid(source):
+			self.pipeline = Gst.ElementFactory.make("playbin", None)
+			self.pipeline.set_property("uri", source)
+			# Bytes buffered of a network stream
+			self.pipeline.set_property("buffer-size", buffer_size)
+			self.tap = Gst.ElementFactory.make("identity", None)
+			self.pipeline.set_property("audio-filter", self.tap)
+			self.volume = self.pipeline
+		else:
+			self.pipeline = Gst.parse_launch(source + " ! identity name=tap ! audioconvert ! volume name=volume ! autoaudiosink")
+			self.tap = self.pipeline.get_by_name("tap")
+			self.volume = self.pipeline.get_by_name("volume")
+		self.failed = False
+		# Monotonic time it was pre-rolled
+		self.since = None
+		# The first buffer went out, and the monotonic time the audio stopped since
+		self.heard = False
+		self.broken_since = None
+		# PLAYING is wanted, paused for buffering since that monotonic time, and the last buffer out
+		self.playing = False
+		self.buffering = False
+		self.stalled_at = None
+		self.flowed = None
+		self.tap.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.on_buffer)
+		# Without a GLib main loop, messages are handled in the thread posting them
+		bus = self.pipeline.get_bus()
+		bus.enable_sync_message_emission()
+		bus.connect("sync-message::error", self.on_error)
+		bus.connect("sync-message::eos", self.on_eos)
+		bus.connect("sync-message::buffering", self.on_buffering)
+		bus.connect("sync-message::tag", self.on_tag)
+
+	def on_error(self, bus, message):
+		error, debug = message.parse_error()
+		tracing.error("player", "%s: %s", self.source, error.message)
+		self.failed = True
+		self.health.error()
+		self.broke()
+
+	def on_eos(self, bus, message):
+		tracing.warning("player", "%s: end of stream", self.source)
+		self.failed = True
+		self.health.ended()
+		self.broke()
+
+	def on_buffering(self, bus, message):
+		# Paused below 100%, playing again at 100%: only a stall longer than STALL is an outage, see broken()
+		percent = message.parse_buffering()
+		self.health.buffering = percent
+		if percent < 100 and not self.buffering:
+			self.buffering = True
+			if self.playing:
+				self.stalled_at = monotonic()
+				self.change_state(Gst.State.PAUSED)
+		elif percent == 100 and self.buffering:
+			self.buffering = False
+			self.stalled_at = None
+			if not self.failed:
+				self.broken_since = None
+			if self.playing:
+				self.flowed = monotonic()
+				self.change_state(Gst.State.PLAYING)
+
+	def change_state(self, state):
+		# From a streaming thread, which the state change would wait for: a thread of GStreamer does it
+		self.pipeline.call_async(lambda element, state: element.set_state(state), state)
+
+	def on_buffer(self, pad, info):
+		self.flowed = monotonic()
+		if self.broken_since != None and not self.failed and not self.buffering:
+			self.broken_since = None
+		return Gst.PadProbeReturn.OK
+
+	def on_tag(self, bus, message):
+		found, bitrate = message.parse_tag().get_uint("bitrate")
+		if found:
+			self.health.bitrate = bitrate
+
+	def broke(self):
+		if self.broken_since == None:
+			self.broken_since = monotonic()
+
+	def broken(self):
+		# Monotonic time the audio stopped, None while it plays
+		if self.broken_since == None and self.playing:
+			stopped = self.stalled_at if self.buffering else self.flowed
+			if stopped != None and monotonic() - stopped >= Stream.STALL:
+				self.health.underrun()
+				self.broken_since = stopped
+		return self.broken_since
+
+	def usable(self, max_age):
+		# Standing by for longer, a network stream fell behind or was dropped by the server (None: any age)
+		return not self.failed and (max_age == None or monotonic() - self.since < max_age)
+
+	def preroll(self):
+		self.playing = False
+		self.pipeline.set_state(Gst.State.PAUSED)
+		self.since = monotonic()
+		self.heard = False
+
+	def flowing(self, timeout):
+		# Pre-rolled: data made it to the sink within timeout seconds
+		return not self.failed and self.pipeline.get_state(int(timeout * Gst.SECOND))[0] == Gst.StateChangeReturn.SUCCESS
+
+	def start(self, first_buffer):
+		# first_buffer() is called from the streaming thread with the next buffer going out
+		def probe(pad, info):
+			self.heard = True
+			self.health.started()
+			first_buffer()
+			return Gst.PadProbeReturn.REMOVE
+		self.tap.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, probe)
+		self.resume()
+		self.since = None
+
+	def pause(self):
+		self.playing = False
+		self.pipeline.set_state(Gst.State.PAUSED)
+
+	def resume(self):
+		# Still buffering, on_buffering() takes it to PLAYING
+		self.playing = True
+		self.flowed = monotonic()
+		if self.buffering:
+			self.stalled_at = monotonic()
+		else:
+			self.pipeline.set_state(Gst.State.PLAYING)
+
+	def healthy(self):
+		# playbin buffers on its own, only its errors tell
+		return False if self.failed else None
+
+	def set_volume(self, volume):
+		self.volume.set_property("volume", volume / 100.0)
+
+	def close(self):
+		self.pipeline.set_state(Gst.State.NULL)
+
+
+class TimeshiftStream(object):
+	"""
+	A network stream played through a Ring: a capture pipeline appends the bytes received,
+	the playback pipeline is fed from the ring by a thread of its own, LEAD bytes behind.
+	The feeder holds until the ring has MIN_LEAD bytes: a stream standing by long enough
+	starts LEAD behind, one started cold only MIN_LEAD behind. Standing by is capturing only,
+	the ring stays up to date. A capture that fails is started again after a backoff from
+	RETRY to RETRY_CAP seconds, the playback goes on as long as the ring lasts.
+	"""
+	# About 15s of a 128kbit/s stream, and 2s
+	LEAD = 256 * 1024
+	MIN_LEAD = 32 * 1024
+	CHUNK = 4096
+	RETRY = 2
+	RETRY_CAP = 30
+	# Seconds without bytes coming in before the stream is no proof of the network
+	QUIET = 5
+	# Seconds close() waits for the feeder to get out of the ring
+	JOIN = 1
+
+	def __init__(self, source, ring, health):
+		self.source = source
+		self.ring = ring
+		self.health = health
+		self.failed = False
+		self.failed_at = None
+		self.heard = False
+		self.since = None
+		self.closed = False
+		self.reconnecting = False
+		# Failed captures since bytes last came in
+		self.attempts = 0
+		# Monotonic time bytes last came in, and the capture was lost since
+		self.received = None
+		self.lost = None
+		# The feeder waits for MIN_LEAD
+		self.holding = True
+		self.capture = None
+		self.capture_lock = threading.Lock()
+		self.playback = Gst.parse_launch("appsrc name=ring format=bytes max-bytes=65536 block=true ! decodebin ! "
+			"identity name=tap ! audioconvert ! volume name=volume ! autoaudiosink")
+		self.appsrc = self.playback.get_by_name("ring")
+		self.tap = self.playback.get_by_name("tap")
+		self.volume = self.playback.get_by_name("volume")
+		bus = self.playback.get_bus()
+		bus.enable_sync_message_emission()
+		bus.connect("sync-message::error", self.on_playback_error)
+		bus.connect("sync-message::tag", self.on_tag)
+		self.feeder = None
+		self.connect()
+
+	def connect(self):
+		with self.capture_lock:
+			self.reconnecting = False
+			if self.closed:
+				return
+			if self.capture != None:
+				self.capture.set_state(Gst.State.NULL)
+			self.capture = Gst.parse_launch("souphttpsrc name=source iradio-mode=false ! appsink name=sink sync=false emit-signals=true")
+			self.capture.get_by_name("source").set_property("location", self.source)
+			self.capture.get_by_name("sink").connect("new-sample", self.on_sample)
+			bus = self.capture.get_bus()
+			bus.enable_sync_message_emission()
+			bus.connect("sync-message::error", self.on_capture_error)
+			bus.connect("sync-message::eos", self.on_capture_error)
+			self.capture.set_state(Gst.State.PLAYING)
+
+	def on_sample(self, sink):
+		# Streaming thread of the capture: only queues the bytes
+		buffer = sink.emit("pull-sample").get_buffer()
+		self.ring.append(buffer.extract_dup(0, buffer.get_size()))
+		self.received = monotonic()
+		self.lost = None
+		self.attempts = 0
+		return Gst.FlowReturn.OK
+
+	def on_capture_error(self, bus, message):
+		# An error, or the server closed the connection
+		if self.reconnecting:
+			return
+		self.reconnecting = True
+		if self.lost == None:
+			self.lost = monotonic()
+		if message.type == Gst.MessageType.EOS:
+			self.health.ended()
+		else:
+			self.health.error()
+		self.health.reconnects += 1
+		delay = backoff(self.attempts, TimeshiftStream.RETRY, TimeshiftStream.RETRY_CAP)
+		self.attempts += 1
+		tracing.warning("player", "%s: capture lost, again in %.1fs", self.source, delay)
+		timer = threading.Timer(delay, self.connect)
+		timer.daemon = True
+		timer.start()
+
+	def on_playback_error(self, bus, message):
+		error, debug = message.parse_error()
+		tracing.error("player", "%s: %s", self.source, error.message)
+		self.failed = True
+		self.failed_at = monotonic()
+		self.health.error()
+
+	def on_tag(self, bus, message):
+		found, bitrate = message.parse_tag().get_uint("bitrate")
+		if found:
+			self.health.bitrate = bitrate
+
+	def feed(self):
+		# Pushing blocks while the playback is paused and its queue full
+		while not self.closed and self.ring.written - self.ring.floor < TimeshiftStream.MIN_LEAD:
+			sleep(0.05)
+		self.ring.seek_live(TimeshiftStream.LEAD)
+		self.holding = False
+		underruns = self.ring.underruns
+		while not self.closed:
+			data = self.ring.read(TimeshiftStream.CHUNK)
+			if not data:
+				if self.ring.underruns != underruns:
+					underruns = self.ring.underruns
+					self.health.underrun()
+				sleep(0.05)
+				continue
+			if self.appsrc.emit("push-buffer", Gst.Buffer.new_wrapped(data)) == Gst.FlowReturn.FLUSHING:
+				return
+
+	def usable(self, max_age):
+		# Capturing, it never falls behind
+		return not self.failed
+
+	def preroll(self):
+		self.since = monotonic()
+		self.heard = False
+
+	def flowing(self, timeout):
+		# Bytes came in within timeout seconds
+		deadline = monotonic() + timeout
+		while not self.ring.written and not self.failed and monotonic() < deadline:
+			sleep(0.1)
+		return self.ring.written > 0 and not self.failed
+
+	def start(self, first_buffer):
+		def probe(pad, info):
+			self.heard = True
+			self.health.started()
+			first_buffer()
+			return Gst.PadProbeReturn.REMOVE
+		self.tap.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, probe)
+		if self.feeder == None:
+			self.feeder = threading.Thread(target = self.feed, name = "feeder")
+			self.feeder.daemon = True
+			self.feeder.start()
+		self.playback.set_state(Gst.State.PLAYING)
+		self.since = None
+
+	def broken(self):
+		# The ring ran dry, or never got to MIN_LEAD, while the capture is lost, or the playback failed
+		if self.failed:
+			return self.failed_at
+		if self.lost != None:
+			return self.lost if self.holding else self.ring.dry
+		return None
+
+	def lead(self):
+		# Bytes ahead of the playback, or captured while the feeder holds
+		return self.ring.written - (self.ring.floor if self.holding else self.ring.position)
+
+	def healthy(self):
+		# Bytes coming in prove the network, a capture lost disproves it
+		if self.failed or self.reconnecting:
+			return False
+		if self.received != None and monotonic() - self.received < TimeshiftStream.QUIET:
+			return True
+		return None
+
+	def pause(self):
+		self.playback.set_state(Gst.State.PAUSED)
+
+	def resume(self):
+		self.playback.set_state(Gst.State.PLAYING)
+
+	def set_volume(self, volume):
+		self.volume.set_property("volume", volume / 100.0)
+
+	def feeding(self):
+		return self.feeder != None and self.feeder.is_alive()
+
+	def close(self):
+		# Flushing the playback gets a push out of the appsrc, the feeder then sees closed
+		self.closed = True
+		self.playback.set_state(Gst.State.NULL)
+		with self.capture_lock:
+			self.capture.set_state(Gst.State.NULL)
+		if self.feeding():
+			self.feeder.join(TimeshiftStream.JOIN)
+
+
+class PlayerPool(object):
+	# Pipelines at most, the playing one included
+	SIZE = 3
+	# Bytes of network buffering, shared by the pipelines
+	BUDGET = 3 * 1024 * 1024
+	# Seconds a stream stands by: a stream not read falls behind, or the server drops it
+	MAX_AGE = 60
+	# Seconds the stream playing is out before the failover callback gets it
+	FAILOVER = 30
+	# Seconds between the checks of the stream playing, and the backoff of its reconnections
+	CHECK = 1
+	RETRY = 1
+	RETRY_CAP = 16
+
+	def __init__(self, size = SIZE, budget = BUDGET, max_age = MAX_AGE, timeshift_dir = None, timeshift_size = Ring.SIZE, failover = FAILOVER):
+		self.size = size
+		self.budget = budget
+		self.max_age = max_age
+		# Rings of the network streams, None: played directly
+		self.timeshift_dir = timeshift_dir
+		self.timeshift_size = timeshift_size
+		# Rings not in use, a ring file is created once, by the rings thread
+		self.rings = []
+		self.ring_count = 0
+		self.rings_wanted = size + 1
+		self.rings_event = threading.Event()
+		self.lock = threading.Lock()
+		# source -> Stream or TimeshiftStream standing by, oldest first
+		self.standby = OrderedDict()
+		self.active = None
+		self.volume = 0
+		self.warm = Histogram()
+		self.cold = Histogram()
+		# Source kept standing by until played, whatever prepare() says
+		self.armed = None
+		# Wall time the audio of the next play() is due, and how late it came
+		self.due = None
+		self.late = Histogram(Histogram.BOUNDS + (2.0, 5.0, 10.0))
+		self.health = Health()
+		self.failover = failover
+		self.failover_callback = None
+		# Monotonic time the source playing went out, reconnections tried since, and when the next one is
+		self.outage = None
+		self.attempts = 0
+		self.retry_at = None
+		thread = threading.Thread(target = self.supervise, name = "supervisor")
+		thread.daemon = True
+		thread.start()
+		if timeshift_dir != None:
+			thread = threading.Thread(target = self.make_rings, name = "rings")
+			thread.daemon = True
+			thread.start()
+
+	def make_rings(self):
+		# Creating a ring file and touching its pages takes a while: here, not under the lock
+		while True:
+			while self.ring_count < self.rings_wanted:
+				ring = Ring(os.path.join(self.timeshift_dir, "timeshift%d" % self.ring_count), self.timeshift_size)
+				with self.lock:
+					self.ring_count += 1
+					self.rings.append(ring)
+			self.rings_event.wait()
+			self.rings_event.clear()
+
+	def set_failover_callback(self, callback):
+		# callback(source) of the source playing, out for failover seconds, from the supervisor thread
+		self.failover_callback = callback
+
+	def reliability(self, source):
+		return self.health.reliability(source)
+
+	def open(self, source):
+		health = self.health.station(source)
+		if self.timeshift_dir == None or not source.startswith(("http:", "https:")):
+			return Stream(source, self.budget / self.size, health)
+		if not self.rings:
+			# Played directly while a ring is made, one more once they are all in use
+			tracing.warning("player", "%s: no ring free, not timeshifted", source)
+			if self.ring_count >= self.rings_wanted:
+				self.rings_wanted += 1
+				self.rings_event.set()
+			return Stream(source, self.budget / self.size, health)
+		ring = self.rings.pop()
+		ring.reset()
+		return TimeshiftStream(source, ring, health)
+
+	def close(self, stream):
+		stream.close()
+		if isinstance(stream, TimeshiftStream):
+			# Not while the old feeder may still read it
+			if stream.feeding():
+				tracing.warning("player", "%s: feeder still running, ring not reused", stream.source)
+			else:
+				self.rings.append(stream.ring)
+
+	def prepare(self, sources):
+		# Sources likely to be played next, nearest first: up to size - 1 stand by
+		with self.lock:
+			wanted = [source for source in sources if self.active == None or source != self.active.source][:self.size - 1]
+			for source, stream in list(self.standby.items()):
+				if source == self.armed:
+					continue
+				if source not in wanted or not stream.usable(self.max_age):
+					del self.standby[source]
+					self.close(stream)
+			for source in wanted:
+				if source not in self.standby:
+					stream = self.open(source)
+					stream.preroll()
+					self.standby[source] = stream
+
+	def arm(self, uri, timeout):
+		# Stands uri by until it is played, returns whether its data flows within timeout seconds
+		with self.lock:
+			self.armed = uri
+			if self.active != None and self.active.source == uri:
+				return True
+			stream = self.standby.get(uri)
+			if stream == None or not stream.usable(self.max_age):
+				if stream != None:
+					self.close(stream)
+				stream = self.open(uri)
+				stream.preroll()
+				self.standby[uri] = stream
+		return stream.flowing(timeout)
+
+	def disarm(self):
+		self.armed = None
+
+	def expect(self, at):
+		# The audio of the next play() is due at that wall time, how late it comes is logged
+		self.due = at
+
+	def heard(self, uri, due):
+		late = time() - due
+		self.late.add(max(late, 0))
+		tracing.info("player", "%s: audio %.3fs after it was due", uri, late)
+
+	def play(self, uri, volume):
+		with self.lock:
+			due = self.due
+			self.due = None
+			# Armed ahead of the alarm, it stood by for as long as it took
+			armed = uri == self.armed
+			if armed:
+				self.armed = None
+			if self.active != None and self.active.source == uri:
+				if due != None:
+					tracing.info("player", "%s: already playing when due", uri)
+				return
+			stream = self.standby.pop(uri, None)
+			warm = stream != None and stream.usable(None if armed else self.max_age)
+			if not warm:
+				if stream != None:
+					self.close(stream)
+				stream = self.open(uri)
+			previous = self.active
+			self.active = stream
+			self.outage = None
+			stream.set_volume(self.volume)
+			start = monotonic()
+			def first_buffer():
+				(self.warm if warm else self.cold).add(monotonic() - start)
+				if due != None:
+					self.heard(uri, due)
+			stream.start(first_buffer)
+
+			# The station left is a neighbour of the new one
+			if previous != None:
+				if self.size > 1:
+					previous.pause()
+					previous.preroll()
+					self.standby[previous.source] = previous
+				else:
+					self.close(previous)
+			for source in list(self.standby.keys()):
+				if len(self.standby) <= self.size - 1:
+					break
+				if source != self.armed:
+					self.close(self.standby.pop(source))
+
+	def stop(self):
+		# An armed source keeps standing by
+		with self.lock:
+			streams = [stream for (source, stream) in self.standby.items() if source != self.armed]
+			if self.active != None:
+				streams.append(self.active)
+			self.standby = OrderedDict([(source, stream) for (source, stream) in self.standby.items() if source == self.armed])
+			self.active = None
+			for stream in streams:
+				self.close(stream)
+
+	def pause(self):
+		# Live radio keeps coming into the ring while paused
+		if self.active != None:
+			self.active.pause()
+
+	def resume(self):
+		if self.active != None:
+			self.active.resume()
+
+	def supervise(self):
+		while True:
+			sleep(PlayerPool.CHECK)
+			failed = self.check()
+			if failed != None and self.failover_callback != None:
+				self.failover_callback(failed)
+
+	def check(self):
+		# Reconnects the stream playing once it broke, returns its source once it was out for failover seconds
+		with self.lock:
+			stream = self.active
+			if stream == None:
+				return None
+			now = monotonic()
+			broken = stream.broken()
+			if broken == None and (stream.heard or self.outage == None):
+				if self.outage != None:
+					tracing.info("player", "%s: back after %.1fs", stream.source, now - self.outage)
+					self.outage = None
+				return None
+			if self.outage == None:
+				self.outage = broken
+				self.attempts = 0
+				self.retry_at = now + backoff(0, PlayerPool.RETRY, PlayerPool.RETRY_CAP)
+			if now - self.outage >= self.failover:
+				tracing.warning("player", "%s: out for %.0fs, failing over", stream.source, now - self.outage)
+				self.health.station(stream.source).failovers += 1
+				self.outage = None
+				return stream.source
+			# A timeshifted capture reconnects by itself
+			if now < self.retry_at or (isinstance(stream, TimeshiftStream) and not stream.failed):
+				return None
+			self.attempts += 1
+			self.health.station(stream.source).reconnects += 1
+			self.retry_at = now + backoff(self.attempts, PlayerPool.RETRY, PlayerPool.RETRY_CAP)
+			tracing.warning("player", "%s: reconnecting, attempt %d", stream.source, self.attempts)
+			self.active = self.open(stream.source)
+			self.close(stream)
+			self.active.set_volume(self.volume)
+			self.active.start(lambda: None)
+			return None
+
+	def timeshifting(self):
+		# The stream playing rides out network outages, it has its lead in the ring
+		with self.lock:
+			return isinstance(self.active, TimeshiftStream) and self.active.lead() >= TimeshiftStream.MIN_LEAD
+
+	def healthy(self):
+		# What the stream playing says of the network: True, False, or None without a say
+		with self.lock:
+			if self.active == None or not self.active.source.startswith(("http:", "https:")):
+				return None
+			return self.active.healthy()
+
+	def set_volume(self, new_volume):
+		self.volume = new_volume
+		if self.active != None:
+			self.active.set_volume(new_volume)
+
+	def stats(self):
+		# warm and cold: seconds from play() to the first audio buffer, late: from when it was due
+		stats = { "standby": list(self.standby.keys()), "armed": self.armed, "warm": self.warm.stats(), "cold": self.cold.stats(),
+			"late": self.late.stats(), "stations": self.health.stats() }
+		if isinstance(self.active, TimeshiftStream):
+			stats["timeshift"] = self.active.ring.stats()
+		return stats
+
+
+if __name__ == "__main__":
+	# Goes through the sources as the wheel would, the next ones standing by
+	GObject.threads_init()
+	Gst.init(None)
+	if sys.argv[1:2] == ["--standin"]:
+		# Served dropping the connection every 10s, then out for longer than the failover
+		server = StandInServer(open(sys.argv[2], "rb").read(), drop = 10)
+		server.start()
+		pool = PlayerPool(timeshift_dir = "/dev/shm", failover = 15)
+		pool.set_failover_callback(lambda source: sys.stdout.write("failover %s\n" % source))
+		pool.play(server.url, 30)
+		for (down, seconds) in ((False, 30), (True, 25), (False, 20)):
+			server.down = down
+			sleep(seconds)
+			print("%s %s" % (server.stats(), pool.stats()["stations"]))
+		pool.stop()
+		sys.exit(0)
+	sources = sys.argv[1:]
+	pool = PlayerPool()
+	for i in range(0, 3 * len(sources)):
+		pool.play(sources[i % len(sources)], 30)
+		pool.prepare([sources[(i + 1) % len(sources)], sources[(i - 1) % len(sources)]])
+		sleep(2)
+	pool.stop()
+	print(pool.stats())
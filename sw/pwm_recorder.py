@@ -0,0 +1,204 @@
+"""
+In-memory stand-in for RPIO.PWM.
+
+Every call is recorded and the channel buffers are kept as a sparse
+{slot: (bits, on)} map, so the display code can be exercised and benchmarked
+without a Raspberry Pi:
+
+	pwm = RecordingPWM()
+	display = Display(pwm = pwm)
+	pwm.reset_calls()
+	display.set_brightness(30)
+	print(pwm.count())
+"""
+
+from collections import deque
+
+class RecordingPWM(object):
+	# Calls kept in memory, the counts cover all of them
+	HISTORY = 100000
+	def __init__(self, pulse_incr_us = 10):
+		self.pulse_incr_us = pulse_incr_us
+		self.subcycles = {}
+		self.buffers = {}
+		self.calls = deque(maxlen = RecordingPWM.HISTORY)
+		self.counts = {}
+		self.total = 0
+
+	def record(self, name, *args):
+		self.calls.append((name, args))
+		self.counts[name] = self.counts.get(name, 0) + 1
+		self.total += 1
+
+	def count(self, name = None):
+		if name == None:
+			return self.total
+		return self.counts.get(name, 0)
+
+	def reset_calls(self):
+		self.calls.clear()
+		self.counts = {}
+		self.total = 0
+
+	def slot(self, channel, position):
+		return self.buffers[channel].get(position, (0, False))
+
+	def put(self, channel, position, bits, on):
+		if bits or on:
+			self.buffers[channel][position] = (bits, on)
+		else:
+			self.buffers[channel].pop(position, None)
+
+	def elapse(self, channel, us):
+		# Writers wait for the DMA engine through this rather than sleeping, no engine runs here
+		pass
+
+	# RPIO.PWM API
+
+	def setup(self, pulse_incr_us = 10, delay_hw = 0):
+		self.record("setup", pulse_incr_us, delay_hw)
+		self.pulse_incr_us = pulse_incr_us
+
+	def cleanup(self):
+		self.record("cleanup")
+		self.buffers = {}
+		self.subcycles = {}
+
+	def get_pulse_incr_us(self):
+		return self.pulse_incr_us
+
+	def init_channel(self, channel, subcycle_time_us = 20000):
+		self.record("init_channel", channel, subcycle_time_us)
+		self.subcycles[channel] = subcycle_time_us
+		self.buffers[channel] = {}
+
+	def print_channel(self, channel):
+		self.record("print_channel", channel)
+
+	def add_channel_pulse(self, channel, gpio, start, width):
+		self.record("add_channel_pulse", channel, gpio, start, width)
+		bits, on = self.slot(channel, start)
+		self.put(channel, start, bits | (1 << gpio), True)
+		bits, on = self.slot(channel, start + width)
+		self.put(channel, start + width, bits | (1 << gpio), False)
+
+	def clear_channel_gpio(self, channel, gpio):
+		self.record("clear_channel_gpio", channel, gpio)
+		for position, (bits, on) in list(self.buffers[channel].items()):
+			self.put(channel, position, bits & ~(1 << gpio), on)
+
+	def buffer_set_on(self, channel, position):
+		self.record("buffer_set_on", channel, position)
+		bits, on = self.slot(channel, position)
+		self.put(channel, position, bits, True)
+
+	def buffer_set_off(self, channel, position):
+		self.record("buffer_set_off", channel, position)
+		bits, on = self.slot(channel, position)
+		self.put(channel, position, bits, False)
+
+	def buffer_set_mask(self, channel, set, mask, position):
+		self.record("buffer_set_mask", channel, set, mask, position)
+		bits, on = self.slot(channel, position)
+		self.put(channel, position, (bits & ~mask) | (set & mask), on)
+
+	def buffer_assign(self, channel, gpio, position):
+		self.record("buffer_assign", channel, gpio, position)
+		bits, on = self.slot(channel, position)
+		self.put(channel, position, bits | (1 << gpio), on)
+
+
+class SimulatedPWM(RecordingPWM):
+	"""
+	RecordingPWM that also plays the DMA engine: every buffer write lets it scan
+	slots_per_call more slots, as a Python call lasts a few 10us slots on a Pi Zero,
+	and elapse() the slots of the microseconds a writer waits.
+
+	Writers call publish() once the buffer holds a complete frame. A scanned
+	subcycle is torn if it lit a GPIO combination that none of the frames published
+	while it was scanned (or the one shown when it started) shows. gates maps a
+	channel to the GPIOs that have to be high for anything to be visible (the tube
+	anodes for the nixie channel).
+	"""
+	def __init__(self, pulse_incr_us = 10, slots_per_call = 3, gates = None):
+		RecordingPWM.__init__(self, pulse_incr_us)
+		self.slots_per_call = slots_per_call
+		self.gates = gates or {}
+		self.pointers = {}
+		self.observed = {}
+		self.published = {}
+		self.legit = {}
+		self.scanned = {}
+		self.torn = {}
+
+	def init_channel(self, channel, subcycle_time_us = 20000):
+		RecordingPWM.init_channel(self, channel, subcycle_time_us)
+		self.pointers[channel] = 0
+		self.observed[channel] = {}
+		self.published[channel] = ({}, set())
+		self.legit[channel] = set()
+		self.scanned[channel] = 0
+		self.torn[channel] = 0
+
+	def lit(self, channel, slots):
+		# GPIO levels held during a subcycle of slots (second lap, once the levels are steady)
+		gate = self.gates.get(channel, ~0)
+		levels = 0
+		lit = set()
+		positions = sorted(slots)
+		for lap in (0, 1):
+			for position in positions:
+				bits, on = slots[position]
+				if on:
+					levels |= bits
+				else:
+					levels &= ~bits
+				if lap and levels & gate:
+					lit.add(levels)
+		return lit
+
+	def publish(self, channel):
+		slots = dict(self.buffers[channel])
+		lit = self.lit(channel, slots)
+		self.published[channel] = (slots, lit)
+		self.legit[channel] |= lit
+
+	def end_subcycle(self, channel):
+		slots, lit = self.published[channel]
+		if self.observed[channel] != slots and not self.lit(channel, self.observed[channel]) <= self.legit[channel]:
+			self.torn[channel] += 1
+		self.scanned[channel] += 1
+		self.observed[channel] = {}
+		self.legit[channel] = set(lit)
+
+	def elapse(self, channel, us):
+		self.advance(channel, us / self.pulse_incr_us)
+
+	def advance(self, channel, slots):
+		length = self.subcycles[channel] / self.pulse_incr_us
+		buffer = self.buffers[channel]
+		pointer = self.pointers[channel]
+		for i in range(0, slots):
+			if pointer in buffer:
+				self.observed[channel][pointer] = buffer[pointer]
+			pointer += 1
+			if pointer == length:
+				self.end_subcycle(channel)
+				pointer = 0
+		self.pointers[channel] = pointer
+
+	def buffer_set_on(self, channel, position):
+		self.advance(channel, self.slots_per_call)
+		RecordingPWM.buffer_set_on(self, channel, position)
+
+	def buffer_set_off(self, channel, position):
+		self.advance(channel, self.slots_per_call)
+		RecordingPWM.buffer_set_off(self, channel, position)
+
+	def buffer_set_mask(self, channel, set, mask, position):
+		self.advance(channel, self.slots_per_call)
+		RecordingPWM.buffer_set_mask(self, channel, set, mask, position)
+
+	def buffer_assign(self, channel, gpio, position):
+		self.advance(channel, self.slots_per_call)
+		RecordingPWM.buffer_assign(self, channel, gpio, position)
@@ -0,0 +1,167 @@
+"""
+Replays synthetic input streams through the emulated GPIOs, the input handling and the
+display thread, and reports the latency from the interrupt callbacks to the DMA writes
+(tracing.latency) to find the rate where it saturates:
+
+	python replay.py                                # sweep of wheel and touch rates
+	python replay.py --source wheel --rate 200 --seconds 5
+	python replay.py --conductor                    # through the conductor's event queue and state machine
+
+The wheel is driven through its two quadrature pins and decoded as on the clock, with no
+debounce: every edge reaches the decoder. A touch stream alternates touching and releasing
+the top pad.
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import sys
+import getopt
+import itertools
+from time import sleep
+
+import tracing
+from tracing import monotonic
+from hardware import RPIO
+from user_input import UI
+from nixie import DisplayThread
+from conductor import Conductor
+
+# Quadrature levels (a, b) going clockwise
+CLOCKWISE = ((0, 1), (0, 0), (1, 0), (1, 1))
+WHEEL_RATES = (25, 50, 100, 200, 400, 800, 1600)
+TOUCH_RATES = (1, 2, 5, 10, 20, 40)
+# Edges before the wheel turns back
+SWING = 200
+# p99 input to DMA latency above this is saturated, a touch waits for the chord window first
+BUDGETS = { "wheel": 0.05, "touch": 0.15 }
+
+
+class SilentPlayer(object):
+	# Plays nothing, the conductor only needs the calls
+	def play(self, uri, volume):
+		pass
+
+	def stop(self):
+		pass
+
+	def set_volume(self, new_volume):
+		pass
+
+	def prepare(self, uris):
+		pass
+
+	def timeshifting(self):
+		return False
+
+	def arm(self, uri, timeout):
+		return True
+
+	def disarm(self):
+		pass
+
+	def expect(self, at):
+		pass
+
+	def reliability(self, uri):
+		return 1.0
+
+
+def wire(conductor = False):
+	ui = UI()
+	if conductor:
+		conductor = Conductor(ui.wheel.setup, SilentPlayer())
+		ui.set_wheel_pressed_callback(conductor.event_WHEEL_PRESSED)
+		ui.set_tmb_pressed_callback(conductor.event_TMB)
+		ui.set_top_pressed_callback(conductor.event_T)
+		ui.set_middle_pressed_callback(conductor.event_M)
+		ui.set_bottom_pressed_callback(conductor.event_B)
+		conductor.start()
+		return ui, conductor.dt
+
+	# As the conductor does for the volume: every value goes to the tubes
+	dt = DisplayThread()
+	dt.start()
+	ui.wheel.setup(0, 50, 100, 5, 96, dt.display_number)
+	counter = itertools.count()
+	ui.set_top_pressed_callback(lambda: dt.display_number(next(counter) % 10000))
+	return ui, dt
+
+def inject(ui, source, rate, seconds):
+	# Paced on monotonic deadlines, a late input goes right away (the stream keeps its count).
+	# A touch is held for half of its period.
+	count = int(rate * seconds)
+	position = CLOCKWISE.index((RPIO.input(ui.wheel.pin_a), RPIO.input(ui.wheel.pin_b)))
+	start = monotonic()
+	for i in range(0, count * 2 if source == "touch" else count):
+		pause(start + float(i) / (rate * 2 if source == "touch" else rate))
+		if source == "wheel":
+			# Back and forth, so the value stays off the limits
+			position += -1 if (i / SWING) % 2 else 1
+			a, b = CLOCKWISE[position % 4]
+			# One of the two changes
+			RPIO.drive(ui.wheel.pin_a, a)
+			RPIO.drive(ui.wheel.pin_b, b)
+		else:
+			ui.cap.touch((1 << UI.CAPA_TOP) if i % 2 == 0 else 0)
+	pause(start + seconds)
+	return count, monotonic() - start
+
+def pause(until):
+	delay = until - monotonic()
+	if delay > 0:
+		sleep(delay)
+
+def run(ui, dt, source, rate, seconds):
+	tracing.latency.reset()
+	tracing.latency.enabled = True
+	edges = ui.wheel.edges.total
+	dispatched = ui.touch.dispatched
+	applied = dt.applied
+	waited = dt.display.channel.waited
+	count, elapsed = inject(ui, source, rate, seconds)
+	# Let the last inputs reach the tubes
+	sleep(0.5)
+	tracing.latency.enabled = False
+	# Edges decoded, or touches that reached their callback
+	accepted = ui.wheel.edges.total - edges if source == "wheel" else ui.touch.dispatched - dispatched
+	return { "source": source, "rate": rate, "offered": count / elapsed, "accepted": float(accepted) / elapsed,
+		"applied": (dt.applied - applied) / elapsed, "waited": (dt.display.channel.waited - waited) / 1000.0 / elapsed, "latency": tracing.latency.report(), "completed": tracing.latency.completed,
+		"dropped": tracing.latency.dropped }
+
+def show(result):
+	print("%-5s %6d/s offered %7.1f/s accepted %7.1f/s, display commands %6.1f/s, %5d on the tubes %5d without effect" % (result["source"],
+		result["rate"], result["offered"], result["accepted"], result["applied"], result["completed"], result["dropped"]))
+	# Part of the dma stage: the gated commits waiting for the DMA engine to leave a window
+	print("      commits waited %.1fms/s" % result["waited"])
+	for stage, (count, p50, p90, p99, worst) in result["latency"].items():
+		print("      %-10s p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  max %7.2fms" % (stage, p50 * 1000, p90 * 1000, p99 * 1000, worst * 1000))
+
+def saturated(result):
+	total = result["latency"].get("total")
+	return result["accepted"] < 0.9 * result["offered"] or (total != None and total[3] > BUDGETS[result["source"]])
+
+
+if __name__ == "__main__":
+	opts, args = getopt.getopt(sys.argv[1:], "s:r:t:c", ["source=", "rate=", "seconds=", "conductor"])
+	options = dict(opts)
+	source = options.get("-s", options.get("--source"))
+	rate = options.get("-r", options.get("--rate"))
+	seconds = float(options.get("-t", options.get("--seconds", 2)))
+
+	ui, dt = wire("-c" in options or "--conductor" in options)
+	sleep(0.2)
+
+	if rate:
+		show(run(ui, dt, source or "wheel", float(rate), seconds))
+		sys.exit(0)
+
+	for name, rates in (("wheel", WHEEL_RATES), ("touch", TOUCH_RATES)):
+		if source not in (None, name):
+			continue
+		for rate in rates:
+			result = run(ui, dt, name, rate, seconds)
+			show(result)
+			if saturated(result):
+				print("%s saturates at %d/s" % (name, rate))
+				break
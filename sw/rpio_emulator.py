@@ -0,0 +1,130 @@
+"""
+Pure Python emulation of the Raspberry Pi side: RPIO (GPIO levels, pull-ups,
+interrupt callbacks), RPIO.PWM (channel buffers, see pwm_recorder) and the
+MPR121 touch controller. Selected with NIXIE_BACKEND=emulator, see hardware.py.
+
+Inputs are driven from the outside, callbacks run synchronously in the caller,
+like RPIO runs them in its single interrupt thread:
+
+	RPIO.drive(17, 0)
+	ui.cap.touch(1 << 6)
+"""
+
+from time import time
+from pwm_recorder import SimulatedPWM
+
+
+class EmulatedRPIO(object):
+	BCM = 11
+	BOARD = 10
+	IN = 1
+	OUT = 0
+	PUD_OFF = 20
+	PUD_DOWN = 21
+	PUD_UP = 22
+
+	def __init__(self):
+		self.levels = {}
+		self.directions = {}
+		self.pulls = {}
+		# gpio -> [(callback, edge, debounce_timeout_ms, time of the last call)]
+		self.callbacks = {}
+		self.waiting = False
+
+	def setmode(self, mode):
+		self.mode = mode
+
+	def setwarnings(self, enabled):
+		pass
+
+	def setup(self, gpio, direction, pull_up_down = PUD_OFF, initial = None):
+		self.directions[gpio] = direction
+		self.set_pullupdn(gpio, pull_up_down)
+		if direction == EmulatedRPIO.OUT and initial != None:
+			self.levels[gpio] = int(bool(initial))
+
+	def set_pullupdn(self, gpio, pud = PUD_UP):
+		self.pulls[gpio] = pud
+		if gpio not in self.levels:
+			self.levels[gpio] = 1 if pud == EmulatedRPIO.PUD_UP else 0
+
+	def input(self, gpio):
+		return self.levels.get(gpio, 0)
+
+	def output(self, gpio, value):
+		self.levels[gpio] = int(bool(value))
+
+	def add_interrupt_callback(self, gpio, callback, edge = "both", pull_up_down = PUD_OFF, threaded_callback = False, debounce_timeout_ms = None):
+		if gpio not in self.levels:
+			self.set_pullupdn(gpio, pull_up_down)
+		self.callbacks.setdefault(gpio, []).append([callback, edge, debounce_timeout_ms, None])
+
+	def del_interrupt_callback(self, gpio):
+		self.callbacks.pop(gpio, None)
+
+	def wait_for_interrupts(self, threaded = False, epoll_timeout = 1):
+		self.waiting = True
+
+	def stop_waiting_for_interrupts(self):
+		self.waiting = False
+
+	def cleanup(self):
+		self.__init__()
+
+	# Emulator only
+
+	def drive(self, gpio, value, now = None):
+		# Sets an input level, as the outside world would, and runs the callbacks of that edge
+		value = int(bool(value))
+		if self.levels.get(gpio) == value:
+			return
+		self.levels[gpio] = value
+		if now == None:
+			now = time()
+		edge = "rising" if value else "falling"
+		for entry in self.callbacks.get(gpio, []):
+			callback, wanted, debounce, last = entry
+			if wanted not in ("both", edge):
+				continue
+			if debounce and last != None and (now - last) * 1000 < debounce:
+				continue
+			entry[3] = now
+			callback(gpio, value)
+
+
+class EmulatedMPR121(object):
+	"""
+	Stand-in for Adafruit's MPR121 class. touch() sets the touched pins and, like the chip,
+	pulls the IRQ GPIO low until the status is read with touched(). reads counts the I2C reads.
+	"""
+	# Wired to GPIO 4 on the clock
+	IRQ = 4
+	def __init__(self, irq = IRQ, rpio = None):
+		self.irq = irq
+		self.rpio = rpio
+		self.state = 0
+		self.reads = 0
+
+	def begin(self, *args, **kwargs):
+		(self.rpio or RPIO).drive(self.irq, 1)
+		return True
+
+	def touched(self):
+		self.reads += 1
+		(self.rpio or RPIO).drive(self.irq, 1)
+		return self.state
+
+	def is_touched(self, pin):
+		return bool(self.touched() & (1 << pin))
+
+	def touch(self, pins):
+		if pins == self.state:
+			return
+		self.state = pins
+		(self.rpio or RPIO).drive(self.irq, 0)
+
+
+RPIO = EmulatedRPIO()
+PWM = SimulatedPWM()
+# The Adafruit module is used as MPR121.MPR121()
+MPR121 = EmulatedMPR121
@@ -0,0 +1,123 @@
+"""
+Table driven state machine, as the conductor runs it.
+
+transitions maps (state, event) to (action, next state). The action gets the value
+of the event, a next state of None stays in the state without leaving it. A change
+of state runs the exit action of the state left, the action, then the entry action
+of the state entered. Events without a transition in the current state are ignored.
+timeouts gives the seconds a state waits for an event before its TIMEOUT is due:
+
+	machine = StateMachine(DEFAULT, { (DEFAULT, T): (None, BRIGHTNESS), (BRIGHTNESS, TIMEOUT): (None, DEFAULT) },
+		entries = { BRIGHTNESS: show_brightness }, timeouts = { BRIGHTNESS: 3 })
+	machine.start()
+	machine.dispatch(T)
+	machine.timeout()    # -> 3
+
+Pure Python, the clock only times the transitions.
+"""
+
+from collections import OrderedDict
+
+import tracing
+from tracing import monotonic
+
+
+class StateMachine(object):
+	def __init__(self, initial, transitions, entries = None, exits = None, timeouts = None, state_names = None, event_names = None, clock = monotonic):
+		self.initial = initial
+		self.transitions = transitions
+		self.entries = entries or {}
+		self.exits = exits or {}
+		# state -> seconds, None (or not listed): no timeout
+		self.timeouts = timeouts or {}
+		# state -> name and event -> name, for the trace, the stats and the graph
+		self.state_names = state_names or {}
+		self.event_names = event_names or {}
+		self.clock = clock
+		self.state = None
+		# (state, event) -> [count, seconds, longest]
+		self.counters = dict([(key, [0, 0, 0]) for key in transitions])
+		self.ignored = 0
+
+	def state_name(self, state):
+		return self.state_names.get(state, str(state))
+
+	def event_name(self, event):
+		return self.event_names.get(event, str(event))
+
+	def start(self):
+		self.state = self.initial
+		entry = self.entries.get(self.initial)
+		if entry:
+			entry()
+
+	def timeout(self):
+		return self.timeouts.get(self.state)
+
+	def dispatch(self, event, value = None):
+		# Returns whether the event led to a transition
+		key = (self.state, event)
+		transition = self.transitions.get(key)
+		if transition == None:
+			self.ignored += 1
+			tracing.debug("state", "%s: %s ignored", self.state_name(self.state), self.event_name(event))
+			return False
+
+		action, target = transition
+		start = self.clock()
+		if target != None:
+			exit = self.exits.get(self.state)
+			if exit:
+				exit()
+		if action:
+			action(value)
+		if target != None:
+			self.state = target
+			entry = self.entries.get(target)
+			if entry:
+				entry()
+		elapsed = self.clock() - start
+
+		counter = self.counters[key]
+		counter[0] += 1
+		counter[1] += elapsed
+		counter[2] = max(counter[2], elapsed)
+		tracing.debug("state", "%s: %s -> %s, timeout %s", self.state_name(key[0]), self.event_name(event), self.state_name(self.state), self.timeout())
+		return True
+
+	def stats(self):
+		# "STATE EVENT" -> (count, mean seconds, longest), for the transitions taken
+		transitions = OrderedDict()
+		for key in sorted(self.counters):
+			count, seconds, longest = self.counters[key]
+			if count:
+				transitions["%s %s" % (self.state_name(key[0]), self.event_name(key[1]))] = (count, seconds / count, longest)
+		return { "state": self.state_name(self.state), "ignored": self.ignored, "transitions": transitions }
+
+	def graph(self):
+		# Sorted (state, event, next state) names, a transition that stays points to its state
+		edges = []
+		for (state, event), (action, target) in self.transitions.items():
+			edges.append((self.state_name(state), self.event_name(event), self.state_name(state if target == None else target)))
+		return sorted(edges)
+
+	def unreachable(self):
+		# States no transition leads to, from the initial state on
+		reached = set([self.initial])
+		changed = True
+		while changed:
+			changed = False
+			for (state, event), (action, target) in self.transitions.items():
+				if state in reached and target != None and target not in reached:
+					reached.add(target)
+					changed = True
+		states = set([state for (state, event) in self.transitions]) | set(self.entries) | set(self.exits) | set(self.timeouts)
+		return sorted([self.state_name(state) for state in states - reached])
+
+	def dot(self, title = "states"):
+		# Graphviz source of the graph
+		lines = ["digraph %s {" % title]
+		for (state, event, target) in self.graph():
+			lines.append('\t"%s" -> "%s" [label="%s"];' % (state, target, event))
+		lines.append("}")
+		return "\n".join(lines) + "\n"
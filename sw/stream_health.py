@@ -0,0 +1,155 @@
+"""
+Health of the stations as their streams tell it, and the delays to reconnect them.
+
+The player records what the bus of each stream says, from the streaming threads:
+errors, ends of stream, buffering, bitrate, and the underruns. Each station gets a
+reliability between 0 and 1, a moving average of its starts (good) and of its
+failures (bad), that decides which stations stand by first:
+
+	health = Health()
+	health.station(url).error()
+	health.reliability(url)    # -> 0.8
+
+backoff() is the delay before a reconnection attempt, doubling up to a cap and jittered
+so that streams lost at the same time do not all reconnect at once. StandInServer is an
+HTTP radio on the loopback that drops its connections, to test the reconnections
+(python player.py --standin file.mp3). Pure Python, no GStreamer needed.
+"""
+
+import random
+import socket
+import threading
+from time import sleep
+
+from tracing import monotonic
+
+
+def backoff(attempt, base, cap, rand = random.random):
+	# Seconds before attempt (0 first): base doubled each attempt up to cap, between half and all of it
+	delay = min(cap, base * 2 ** attempt)
+	return delay * (0.5 + rand() / 2)
+
+
+class StationHealth(object):
+	# Weight of the latest outcome in the reliability
+	ALPHA = 0.2
+
+	def __init__(self, source):
+		self.source = source
+		# Benefit of the doubt until it played
+		self.reliability = 1.0
+		self.starts = 0
+		self.errors = 0
+		self.ends = 0
+		self.underruns = 0
+		self.reconnects = 0
+		self.failovers = 0
+		# Percent of the last buffering message, bits/s of the last bitrate tag
+		self.buffering = None
+		self.bitrate = None
+
+	def outcome(self, good):
+		self.reliability += StationHealth.ALPHA * ((1.0 if good else 0.0) - self.reliability)
+
+	def started(self):
+		self.starts += 1
+		self.outcome(True)
+
+	def error(self):
+		self.errors += 1
+		self.outcome(False)
+
+	def ended(self):
+		self.ends += 1
+		self.outcome(False)
+
+	def underrun(self):
+		self.underruns += 1
+		self.outcome(False)
+
+	def stats(self):
+		return { "reliability": round(self.reliability, 3), "starts": self.starts, "errors": self.errors, "ends": self.ends,
+			"underruns": self.underruns, "reconnects": self.reconnects, "failovers": self.failovers,
+			"buffering": self.buffering, "bitrate": self.bitrate }
+
+
+class Health(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		# source -> StationHealth
+		self.stations = {}
+
+	def station(self, source):
+		with self.lock:
+			if source not in self.stations:
+				self.stations[source] = StationHealth(source)
+			return self.stations[source]
+
+	def reliability(self, source):
+		station = self.stations.get(source)
+		return 1.0 if station == None else station.reliability
+
+	def stats(self):
+		with self.lock:
+			return dict([(source, station.stats()) for (source, station) in self.stations.items()])
+
+
+class StandInServer(threading.Thread):
+	"""
+	HTTP stand-in of a radio on the loopback: serves data over and over at rate bytes/s,
+	drops each connection after drop seconds (None: never), and closes the new ones at
+	once while down is set.
+	"""
+	def __init__(self, data, rate = 16000, drop = None):
+		threading.Thread.__init__(self, name = "standin")
+		self.daemon = True
+		self.data = data
+		self.rate = rate
+		self.drop = drop
+		self.down = False
+		self.connections = 0
+		self.dropped = 0
+		self.refused = 0
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind(("127.0.0.1", 0))
+		self.server.listen(5)
+		self.url = "http://127.0.0.1:%d/stream" % self.server.getsockname()[1]
+
+	def run(self):
+		while True:
+			connection = self.server.accept()[0]
+			thread = threading.Thread(target = self.serve, args = (connection, ), name = "standin")
+			thread.daemon = True
+			thread.start()
+
+	def serve(self, connection):
+		try:
+			if self.down:
+				self.refused += 1
+				return
+			self.connections += 1
+			request = b""
+			while b"\r\n\r\n" not in request:
+				received = connection.recv(1024)
+				if not received:
+					return
+				request += received
+			connection.sendall(b"HTTP/1.0 200 OK\r\nContent-Type: audio/mpeg\r\n\r\n")
+			# A tenth of a second of data at a time
+			chunk = max(1, self.rate / 10)
+			looped = self.data * (chunk / len(self.data) + 2)
+			position = 0
+			start = monotonic()
+			while not self.down and (self.drop == None or monotonic() - start < self.drop):
+				connection.sendall(looped[position:position + chunk])
+				position = (position + chunk) % len(self.data)
+				sleep(0.1)
+			self.dropped += 1
+		except socket.error:
+			pass
+		finally:
+			connection.close()
+
+	def stats(self):
+		return { "connections": self.connections, "dropped": self.dropped, "refused": self.refused }
@@ -0,0 +1,257 @@
+"""
+The conductor's transition table, with a player and a display that only record the calls
+and the state machine on a fake clock:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import unittest
+from time import localtime, time
+
+from conductor import Conductor, RadioEvent, RadioState, WHEEL_STEPS
+from replay import SilentPlayer
+from stream_health import Health
+
+S = RadioState
+E = RadioEvent
+
+
+class Recorder(object):
+	# Records the calls of any method
+	def __init__(self):
+		self.calls = []
+
+	def __getattr__(self, name):
+		def call(*args, **kwargs):
+			self.calls.append((name, ) + args)
+		return call
+
+
+class RecordingPlayer(SilentPlayer):
+	def __init__(self):
+		self.calls = []
+		# Sources that do not answer arm()
+		self.down = set()
+		self.health = Health()
+
+	def play(self, uri, volume):
+		self.calls.append(("play", uri))
+
+	def stop(self):
+		self.calls.append(("stop", ))
+
+	def prepare(self, uris):
+		self.calls.append(("prepare", list(uris)))
+
+	def arm(self, uri, timeout):
+		self.calls.append(("arm", uri))
+		return uri not in self.down
+
+	def reliability(self, uri):
+		return self.health.reliability(uri)
+
+
+class Station(object):
+	def __init__(self, id_):
+		self.id_ = id_
+		self.name = "station %d" % id_
+		self.url = "http://radio/%d" % id_
+
+
+class Alarm(object):
+	def __init__(self, station_id, hour = 7, minute = 30):
+		self.station_id = station_id
+		self.hour = hour
+		self.minute = minute
+
+
+class AlarmManager(object):
+	def __init__(self, stations, alarm):
+		self.stations = stations
+		self.alarm = alarm
+
+	def get_all_stations(self):
+		return self.stations
+
+	def get_station(self, id_):
+		return [station for station in self.stations if station.id_ == id_][0]
+
+	def get_next_alarm(self):
+		return self.alarm
+
+
+class FakeClock(object):
+	def __init__(self):
+		self.now = 100.0
+
+	def __call__(self):
+		return self.now
+
+
+class Table(unittest.TestCase):
+	def setUp(self):
+		self.player = RecordingPlayer()
+		self.dt = Recorder()
+		self.wheel = []
+		self.conductor = Conductor(lambda *args: self.wheel.append(args), self.player, dt = self.dt)
+		self.stations = [Station(i) for i in range(0, 5)]
+		self.conductor.attach_alarm_mgr(AlarmManager(self.stations, Alarm(3)))
+		self.clock = FakeClock()
+		self.machine = self.conductor.machine
+		self.machine.clock = self.clock
+		self.machine.start()
+
+	def events(self, *events):
+		# Through the queue and the machine, as the conductor's thread does
+		for event in events:
+			if isinstance(event, tuple):
+				self.conductor.raise_event(*event)
+			else:
+				self.conductor.raise_event(event)
+		while self.conductor.events.depth():
+			event, value, stamps = self.conductor.events.get(0)
+			self.machine.dispatch(event, value)
+
+	def wait(self, seconds):
+		# The state times out once seconds reach its timeout
+		timeout = self.machine.timeout()
+		self.clock.now += seconds
+		if timeout != None and seconds >= timeout:
+			self.machine.dispatch(E.TIMEOUT)
+
+	def plays(self):
+		return [call[1] for call in self.player.calls if call[0] == "play"]
+
+	def test_table(self):
+		self.assertEqual(self.machine.unreachable(), [])
+		# Every state ends up in DEFAULT again
+		for (state, event), (action, target) in self.conductor.transitions().items():
+			self.assertTrue(target in (None, S.DEFAULT, S.VOLUME, S.BRIGHTNESS, S.NEXT, S.STATION, S.ALARM))
+		for state in (S.VOLUME, S.BRIGHTNESS, S.NEXT, S.STATION, S.ALARM):
+			self.assertTrue((state, E.TIMEOUT) in self.conductor.transitions())
+
+	def test_volume(self):
+		self.events((E.WHEEL_MOVE, 30))
+		self.assertEqual(self.machine.state, S.VOLUME)
+		self.assertEqual(self.conductor.state_volume, 30 * 100 / WHEEL_STEPS)
+		self.wait(2.9)
+		self.assertEqual(self.machine.state, S.VOLUME)
+		self.events((E.WHEEL_MOVE, 40))
+		self.wait(3)
+		self.assertEqual(self.machine.state, S.DEFAULT)
+		self.assertEqual(self.machine.stats()["transitions"]["VOLUME WHEEL_MOVE"][0], 1)
+
+	def test_brightness_and_blanking(self):
+		self.events(E.T)
+		self.assertEqual(self.machine.state, S.BRIGHTNESS)
+		self.events((E.WHEEL_MOVE, 20))
+		self.assertEqual(self.conductor.state_brightness, 20 * 100 / WHEEL_STEPS)
+		self.events(E.T)
+		self.assertEqual(self.machine.state, S.DEFAULT)
+		self.assertTrue(self.conductor.state_blanked)
+
+	def test_play_toggle(self):
+		self.events(E.WHEEL_PRESSED)
+		self.assertTrue(self.conductor.state_playing)
+		self.assertEqual(self.plays(), [self.stations[0].url])
+		self.events(E.WHEEL_PRESSED)
+		self.assertFalse(self.conductor.state_playing)
+		self.assertEqual(self.player.calls[-1], ("stop", ))
+
+	def test_station(self):
+		self.events(E.WHEEL_PRESSED, E.B)
+		self.assertEqual(self.machine.state, S.STATION)
+		self.events((E.WHEEL_MOVE, 2))
+		self.assertEqual(self.plays(), [self.stations[0].url, self.stations[2].url])
+		self.assertEqual([call for call in self.player.calls if call[0] == "prepare"][-1][1][0], self.stations[2].url)
+		self.wait(3)
+		self.assertEqual(self.machine.state, S.DEFAULT)
+		# Nothing stands by once out of STATION
+		self.assertEqual(self.player.calls[-1], ("prepare", []))
+
+	def prepared(self):
+		return [call for call in self.player.calls if call[0] == "prepare"][-1][1]
+
+	def test_unreliable_neighbours_stand_by_later(self):
+		urls = [station.url for station in self.stations]
+		self.conductor.prepare_neighbours()
+		self.assertEqual(self.prepared(), urls)
+		# Five failures: a neighbour more than one station further away
+		for i in range(0, 5):
+			self.player.health.station(urls[1]).error()
+		self.conductor.prepare_neighbours()
+		self.assertEqual(self.prepared(), [urls[0], urls[2], urls[1], urls[3], urls[4]])
+		for i in range(0, 5):
+			self.player.health.station(urls[1]).started()
+		self.conductor.prepare_neighbours()
+		self.assertEqual(self.prepared(), urls)
+
+	def test_next_ignores_the_wheel(self):
+		self.events(E.M, (E.WHEEL_MOVE, 10))
+		self.assertEqual(self.machine.state, S.NEXT)
+		self.assertEqual(self.machine.stats()["ignored"], 1)
+		self.wait(4)
+		self.assertEqual(self.machine.state, S.DEFAULT)
+
+	def test_alarm(self):
+		self.events(E.T, (E.ALARM, Alarm(3)))
+		self.assertEqual(self.machine.state, S.ALARM)
+		self.assertEqual(self.plays(), [self.stations[3].url])
+		# Only the three pads stop it
+		self.events(E.T, E.WHEEL_PRESSED)
+		self.assertEqual(self.machine.state, S.ALARM)
+		self.events(E.TMB)
+		self.assertEqual(self.machine.state, S.DEFAULT)
+		self.assertFalse(self.conductor.state_playing)
+
+	def test_alarm_goes_ahead_of_the_buttons(self):
+		self.conductor.raise_event(E.T)
+		self.conductor.raise_event(E.ALARM, Alarm(3))
+		self.assertEqual(self.conductor.events.pending(), [E.ALARM, E.T])
+
+	def ring(self):
+		# Pre-armed for an alarm due this minute, it rings at once
+		t = localtime(time())
+		alarm = Alarm(3, t.tm_hour, t.tm_min)
+		self.conductor.alarm_mgr.alarm = alarm
+		self.conductor.prearm(alarm)
+		self.events()
+
+	def test_prearmed_alarm(self):
+		self.ring()
+		self.assertEqual(self.machine.state, S.ALARM)
+		self.assertEqual([call for call in self.player.calls if call[0] == "arm"], [("arm", self.stations[3].url)])
+		self.assertEqual(self.plays(), [self.stations[3].url])
+
+	def test_alarm_fallback(self):
+		# The alarm's station does not answer: the offline station is armed and plays
+		self.player.down.add(self.stations[3].url)
+		self.ring()
+		self.assertEqual(self.machine.state, S.ALARM)
+		self.assertEqual([call for call in self.player.calls if call[0] == "arm"],
+			[("arm", self.stations[3].url), ("arm", self.conductor.offline_station)])
+		self.assertEqual(self.plays(), [self.conductor.offline_station])
+		self.assertTrue(self.conductor.state_playing)
+		self.assertFalse(self.conductor.alarm_fallback)
+
+	def test_failover(self):
+		self.events(E.WHEEL_PRESSED, E.T)
+		self.conductor.station_failed(self.stations[0].url)
+		# Posted, played from the conductor's thread
+		self.assertEqual(self.plays(), [self.stations[0].url])
+		self.events()
+		self.assertEqual(self.plays(), [self.stations[0].url, self.conductor.offline_station])
+		self.assertEqual(self.machine.state, S.BRIGHTNESS)
+
+	def test_failover_when_stopped(self):
+		self.events(E.B)
+		self.conductor.station_failed(self.stations[0].url)
+		self.events()
+		self.assertEqual(self.plays(), [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,305 @@
+"""
+The display on the simulated DMA engine: the layouts it refuses, frame atomicity of the
+double buffered channel, the clock schedule on hand moved clocks, the cathode sweeps
+around the minute rollovers, the commands of the display thread and the frame cache:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import random
+import unittest
+from time import localtime, mktime
+
+import nixie
+from pwm_recorder import RecordingPWM, SimulatedPWM
+
+
+def display(slots_per_call):
+	pwm = SimulatedPWM(slots_per_call = slots_per_call, gates = { nixie.nixie_channel: nixie.tube_mask })
+	pwm.setup()
+	return pwm, nixie.Display(pwm = pwm)
+
+
+class Layouts(unittest.TestCase):
+	def test_anodes(self):
+		self.assertEqual(nixie.Layout(tube_count = 4).tubes, 4)
+		# Six tubes, the default anode codes only go to four
+		self.assertRaisesRegexp(ValueError, "only 4 in the default anodes", nixie.Layout, tube_count = 6)
+		self.assertRaisesRegexp(ValueError, "only 5 given", nixie.Layout, tube_count = 6, anodes = nixie.tubes + [(1, 0, 0)])
+		anodes = nixie.tubes + [(1, 0, 0), (1, 0, 1)]
+		layout = nixie.Layout(tube_count = 6, anodes = anodes, refresh_hz = 50)
+		self.assertEqual(len(layout.tube_sets), 6)
+
+	def test_ghosting(self):
+		self.assertRaisesRegexp(ValueError, "would ghost", nixie.Layout, dead_time_us = nixie.Layout.MIN_DEAD_TIME_US - 10)
+		nixie.Layout(dead_time_us = nixie.Layout.MIN_DEAD_TIME_US)
+
+	def test_overlap(self):
+		# 1000 slots over 16 tubes leave 62, less than the dead time of 79
+		anodes = [(i >> 2 & 1, i >> 1 & 1, i & 1) for i in range(0, 16)]
+		self.assertRaisesRegexp(ValueError, "overlap", nixie.Layout, tube_count = 16, anodes = anodes)
+
+
+class TornFrames(unittest.TestCase):
+	SLOTS_PER_CALL = (1, 3, 10)
+
+	def test_brightness_sweep(self):
+		# Up to a subcycle between the steps, as a fade goes
+		rand = random.Random(2)
+		for slots_per_call in TornFrames.SLOTS_PER_CALL:
+			pwm, d = display(slots_per_call)
+			for brightness in range(100, -1, -1) + range(0, 101) + range(0, 101, 7) + range(100, -1, -13):
+				d.set_brightness(brightness)
+				pwm.elapse(nixie.nixie_channel, rand.randint(0, d.channel.period))
+			self.assertTrue(pwm.scanned[nixie.nixie_channel] > 100)
+			self.assertEqual(d.channel.torn_frames(), 0, "%d slots per call" % slots_per_call)
+
+	def test_random_brightness(self):
+		rand = random.Random(1)
+		for slots_per_call in TornFrames.SLOTS_PER_CALL:
+			pwm, d = display(slots_per_call)
+			for i in range(0, 1000):
+				d.set_brightness(rand.randint(0, 100))
+			self.assertEqual(d.channel.torn_frames(), 0, "%d slots per call" % slots_per_call)
+
+	def test_digits_and_duals(self):
+		rand = random.Random(2)
+		for slots_per_call in TornFrames.SLOTS_PER_CALL:
+			pwm, d = display(slots_per_call)
+			for i in range(0, 500):
+				duals = [None, None, None, (rand.randint(0, 9), rand.randint(0, 100))] if i % 3 == 0 else None
+				d.show([1, 2, rand.randint(0, 5), rand.randint(0, 9)], blanked = rand.randint(0, 1), duals = duals)
+				d.set_brightness(rand.randint(0, 100))
+			self.assertTrue(pwm.scanned[nixie.nixie_channel] > 100)
+			self.assertEqual(d.channel.torn_frames(), 0, "%d slots per call" % slots_per_call)
+
+	def test_waits(self):
+		# One window before a rewired window is drawn, one when an off slot moves earlier, none when it moves later
+		pwm, d = display(3)
+		window = d.channel.period * d.channel.window / d.channel.slots
+		for (change, waits) in ((lambda: d.set_brightness(100), 0), (lambda: d.set_brightness(40), 1),
+				(lambda: d.set_brightness(60), 0), (lambda: d.show([1, 2, 3, 4]), 1), (lambda: d.show([1, 2, 3, 4]), 0)):
+			before = d.channel.waits
+			change()
+			self.assertEqual(d.channel.waits - before, waits)
+		self.assertEqual(d.channel.waited, 2 * window)
+		self.assertEqual(d.stats()["waited"], 2 * window)
+
+	def test_commit_reaches_the_frame(self):
+		pwm, d = display(3)
+		d.show([4, 5, 6, 7])
+		d.set_brightness(37)
+		frame = nixie.compile_display([4, 5, 6, 7], 0, 37)
+		self.assertEqual(pwm.buffers[nixie.nixie_channel], frame.slots)
+
+
+class Clocks(object):
+	# Wall and monotonic clocks of nixie, moved by hand
+	def __init__(self, wall, mono = 1000.0):
+		self.wall = wall
+		self.mono = mono
+		self.saved = (nixie.time, nixie.monotonic)
+		nixie.time = lambda: self.wall
+		nixie.monotonic = lambda: self.mono
+
+	def advance(self, seconds, wall = None):
+		# wall: how far the wall clock goes meanwhile, seconds by default
+		self.mono += seconds
+		self.wall += seconds if wall == None else wall
+
+	def restore(self):
+		nixie.time, nixie.monotonic = self.saved
+
+
+class Schedule(unittest.TestCase):
+	def setUp(self):
+		self.clocks = Clocks(6000.5)
+		self.schedule = nixie.ClockSchedule(60)
+
+	def tearDown(self):
+		self.clocks.restore()
+
+	def test_plan(self):
+		self.assertEqual(self.schedule.plan(self.clocks.wall), 59.5)
+		self.clocks.advance(20)
+		self.assertEqual(self.schedule.plan(self.clocks.wall), 39.5)
+		self.clocks.advance(39.5)
+		self.assertEqual(self.schedule.plan(self.clocks.wall), 60)
+
+	def test_lateness(self):
+		self.schedule.plan(self.clocks.wall)
+		self.clocks.advance(59.52)
+		self.schedule.rolled_over(self.clocks.wall)
+		lateness = self.schedule.stats()["lateness"]
+		self.assertEqual(lateness["count"], 1)
+		self.assertEqual(lateness["buckets"]["<50ms"], 1)
+		# Not a rollover yet
+		self.schedule.rolled_over(self.clocks.wall - 1)
+		self.assertEqual(self.schedule.stats()["lateness"]["count"], 1)
+
+	def test_jump(self):
+		self.schedule.plan(self.clocks.wall)
+		self.clocks.advance(1, wall = 1 + nixie.ClockSchedule.JUMP / 2)
+		self.assertFalse(self.schedule.jumped())
+		self.clocks.advance(1, wall = 1 - 3600)
+		self.assertTrue(self.schedule.jumped())
+		self.assertEqual(self.schedule.jumps, 1)
+		# A new schedule from the new time
+		self.assertEqual(self.schedule.plan(self.clocks.wall), 60 - (self.clocks.wall % 60))
+
+	def test_wall_clock_behind(self):
+		# The wall clock slews slower than the monotonic one: due, but the boundary is not reached
+		self.schedule.plan(self.clocks.wall)
+		self.clocks.advance(59.5, wall = 59.4)
+		self.assertTrue(abs(self.schedule.plan(self.clocks.wall) - 0.1) < 1e-6)
+		self.clocks.advance(0.11, wall = 0.05)
+		self.assertTrue(abs(self.schedule.plan(self.clocks.wall) - 0.05) < 1e-6)
+		self.clocks.advance(0.05)
+		self.assertEqual(self.schedule.plan(self.clocks.wall), 60)
+
+
+class Cycling(unittest.TestCase):
+	def setUp(self):
+		self.pwm, self.d = display(3)
+		# Local midnight, sweeps every minute
+		self.base = mktime((2026, 10, 18, 0, 0, 0, 0, 0, -1))
+		self.cycler = nixie.CathodeCycler(self.d, self.pwm, every = 60, duration = 60)
+		self.cycler.next = self.cycler.next_start(self.base)
+
+	def second(self, t):
+		return localtime(t).tm_sec + t - int(t)
+
+	def test_sweeps_stay_inside_the_minute(self):
+		# Woken late now and then, and busy at times
+		rand = random.Random(3)
+		now = self.base
+		starts = 0
+		while now < self.base + 3600:
+			running = self.cycler.running
+			delay = self.cycler.poll(now, rand.random() < 0.8)
+			if self.cycler.running and not running:
+				starts += 1
+				self.assertTrue(self.second(now) >= nixie.CathodeCycler.DELAY, self.second(now))
+				# Over by second 59 of the same minute
+				self.assertTrue(self.cycler.stop_at - now + self.second(now) <= 60 - nixie.CathodeCycler.DELAY)
+			now += delay + rand.choice([0, 0, 0, 0.3, 5, 30, 59.5])
+		self.assertTrue(starts > 10)
+
+	def test_late_poll(self):
+		# Due at 00:01:01, polled only at 00:01:59.5: no sweep across the rollover
+		self.cycler.poll(self.base + 119.5)
+		self.assertFalse(self.cycler.running)
+		self.assertEqual(self.cycler.next, self.base + 121)
+		self.cycler.poll(self.base + 121.25)
+		self.assertTrue(self.cycler.running)
+		self.assertEqual(self.cycler.stop_at, self.base + 179)
+
+	def test_display_restored(self):
+		self.d.show([1, 2, 3, 4])
+		shown = dict(self.pwm.buffers[nixie.nixie_channel])
+		self.assertTrue(shown)
+		self.cycler.poll(self.base + 61)
+		self.assertTrue(self.cycler.running)
+		self.assertEqual(self.pwm.buffers[nixie.nixie_channel], {})
+		self.assertTrue(self.pwm.buffers[nixie.poison_channel])
+		self.cycler.poll(self.base + 119)
+		self.assertFalse(self.cycler.running)
+		self.assertEqual(self.pwm.buffers[nixie.nixie_channel], shown)
+		self.assertEqual(self.pwm.buffers[nixie.poison_channel], {})
+
+	def test_changes_while_suspended(self):
+		# Shown while the sweep runs, on the tubes once it stops
+		self.d.show([1, 2, 3, 4])
+		self.cycler.poll(self.base + 61)
+		self.d.show([5, 6, 7, 8])
+		self.assertEqual(self.pwm.buffers[nixie.nixie_channel], {})
+		self.cycler.poll(self.base + 70, idle = False)
+		pwm, d = display(3)
+		d.show([5, 6, 7, 8])
+		self.assertEqual(self.pwm.buffers[nixie.nixie_channel], pwm.buffers[nixie.nixie_channel])
+
+
+class Commands(unittest.TestCase):
+	def setUp(self):
+		# Not started: the test applies the commands
+		self.dt = nixie.DisplayThread(pwm = RecordingPWM())
+		self.applied = []
+
+	def post(self, kind, value):
+		self.dt.post(kind, lambda value: self.applied.append((kind, value)), value)
+
+	def test_last_wins(self):
+		for brightness in range(0, 50, 10):
+			self.post("brightness", brightness)
+		self.assertEqual(self.dt.depth(), 1)
+		self.dt.apply_commands()
+		self.assertEqual(self.applied, [("brightness", 40)])
+		stats = self.dt.stats()
+		self.assertEqual((stats["posted"], stats["coalesced"], stats["applied"]), (5, 4, 1))
+
+	def test_kinds_keep_their_order(self):
+		# A kind posted again takes the place of its last posting
+		self.post("number", 1)
+		self.post("dots", "steady")
+		self.post("brightness", 30)
+		self.post("number", 2)
+		self.post("mode", "time")
+		self.post("brightness", 60)
+		self.assertEqual(self.dt.depth(), 4)
+		self.dt.apply_commands()
+		self.assertEqual(self.applied, [("dots", "steady"), ("number", 2), ("mode", "time"), ("brightness", 60)])
+		self.assertEqual(self.dt.depth(), 0)
+		self.dt.apply_commands()
+		self.assertEqual(len(self.applied), 4)
+
+
+class Cache(unittest.TestCase):
+	def setUp(self):
+		self.compiled = []
+		def compiler(*state):
+			self.compiled.append(state)
+			return nixie.Frame()
+		self.cache = nixie.FrameCache(size = 3, compiler = compiler)
+
+	def test_counters(self):
+		first = self.cache.get(1, 2, 3, 4)
+		self.assertTrue(self.cache.get(1, 2, 3, 4) is first)
+		self.cache.get(5, 6, 7, 8)
+		self.assertEqual(self.compiled, [(1, 2, 3, 4), (5, 6, 7, 8)])
+		self.assertEqual(self.cache.stats(), { "size": 3, "frames": 2, "hits": 1, "misses": 2, "evictions": 0 })
+
+	def test_least_recently_used_goes(self):
+		for state in ("a", "b", "c"):
+			self.cache.get(state)
+		# a used again, b is now the oldest
+		self.cache.get("a")
+		self.cache.get("d")
+		self.assertEqual(list(self.cache.frames.keys()), [("c", ), ("a", ), ("d", )])
+		self.assertEqual(self.cache.evictions, 1)
+		self.cache.get("b")
+		self.assertEqual(self.compiled, [("a", ), ("b", ), ("c", ), ("d", ), ("b", )])
+		self.assertEqual(self.cache.stats()["evictions"], 2)
+		self.assertEqual(self.cache.stats()["frames"], 3)
+
+	def test_no_cache(self):
+		cache = nixie.FrameCache(size = 0, compiler = lambda *state: nixie.Frame())
+		cache.get(1)
+		cache.get(1)
+		self.assertEqual(cache.stats(), { "size": 0, "frames": 0, "hits": 0, "misses": 2, "evictions": 0 })
+
+	def test_display_cache(self):
+		# The display hits its cache for a frame shown before
+		pwm, d = display(3)
+		d.show([1, 2, 3, 4])
+		d.show([1, 2, 3, 5])
+		misses = d.cache.misses
+		d.show([1, 2, 3, 4])
+		self.assertEqual(d.cache.misses, misses)
+		self.assertTrue(d.cache.hits >= 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,91 @@
+"""
+Ordering, coalescing and dropping of the conductor's event queue:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import threading
+import unittest
+
+from event_queue import EventQueue
+
+TIMEOUT, T, M, WHEEL_MOVE, ALARM = range(0, 5)
+
+
+def drain(queue):
+	# (kind, value) of the pending events, in the order they come out
+	events = []
+	while queue.depth():
+		kind, value, stamps = queue.get(0)
+		events.append((kind, value))
+	return events
+
+
+class Ordering(unittest.TestCase):
+	def setUp(self):
+		self.queue = EventQueue(priorities = { ALARM: 1 }, coalesced = (WHEEL_MOVE, ), urgent = (ALARM, ), size = 4)
+
+	def test_fifo(self):
+		for (kind, value) in ((T, 1), (M, 2), (T, 3)):
+			self.queue.put(kind, value)
+		self.assertEqual(self.queue.pending(), [T, M, T])
+		self.assertEqual(drain(self.queue), [(T, 1), (M, 2), (T, 3)])
+
+	def test_priority_first(self):
+		self.queue.put(T, 1)
+		self.queue.put(M, 2)
+		self.queue.put(ALARM, "a")
+		self.queue.put(ALARM, "b")
+		self.assertEqual(drain(self.queue), [(ALARM, "a"), (ALARM, "b"), (T, 1), (M, 2)])
+
+	def test_coalesced_in_place(self):
+		self.queue.put(WHEEL_MOVE, 1)
+		self.queue.put(T, None)
+		self.queue.put(WHEEL_MOVE, 2)
+		self.queue.put(WHEEL_MOVE, 3)
+		# The newest value, where the first move was put
+		self.assertEqual(drain(self.queue), [(WHEEL_MOVE, 3), (T, None)])
+		self.assertEqual(self.queue.stats()["coalesced"], 2)
+		self.queue.put(WHEEL_MOVE, 4)
+		self.assertEqual(drain(self.queue), [(WHEEL_MOVE, 4)])
+
+	def test_full_drops_the_newest(self):
+		for value in range(0, 4):
+			self.assertTrue(self.queue.put(T, value))
+		self.assertFalse(self.queue.put(M, 4))
+		self.assertEqual(self.queue.stats()["dropped"], { M: 1 })
+		self.assertEqual(drain(self.queue), [(T, 0), (T, 1), (T, 2), (T, 3)])
+
+	def test_urgent_never_dropped(self):
+		for value in range(0, 4):
+			self.queue.put(T, value)
+		self.assertTrue(self.queue.put(ALARM, "a"))
+		self.assertEqual(self.queue.stats()["max_depth"], 5)
+		self.assertEqual(drain(self.queue)[0], (ALARM, "a"))
+
+	def test_coalesced_while_full(self):
+		self.queue.put(WHEEL_MOVE, 1)
+		for value in range(0, 3):
+			self.queue.put(T, value)
+		self.assertTrue(self.queue.put(WHEEL_MOVE, 2))
+		self.assertEqual(drain(self.queue)[0], (WHEEL_MOVE, 2))
+
+
+class Waiting(unittest.TestCase):
+	def test_timeout(self):
+		self.assertEqual(EventQueue().get(0.01), None)
+
+	def test_wakes_up_on_put(self):
+		queue = EventQueue()
+		timer = threading.Timer(0.05, queue.put, (T, 1))
+		timer.start()
+		self.assertEqual(queue.get(5)[:2], (T, 1))
+		timer.join()
+		self.assertEqual(queue.stats()["got"], 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,131 @@
+"""
+Connectivity monitor against a server on the loopback, probes, stream health and the
+reconnection backoff:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import socket
+import threading
+import unittest
+from time import sleep
+
+import network
+from network import ConnectivityMonitor
+from stream_health import StationHealth, backoff
+
+
+class Monitor(unittest.TestCase):
+	def setUp(self):
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.bind(("127.0.0.1", 0))
+		self.server.listen(5)
+		self.events = []
+		self.health = None
+		self.monitor = ConnectivityMonitor(lambda: self.events.append("online"), lambda: self.events.append("offline"),
+			target = self.server.getsockname(), health = lambda: self.health, timeout = 0.5, down_after = 3, up_after = 2)
+
+	def tearDown(self):
+		self.server.close()
+
+	def steps(self, count):
+		for i in range(0, count):
+			self.monitor.step()
+
+	def test_probe(self):
+		self.steps(3)
+		self.assertEqual(self.monitor.stats()["failed"], 0)
+		self.assertTrue(self.monitor.last_rtt != None)
+
+	def test_broken_stream_is_a_failure(self):
+		# The probe answers, the stream playing says the network is out
+		self.health = False
+		self.steps(3)
+		self.assertEqual(self.events, ["offline"])
+		self.health = None
+		self.steps(2)
+		self.assertEqual(self.events, ["offline", "online"])
+
+	def test_flowing_stream_is_a_success(self):
+		self.monitor.inject(5)
+		self.health = True
+		self.steps(5)
+		self.assertEqual(self.events, [])
+
+	def test_outage(self):
+		self.monitor.inject(3)
+		self.steps(3)
+		self.assertEqual(self.events, ["offline"])
+		self.assertEqual(self.monitor.delay(), ConnectivityMonitor.INTERVAL * 4)
+		self.steps(2)
+		self.assertEqual(self.events, ["offline", "online"])
+		self.assertEqual(self.monitor.delay(), ConnectivityMonitor.INTERVAL)
+		self.assertEqual(list(self.monitor.stats()["outage"]["buckets"].keys())[:2], ["<1s", "<5s"])
+
+
+class Resolution(unittest.TestCase):
+	def setUp(self):
+		self.lookups = []
+		self.release = threading.Event()
+		self.getaddrinfo = network.socket.getaddrinfo
+		def getaddrinfo(host, port, family = 0):
+			self.lookups.append(host)
+			self.release.wait()
+			return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))]
+		network.socket.getaddrinfo = getaddrinfo
+		self.monitor = ConnectivityMonitor(lambda: None, lambda: None, target = ("gate", 1), timeout = 0.05)
+
+	def tearDown(self):
+		self.release.set()
+		network.socket.getaddrinfo = self.getaddrinfo
+
+	def test_slow_lookup_times_out_and_goes_on(self):
+		self.assertEqual(self.monitor.probe(), None)
+		self.assertEqual(self.monitor.probe(), None)
+		# Still the first lookup
+		self.assertEqual(self.lookups, ["gate"])
+		self.release.set()
+		sleep(0.05)
+		self.assertEqual(self.monitor.resolve(), ("127.0.0.1", 1))
+
+	def test_resolved_once(self):
+		self.release.set()
+		for i in range(0, 3):
+			# Refused, nothing listens on port 1: an answer, or no answer at all, the address stays
+			self.monitor.probe()
+		self.assertEqual(self.lookups, ["gate"])
+
+
+class Backoff(unittest.TestCase):
+	def test_schedule(self):
+		# Doubled each attempt up to the cap
+		self.assertEqual([backoff(attempt, 1, 16, lambda: 1.0) for attempt in range(0, 7)], [1, 2, 4, 8, 16, 16, 16])
+		self.assertEqual([backoff(attempt, 2, 30, lambda: 1.0) for attempt in range(0, 6)], [2, 4, 8, 16, 30, 30])
+
+	def test_jitter(self):
+		# Between half and all of it
+		self.assertEqual(backoff(3, 1, 16, lambda: 0.0), 4)
+		for i in range(0, 100):
+			self.assertTrue(4 <= backoff(3, 1, 16) <= 8)
+
+
+class Reliability(unittest.TestCase):
+	def test_outcomes(self):
+		station = StationHealth("http://radio/1")
+		self.assertEqual(station.reliability, 1.0)
+		station.underrun()
+		station.error()
+		self.assertAlmostEqual(station.reliability, 0.64)
+		station.ended()
+		self.assertAlmostEqual(station.reliability, 0.512)
+		# Playing again wins it back a step at a time
+		station.started()
+		self.assertAlmostEqual(station.reliability, 0.6096)
+		self.assertEqual(station.stats()["underruns"], 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,286 @@
+"""
+The player pool with test pipelines, on a fake monotonic clock, a timeshifted stream
+from a stand-in server, the feeder of a stream whose capture is lost, and the failover
+of a stream that stays out. Needs GStreamer, skipped without it:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+from time import sleep
+
+try:
+	from gi import require_version
+	require_version('Gst', '1.0')
+	from gi.repository import Gst
+	Gst.init(None)
+	import player
+	from player import PlayerPool, TimeshiftStream
+	from stream_health import Health, StandInServer
+	from timeshift import Ring
+except (ImportError, ValueError):
+	player = None
+
+TONE = "audiotestsrc is-live=true freq=440"
+OTHER = "audiotestsrc is-live=true freq=880"
+THIRD = "audiotestsrc is-live=true freq=1320"
+
+
+def until(condition, timeout = 5):
+	# Waits in real time for the streaming threads
+	for i in range(0, int(timeout / 0.01)):
+		if condition():
+			return True
+		sleep(0.01)
+	return condition()
+
+
+def silence(seconds):
+	# A WAV of 16 bit mono silence at 8kHz
+	data = b"\0" * (seconds * 16000)
+	return b"RIFF" + struct.pack("<I", 36 + len(data)) + b"WAVEfmt " + struct.pack("<IHHIIHH", 16, 1, 1, 8000, 16000, 2, 16) + \
+		b"data" + struct.pack("<I", len(data)) + data
+
+
+class FakeClock(object):
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+@unittest.skipIf(player == None, "needs GStreamer")
+class Pool(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.monotonic = player.monotonic
+		player.monotonic = self.clock
+		self.pool = PlayerPool(size = 3)
+
+	def tearDown(self):
+		self.pool.stop()
+		player.monotonic = self.monotonic
+
+	def test_armed_plays_warm_past_max_age(self):
+		# Armed a minute ahead of the alarm, it stood by for longer than MAX_AGE
+		self.assertTrue(self.pool.arm(TONE, 5))
+		stream = self.pool.standby[TONE]
+		self.clock.now += PlayerPool.MAX_AGE + 5
+		self.pool.prepare([])
+		self.assertTrue(self.pool.standby[TONE] is stream)
+		self.pool.play(TONE, 0)
+		self.assertTrue(self.pool.active is stream)
+		self.assertEqual(self.pool.armed, None)
+
+	def test_standing_by_past_max_age_starts_cold(self):
+		self.pool.prepare([TONE])
+		stream = self.pool.standby[TONE]
+		self.clock.now += PlayerPool.MAX_AGE + 5
+		self.pool.play(TONE, 0)
+		self.assertFalse(self.pool.active is stream)
+
+	def test_switching(self):
+		self.pool.play(TONE, 0)
+		self.pool.prepare([OTHER, THIRD])
+		self.assertEqual(list(self.pool.standby.keys()), [OTHER, THIRD])
+		other = self.pool.standby[OTHER]
+		self.pool.play(OTHER, 0)
+		self.assertTrue(self.pool.active is other)
+		# The station left stands by, the oldest one goes
+		self.assertEqual(list(self.pool.standby.keys()), [THIRD, TONE])
+		self.pool.play(TONE, 0)
+		self.assertEqual(list(self.pool.standby.keys()), [THIRD, OTHER])
+		self.pool.stop()
+		self.assertEqual(self.pool.active, None)
+		self.assertEqual(list(self.pool.standby.keys()), [])
+
+	def test_warm_and_cold(self):
+		# Cold: nothing stood by, warm: prepared, then played
+		self.pool.play(TONE, 0)
+		self.assertTrue(until(lambda: self.pool.cold.count == 1))
+		self.pool.prepare([OTHER])
+		self.pool.play(OTHER, 0)
+		self.assertTrue(until(lambda: self.pool.warm.count == 1))
+		self.pool.play(THIRD, 0)
+		self.assertTrue(until(lambda: self.pool.cold.count == 2))
+		self.assertEqual(self.pool.warm.count, 1)
+		stats = self.pool.stats()
+		self.assertEqual((stats["warm"]["count"], stats["cold"]["count"]), (1, 2))
+
+
+@unittest.skipIf(player == None, "needs GStreamer")
+class Timeshift(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.server = StandInServer(silence(30), rate = 128000)
+		self.server.start()
+		self.pool = PlayerPool(size = 2, timeshift_dir = self.directory, timeshift_size = 1024 * 1024)
+		self.assertTrue(until(lambda: self.pool.ring_count == self.pool.rings_wanted))
+
+	def tearDown(self):
+		self.pool.stop()
+		shutil.rmtree(self.directory)
+
+	def test_close_stops_the_feeder_first(self):
+		self.pool.play(self.server.url, 0)
+		stream = self.pool.active
+		self.assertTrue(isinstance(stream, TimeshiftStream))
+		self.assertTrue(until(lambda: stream.feeding() and not stream.holding))
+		self.assertTrue(until(self.pool.timeshifting))
+		free = len(self.pool.rings)
+		self.pool.stop()
+		self.assertFalse(stream.feeding())
+		# Back in the pool once nothing reads it
+		self.assertEqual(len(self.pool.rings), free + 1)
+		self.assertFalse(self.pool.timeshifting())
+		self.assertEqual(self.pool.healthy(), None)
+
+
+
+class Out(object):
+	# A stream out since since, and its reconnections
+	def __init__(self, source, since):
+		self.source = source
+		self.since = since
+		self.heard = False
+		self.failed = True
+
+	def broken(self):
+		return self.since
+
+	def set_volume(self, volume):
+		pass
+
+	def start(self, first_buffer):
+		pass
+
+	def close(self):
+		pass
+
+
+@unittest.skipIf(player == None, "needs GStreamer")
+class Failover(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.monotonic = player.monotonic
+		player.monotonic = self.clock
+
+	def tearDown(self):
+		player.monotonic = self.monotonic
+
+	def out(self, failover):
+		# The supervisor thread first checks a second from now: the checks here are the test's
+		pool = PlayerPool(size = 1, failover = failover)
+		pool.open = lambda source: Out(source, self.clock.now)
+		pool.active = Out(TONE, self.clock.now)
+		return pool
+
+	def test_failover_delay(self):
+		for failover in (3, PlayerPool.FAILOVER):
+			self.clock.now = 1000.0
+			pool = self.out(failover)
+			self.assertEqual(pool.check(), None)
+			self.clock.now += failover - 0.1
+			# Reconnected meanwhile, still out since the first stream went
+			self.assertEqual(pool.check(), None)
+			self.assertTrue(pool.active.since > 1000.0)
+			self.clock.now += 0.2
+			self.assertEqual(pool.check(), TONE)
+			self.assertEqual(pool.health.station(TONE).failovers, 1)
+
+	def test_reconnections_back_off(self):
+		# Long enough a failover for the delays to reach RETRY_CAP
+		pool = self.out(60)
+		attempts = []
+		while len(attempts) < 7:
+			pool.check()
+			if pool.attempts not in attempts:
+				attempts.append(pool.attempts)
+				# The next one between half and all of the doubled delay, up to RETRY_CAP
+				delay = min(PlayerPool.RETRY_CAP, PlayerPool.RETRY * 2 ** pool.attempts)
+				self.assertTrue(delay / 2.0 <= pool.retry_at - self.clock.now <= delay)
+			self.clock.now += 0.1
+		self.assertEqual(attempts, [0, 1, 2, 3, 4, 5, 6])
+		# Out since the first stream went, short of the failover all along
+		self.assertTrue(self.clock.now - pool.outage < 60)
+
+
+class Appsrc(object):
+	# Takes the feeder's buffers as a playing appsrc would
+	def __init__(self):
+		self.pushed = 0
+
+	def emit(self, signal, buffer):
+		self.pushed += buffer.get_size()
+		return Gst.FlowReturn.OK
+
+
+@unittest.skipIf(player == None, "needs GStreamer")
+class Feeder(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.ring = Ring(os.path.join(self.directory, "ring"), 256 * 1024)
+		# Nothing listens there: the capture is lost from the start
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(("127.0.0.1", 0))
+		source = "http://127.0.0.1:%d/stream" % listener.getsockname()[1]
+		listener.close()
+		self.health = Health().station(source)
+		self.stream = TimeshiftStream(source, self.ring, self.health)
+		self.stream.appsrc = Appsrc()
+		self.assertTrue(until(lambda: self.stream.lost != None))
+
+	def tearDown(self):
+		self.stream.close()
+		self.ring.close()
+		shutil.rmtree(self.directory)
+
+	def feed(self):
+		self.stream.feeder = threading.Thread(target = self.stream.feed, name = "feeder")
+		self.stream.feeder.daemon = True
+		self.stream.feeder.start()
+
+	def test_broken_while_holding(self):
+		# Short of MIN_LEAD when the capture was lost: broken since then
+		self.ring.append(b"x" * 1000)
+		self.feed()
+		sleep(0.1)
+		self.assertTrue(self.stream.holding)
+		self.assertEqual(self.stream.appsrc.pushed, 0)
+		self.assertEqual(self.stream.broken(), self.stream.lost)
+
+	def test_rides_out_the_outage_until_the_ring_runs_dry(self):
+		self.ring.append(b"x" * TimeshiftStream.MIN_LEAD)
+		self.feed()
+		self.assertTrue(until(lambda: self.stream.appsrc.pushed == TimeshiftStream.MIN_LEAD))
+		self.assertTrue(until(lambda: self.health.underruns == 1))
+		self.assertFalse(self.stream.holding)
+		# Dry with the capture lost: broken since it ran dry, not since the capture was lost
+		self.assertEqual(self.stream.broken(), self.ring.dry)
+		self.assertTrue(self.ring.dry >= self.stream.lost)
+		# Bytes again, it plays on and runs dry again: an underrun each time, not one every poll
+		self.ring.append(b"y" * 1000)
+		self.assertTrue(until(lambda: self.stream.appsrc.pushed == TimeshiftStream.MIN_LEAD + 1000))
+		sleep(0.2)
+		self.assertEqual(self.health.underruns, 2)
+		self.assertEqual(self.ring.stats()["recovery"]["count"], 1)
+
+	def test_closed_feeder_stops(self):
+		self.ring.append(b"x" * TimeshiftStream.MIN_LEAD)
+		self.feed()
+		self.assertTrue(until(lambda: self.stream.appsrc.pushed == TimeshiftStream.MIN_LEAD))
+		self.stream.close()
+		self.assertFalse(self.stream.feeding())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,134 @@
+"""
+Dispatch of the table driven state machine, its timeouts and counters on a fake clock:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import unittest
+
+from state_machine import StateMachine
+
+DEFAULT, VOLUME, BRIGHTNESS, ORPHAN = range(0, 4)
+TIMEOUT, T, M, WHEEL_MOVE = range(0, 4)
+
+
+class FakeClock(object):
+	def __init__(self):
+		self.now = 100.0
+
+	def __call__(self):
+		return self.now
+
+
+class Machine(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.calls = []
+		def log(name, seconds = 0):
+			def call(*args):
+				self.calls.append((name, ) + args)
+				self.clock.now += seconds
+			return call
+		self.machine = StateMachine(DEFAULT, {
+				(DEFAULT, T): (log("show brightness"), BRIGHTNESS),
+				(DEFAULT, WHEEL_MOVE): (log("volume", 0.25), VOLUME),
+				(VOLUME, WHEEL_MOVE): (log("volume", 0.5), None),
+				(VOLUME, TIMEOUT): (None, DEFAULT),
+				(BRIGHTNESS, T): (None, BRIGHTNESS),
+				(BRIGHTNESS, TIMEOUT): (None, DEFAULT),
+			},
+			entries = { DEFAULT: log("enter default"), VOLUME: log("enter volume") },
+			exits = { DEFAULT: log("exit default"), VOLUME: log("exit volume") },
+			timeouts = { VOLUME: 3, BRIGHTNESS: 5 },
+			state_names = { DEFAULT: "DEFAULT", VOLUME: "VOLUME", BRIGHTNESS: "BRIGHTNESS", ORPHAN: "ORPHAN" },
+			event_names = { TIMEOUT: "TIMEOUT", T: "T", M: "M", WHEEL_MOVE: "WHEEL_MOVE" },
+			clock = self.clock)
+		self.machine.start()
+
+	def run_events(self, events, until):
+		# Runs the machine like the conductor, on the fake clock: the (time, event, value) in order,
+		# TIMEOUT once the timeout of a state passes before the next event
+		events = list(events)
+		while True:
+			timeout = self.machine.timeout()
+			due = None if timeout == None else self.clock.now + timeout
+			if events and (due == None or events[0][0] < due):
+				at, event, value = events.pop(0)
+				self.clock.now = max(self.clock.now, at)
+			elif due != None and due <= until:
+				self.clock.now = due
+				event, value = TIMEOUT, None
+			else:
+				return
+			self.machine.dispatch(event, value)
+
+	def test_start(self):
+		self.assertEqual(self.machine.state, DEFAULT)
+		self.assertEqual(self.calls, [("enter default", )])
+		self.assertEqual(self.machine.timeout(), None)
+
+	def test_exit_action_entry(self):
+		del self.calls[:]
+		self.assertTrue(self.machine.dispatch(WHEEL_MOVE, 12))
+		self.assertEqual(self.calls, [("exit default", ), ("volume", 12), ("enter volume", )])
+		self.assertEqual(self.machine.state, VOLUME)
+		self.assertEqual(self.machine.timeout(), 3)
+
+	def test_stay(self):
+		self.machine.dispatch(WHEEL_MOVE, 12)
+		del self.calls[:]
+		self.assertTrue(self.machine.dispatch(WHEEL_MOVE, 13))
+		# No exit nor entry
+		self.assertEqual(self.calls, [("volume", 13)])
+		self.assertEqual(self.machine.state, VOLUME)
+
+	def test_ignored(self):
+		del self.calls[:]
+		self.assertFalse(self.machine.dispatch(M))
+		self.assertFalse(self.machine.dispatch(TIMEOUT))
+		self.assertEqual(self.calls, [])
+		self.assertEqual(self.machine.state, DEFAULT)
+		self.assertEqual(self.machine.stats()["ignored"], 2)
+
+	def test_timeout(self):
+		self.run_events([(101, WHEEL_MOVE, 1), (102, WHEEL_MOVE, 2)], 200)
+		self.assertEqual(self.machine.state, DEFAULT)
+		# The second move restarted the 3s
+		self.assertEqual(self.clock.now, 102.5 + 3)
+		self.assertEqual(self.calls[-2:], [("exit volume", ), ("enter default", )])
+
+	def test_no_timeout_before_due(self):
+		self.run_events([(101, T, None)], 105.9)
+		self.assertEqual(self.machine.state, BRIGHTNESS)
+		self.run_events([], 106)
+		self.assertEqual(self.machine.state, DEFAULT)
+
+	def test_event_before_timeout(self):
+		self.run_events([(101, T, None), (105, T, None)], 109)
+		self.assertEqual(self.machine.state, BRIGHTNESS)
+		self.run_events([], 110)
+		self.assertEqual(self.machine.state, DEFAULT)
+
+	def test_counters(self):
+		self.run_events([(101, WHEEL_MOVE, 1), (102, WHEEL_MOVE, 2), (103, WHEEL_MOVE, 3)], 200)
+		transitions = self.machine.stats()["transitions"]
+		self.assertEqual(transitions["DEFAULT WHEEL_MOVE"], (1, 0.25, 0.25))
+		self.assertEqual(transitions["VOLUME WHEEL_MOVE"], (2, 0.5, 0.5))
+		self.assertEqual(transitions["VOLUME TIMEOUT"], (1, 0, 0))
+		self.assertFalse("DEFAULT T" in transitions)
+		self.assertEqual(self.machine.stats()["state"], "DEFAULT")
+
+	def test_graph(self):
+		self.assertTrue(("BRIGHTNESS", "T", "BRIGHTNESS") in self.machine.graph())
+		self.assertTrue(("VOLUME", "WHEEL_MOVE", "VOLUME") in self.machine.graph())
+		self.assertEqual(self.machine.unreachable(), [])
+		self.machine.timeouts[ORPHAN] = 1
+		self.assertEqual(self.machine.unreachable(), ["ORPHAN"])
+		self.assertTrue('"DEFAULT" -> "VOLUME" [label="WHEEL_MOVE"];' in self.machine.dot())
+
+
+if __name__ == "__main__":
+	unittest.main()
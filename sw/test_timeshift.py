@@ -0,0 +1,76 @@
+"""
+The timeshift ring, its writer thread and a reset while it copies:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import shutil
+import tempfile
+import threading
+import unittest
+from time import sleep
+
+from timeshift import Ring
+
+
+def settle(ring, written):
+	# Waits for the writer thread to get to written bytes
+	for i in range(0, 200):
+		if ring.written == written:
+			return
+		sleep(0.01)
+
+
+class Rings(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.ring = Ring(os.path.join(self.directory, "ring"), 64 * 1024, backlog = 16 * 1024)
+
+	def tearDown(self):
+		self.ring.close()
+		shutil.rmtree(self.directory)
+
+	def test_read_behind(self):
+		for i in range(0, 4):
+			self.ring.append(chr(ord("a") + i) * 1000)
+			settle(self.ring, 1000 * (i + 1))
+		self.ring.seek_live(1500)
+		self.assertEqual(self.ring.read(4096), "c" * 500 + "d" * 1000)
+		self.assertEqual(self.ring.read(4096), "")
+		self.assertEqual(self.ring.stats()["underruns"], 1)
+
+	def test_lapped(self):
+		for i in range(0, 10):
+			self.ring.append(chr(ord("a") + i) * 10000)
+			settle(self.ring, 10000 * (i + 1))
+		data = self.ring.read(10000)
+		self.assertEqual(data[0], "d")
+		self.assertEqual(self.ring.stats()["lapped"], 100000 - 64 * 1024)
+
+	def test_reset_while_copying(self):
+		copying = threading.Event()
+		release = threading.Event()
+		copy_in = self.ring.copy_in
+		def held(offset, data):
+			copying.set()
+			release.wait()
+			copy_in(offset, data)
+		self.ring.copy_in = held
+		self.ring.append("x" * 1000)
+		self.assertTrue(copying.wait(2))
+		# The new stream comes in before the copy of the old one is done
+		self.ring.reset()
+		self.ring.copy_in = copy_in
+		self.ring.append("y" * 300)
+		release.set()
+		settle(self.ring, 300)
+		sleep(0.05)
+		self.assertEqual(self.ring.written, 300)
+		self.assertEqual(self.ring.read(4096), "y" * 300)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,102 @@
+"""
+Touch gestures from recorded bitmaps, and the MPR121 interrupt on the emulated RPIO:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import threading
+import unittest
+from time import time
+
+import user_input
+from hardware import RPIO
+from user_input import UI, TouchEngine
+
+TOP = 1 << UI.CAPA_TOP
+MID = 1 << UI.CAPA_MID
+BOT = 1 << UI.CAPA_BOT
+
+
+def play(engine, bitmaps, until):
+	# Events of the (time, bitmap) changes, polled every 10ms until the time until
+	events = []
+	bitmaps = list(bitmaps)
+	now = 0.0
+	while now <= until:
+		while bitmaps and bitmaps[0][0] <= now:
+			events += engine.update(bitmaps.pop(0)[1], now)
+		events += engine.poll(now)
+		now = round(now + 0.01, 2)
+	return events
+
+
+class Gestures(unittest.TestCase):
+	def setUp(self):
+		self.engine = TouchEngine(chord_window = 0.08, double_window = 0.3, long_press = 0.8)
+
+	def test_press_waits_for_the_chord_window(self):
+		self.assertEqual(self.engine.update(TOP, 0.0), [])
+		self.assertEqual(self.engine.poll(0.05), [])
+		self.assertEqual(self.engine.poll(0.08), [("press", TOP)])
+		self.assertEqual(self.engine.update(0, 0.2), [("release", TOP)])
+
+	def test_chord_never_fires_its_pins(self):
+		self.engine.chords = set([TOP | MID | BOT])
+		events = play(self.engine, [(0.0, TOP), (0.03, TOP | MID), (0.05, TOP | MID | BOT), (0.2, 0)], 1.0)
+		self.assertEqual(events, [("chord", TOP | MID | BOT), ("release", TOP | MID | BOT)])
+
+	def test_not_a_chord(self):
+		self.engine.chords = set([TOP | MID | BOT])
+		events = play(self.engine, [(0.0, TOP), (0.03, TOP | MID), (0.2, 0)], 1.0)
+		self.assertEqual(sorted(events), sorted([("press", TOP), ("press", MID), ("release", TOP | MID)]))
+
+	def test_long(self):
+		events = play(self.engine, [(0.0, MID), (1.0, 0)], 1.5)
+		self.assertEqual(events, [("press", MID), ("long", MID), ("release", MID)])
+
+	def test_released_before_long(self):
+		events = play(self.engine, [(0.0, MID), (0.5, 0)], 1.5)
+		self.assertEqual(events, [("press", MID), ("release", MID)])
+
+	def test_double(self):
+		self.engine.doubles = BOT
+		events = play(self.engine, [(0.0, BOT), (0.1, 0), (0.2, BOT), (0.3, 0)], 1.0)
+		self.assertEqual([event for event in events if event[0] != "release"], [("double", BOT)])
+
+	def test_single_press_of_a_double_pin_waits(self):
+		self.engine.doubles = BOT
+		events = play(self.engine, [(0.0, BOT), (0.1, 0)], 1.0)
+		self.assertEqual(events, [("release", BOT), ("press", BOT)])
+		self.assertEqual(self.engine.deadline(), None)
+
+
+class Interrupt(unittest.TestCase):
+	def setUp(self):
+		self.ui = UI()
+		self.time = user_input.time
+
+	def tearDown(self):
+		user_input.time = self.time
+		RPIO.cleanup()
+
+	def test_status_read_and_pull_up_again(self):
+		RPIO.set_pullupdn(UI.CAPA_IRQ, RPIO.PUD_OFF)
+		self.ui.cap.touch(TOP)
+		self.assertEqual(self.ui.reads, 1)
+		self.assertEqual(RPIO.input(UI.CAPA_IRQ), 1)
+		self.assertEqual(RPIO.pulls[UI.CAPA_IRQ], RPIO.PUD_UP)
+
+	def test_wall_clock_set_back(self):
+		# Set back an hour while the press waits for its chord window: it still comes in time
+		pressed = threading.Event()
+		self.ui.set_top_pressed_callback(pressed.set)
+		self.ui.cap.touch(TOP)
+		user_input.time = lambda: time() - 3600
+		self.assertTrue(pressed.wait(0.5))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,182 @@
+"""
+Quadrature decoding of the wheel, from the transition table to the emulated RPIO pins:
+
+	python -m unittest discover -p "test_*.py"
+"""
+
+import os
+os.environ.setdefault("NIXIE_BACKEND", "emulator")
+
+import threading
+import unittest
+from time import sleep, time
+
+import user_input
+from hardware import RPIO
+from tracing import monotonic
+from user_input import Courier, QuadratureDecoder, Wheel
+
+# Pin levels (a << 1) | b, clockwise
+CLOCKWISE = (3, 1, 0, 2)
+
+
+def turn(decoder, states, start = 0.0, interval = 0.02):
+	# Steps of each state fed interval seconds apart
+	return [decoder.update(state, start + i * interval) for (i, state) in enumerate(states)]
+
+
+class Transitions(unittest.TestCase):
+	def test_table(self):
+		# Same state: 0, one pin changed: a step along the clockwise cycle, both pins: an edge was missed
+		for previous in range(0, 4):
+			for current in range(0, 4):
+				step = QuadratureDecoder.TRANSITIONS[(previous << 2) | current]
+				i = CLOCKWISE.index(previous)
+				if current == previous:
+					self.assertEqual(step, 0)
+				elif current == CLOCKWISE[(i + 1) % 4]:
+					self.assertEqual(step, 1)
+				elif current == CLOCKWISE[(i - 1) % 4]:
+					self.assertEqual(step, -1)
+				else:
+					self.assertEqual(step, None)
+
+	def test_clockwise(self):
+		decoder = QuadratureDecoder(3)
+		self.assertEqual(turn(decoder, CLOCKWISE[1:] + CLOCKWISE * 2), [1] * 11)
+		self.assertEqual(decoder.steps, 11)
+
+	def test_counterclockwise(self):
+		decoder = QuadratureDecoder(3)
+		self.assertEqual(turn(decoder, tuple(reversed(CLOCKWISE)) * 2), [-1] * 8)
+
+	def test_same_state(self):
+		decoder = QuadratureDecoder(3)
+		self.assertEqual(turn(decoder, (3, 3, 1, 1)), [0, 0, 1, 0])
+
+	def test_skipped_state(self):
+		# 11 -> 00 misses an edge: no step, counted invalid, the velocity starts over
+		decoder = QuadratureDecoder(3)
+		turn(decoder, (1, 0, 2, 3, 1), interval = 0.001)
+		self.assertEqual(decoder.update(2, 0.006), 0)
+		self.assertEqual(decoder.invalid, 1)
+		self.assertEqual(decoder.velocity(), 0)
+		self.assertEqual(decoder.update(3, 0.007), 1)
+
+	def test_bounce_nets_out(self):
+		decoder = QuadratureDecoder(3)
+		self.assertEqual(sum(turn(decoder, (1, 3, 1, 3, 1), interval = 0.0002)), 1)
+
+	def test_acceleration(self):
+		slow = QuadratureDecoder(3)
+		self.assertEqual(turn(slow, CLOCKWISE[1:] + CLOCKWISE, interval = 1.0 / QuadratureDecoder.SLOW * 2), [1] * 7)
+		fast = QuadratureDecoder(3)
+		steps = turn(fast, CLOCKWISE[1:] + CLOCKWISE, interval = 1.0 / QuadratureDecoder.FAST / 2)
+		self.assertEqual(steps[:QuadratureDecoder.WINDOW - 1], [1] * (QuadratureDecoder.WINDOW - 1))
+		self.assertEqual(steps[-1], QuadratureDecoder.MAX_GAIN)
+
+	def test_reversal_resets_the_velocity(self):
+		decoder = QuadratureDecoder(3)
+		turn(decoder, CLOCKWISE[1:] + CLOCKWISE, interval = 0.0005)
+		self.assertEqual(decoder.update(0, 0.01), -1)
+
+
+class WheelPins(unittest.TestCase):
+	PIN_A = 27
+	PIN_B = 17
+
+	def setUp(self):
+		RPIO.drive(WheelPins.PIN_A, 1)
+		RPIO.drive(WheelPins.PIN_B, 1)
+		self.clock = [1000.0]
+		self.time = user_input.time
+		user_input.time = lambda: self.clock[0]
+		self.values = []
+		self.wheel = Wheel(WheelPins.PIN_A, WheelPins.PIN_B, interval = None)
+		self.wheel.setup(0, 0, 96, 10, 96, self.values.append)
+
+	def tearDown(self):
+		user_input.time = self.time
+		RPIO.del_interrupt_callback(WheelPins.PIN_A)
+		RPIO.del_interrupt_callback(WheelPins.PIN_B)
+
+	def flick(self, edges, rate):
+		# Clockwise edges through the interrupt callbacks, at rate edges per second
+		state = 3
+		for i in range(0, edges):
+			state = CLOCKWISE[(CLOCKWISE.index(state) + 1) % 4]
+			self.clock[0] += 1.0 / rate
+			RPIO.drive(WheelPins.PIN_A, state >> 1, self.clock[0])
+			RPIO.drive(WheelPins.PIN_B, state & 1, self.clock[0])
+
+	def test_slow_edges_all_count(self):
+		self.flick(48, 50)
+		self.assertEqual(self.wheel.value, 48 * 96 / (10 * 96))
+		self.assertEqual(self.wheel.decoder.steps, 48)
+		self.assertEqual(self.wheel.decoder.invalid, 0)
+
+	def test_fast_flick_registers_every_edge(self):
+		for rate in (800, 1600):
+			before = self.wheel.decoder.steps
+			self.flick(48, rate)
+			self.assertEqual(self.wheel.decoder.steps - before, 48, "%d edges/s" % rate)
+			self.assertEqual(self.wheel.decoder.invalid, 0)
+			# Slow down before the next flick, the velocity starts over
+			self.clock[0] += 1
+
+	def test_fast_flick_accelerates(self):
+		self.flick(48, 1600)
+		self.assertTrue(self.wheel.raw > 48 * (QuadratureDecoder.MAX_GAIN - 1))
+
+
+class Deliveries(unittest.TestCase):
+	INTERVAL = 0.05
+
+	def setUp(self):
+		self.courier = Courier(Deliveries.INTERVAL)
+		self.courier.start()
+		self.delivered = []
+		self.done = threading.Event()
+		self.time = user_input.time
+
+	def tearDown(self):
+		user_input.time = self.time
+
+	def receive(self, value):
+		self.delivered.append((monotonic(), value))
+		if value == "last":
+			self.done.set()
+
+	def test_last_value_wins(self):
+		for value in range(0, 50):
+			self.courier.publish(self.receive, value)
+		self.courier.publish(self.receive, "last")
+		self.assertTrue(self.done.wait(1))
+		values = [value for (at, value) in self.delivered]
+		self.assertEqual(values[-1], "last")
+		# The values published during a wait were replaced
+		self.assertTrue(len(values) <= 3)
+
+	def test_rate_limited(self):
+		start = monotonic()
+		while monotonic() - start < 0.5:
+			self.courier.publish(self.receive, 0)
+			sleep(0.002)
+		self.courier.publish(self.receive, "last")
+		self.assertTrue(self.done.wait(1))
+		times = [at for (at, value) in self.delivered]
+		self.assertTrue(len(times) <= 0.5 / Deliveries.INTERVAL + 2)
+		for (previous, at) in zip(times, times[1:]):
+			self.assertTrue(at - previous >= Deliveries.INTERVAL * 0.9)
+
+	def test_wall_clock_set_back(self):
+		self.courier.publish(self.receive, 0)
+		sleep(0.1)
+		# An hour back: the next value still comes within the interval
+		user_input.time = lambda: time() - 3600
+		self.courier.publish(self.receive, "last")
+		self.assertTrue(self.done.wait(Deliveries.INTERVAL * 4))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,156 @@
+"""
+Fixed size ring of stream bytes in a memory mapped file, to timeshift live radio.
+
+A writer appends what comes from the network, the reader plays some way behind: it
+goes on through short outages and keeps its place across a pause, as long as the
+writer has not come round to it. Positions count the bytes since the start, the ring
+holds the last size of them:
+
+	ring = Ring("/dev/shm/timeshift0", 8 * 1024 * 1024)
+	ring.append(data)       # any thread, never waits for a page fault
+	data = ring.read(4096)  # the reader, "" once it caught up with the writer
+
+append() only queues the data: a thread of the ring copies it to the mapping, a page
+fault holds that thread, not the one streaming. On tmpfs (/dev/shm) nothing is ever
+written back, a ring on the SD card would wear it out. Pure Python, no GStreamer needed.
+"""
+
+import os
+import mmap
+import threading
+from collections import deque
+
+from tracing import Histogram, monotonic
+
+
+class Ring(object):
+	SIZE = 8 * 1024 * 1024
+	# Bytes waiting for the writer thread at most, the oldest are dropped beyond
+	BACKLOG = 512 * 1024
+	# Seconds from running dry to reading again
+	RECOVERY = (0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+	def __init__(self, path, size = SIZE, backlog = BACKLOG):
+		self.path = path
+		self.size = size
+		self.backlog = backlog
+		self.file = open(path, "w+b")
+		self.file.truncate(size)
+		self.map = mmap.mmap(self.file.fileno(), size)
+		# Every page is allocated now, not while streaming: on tmpfs that takes the memory up front
+		for offset in range(0, size, mmap.PAGESIZE):
+			self.map[offset:offset + 1] = b"\0"
+		self.lock = threading.Lock()
+		# Held by the writer thread while it copies, close() waits for it
+		self.copying = threading.Lock()
+		self.wakeup = threading.Event()
+		self.queue = deque()
+		self.closed = False
+		# Counts the resets, the bytes of an earlier stream never move the write position
+		self.generation = 0
+		self.reset()
+		thread = threading.Thread(target = self.run, name = "timeshift")
+		thread.daemon = True
+		thread.start()
+
+	def reset(self):
+		# Empties the ring, for another stream
+		with self.lock:
+			self.generation += 1
+			self.queue.clear()
+			self.queued = 0
+			# Bytes copied to the ring, the reader position, and the oldest position still in the ring
+			self.written = 0
+			self.position = 0
+			self.floor = 0
+			self.dropped = 0
+			self.lapped = 0
+			self.underruns = 0
+			# Time the reader ran dry
+			self.dry = None
+			self.recovery = Histogram(Ring.RECOVERY)
+
+	def append(self, data):
+		with self.lock:
+			self.queue.append(data)
+			self.queued += len(data)
+			while self.queued > self.backlog:
+				self.queued -= len(self.queue[0])
+				self.dropped += len(self.queue.popleft())
+		self.wakeup.set()
+
+	def run(self):
+		while not self.closed:
+			self.wakeup.wait()
+			self.wakeup.clear()
+			while not self.closed:
+				with self.lock:
+					if not self.queue:
+						break
+					data = self.queue.popleft()
+					self.queued -= len(data)
+					data = data[-self.size:]
+					start = self.written
+					generation = self.generation
+					# The bytes about to be overwritten are gone for the reader
+					self.floor = max(self.floor, start + len(data) - self.size)
+				with self.copying:
+					if self.closed:
+						return
+					if generation != self.generation:
+						continue
+					self.copy_in(start % self.size, data)
+				with self.lock:
+					if generation == self.generation:
+						self.written = start + len(data)
+
+	def copy_in(self, offset, data):
+		first = min(len(data), self.size - offset)
+		self.map[offset:offset + first] = data[:first]
+		if first < len(data):
+			self.map[0:len(data) - first] = data[first:]
+
+	def read(self, count):
+		with self.lock:
+			if self.position < self.floor:
+				self.lapped += self.floor - self.position
+				self.position = self.floor
+			available = self.written - self.position
+			if available <= 0:
+				if self.dry == None and self.written:
+					self.dry = monotonic()
+					self.underruns += 1
+				return b""
+			if self.dry != None:
+				self.recovery.add(monotonic() - self.dry)
+				self.dry = None
+			count = min(count, available)
+			offset = self.position % self.size
+			first = min(count, self.size - offset)
+			data = self.map[offset:offset + first]
+			if first < count:
+				data += self.map[0:count - first]
+			self.position += count
+			return data
+
+	def seek_live(self, lead):
+		# The reader goes lead bytes behind the writer, or as far as the ring goes
+		with self.lock:
+			self.position = max(self.floor, self.written - lead)
+
+	def fill(self):
+		# Bytes the reader has ahead of it
+		return self.written - self.position
+
+	def stats(self):
+		with self.lock:
+			return { "size": self.size, "written": self.written, "fill": self.written - self.position, "underruns": self.underruns,
+				"dry": self.dry != None, "lapped": self.lapped, "dropped": self.dropped, "recovery": self.recovery.stats() }
+
+	def close(self):
+		self.closed = True
+		self.wakeup.set()
+		with self.copying, self.lock:
+			self.map.close()
+			self.file.close()
+		os.remove(self.path)
@@ -0,0 +1,246 @@
+"""
+In-memory trace of what the threads do, instead of printing from the interrupt
+callbacks and the display and conductor loops.
+
+Entries go to a preallocated ring: (sequence, time, thread, level, code, message, args),
+the message is only formatted when dumped. Recording is off by default, a call below
+the threshold costs a comparison:
+
+	tracing.debug("wheel", "Wheel: %s", val)
+
+Messages at ECHO level and above are printed as well, so the console still shows them.
+kill -USR1 dumps the ring to stderr, kill -USR2 turns recording on and off.
+
+Latency, when enabled, follows every input from its interrupt callback to the DMA
+writes it leads to: stamps travel with the values handed from thread to thread.
+"""
+
+import sys
+import signal
+import itertools
+import threading
+from collections import OrderedDict, deque
+from time import localtime, time
+
+try:
+	from time import monotonic
+except ImportError:
+	# Python 2 has no monotonic clock, read CLOCK_MONOTONIC from librt (or libc)
+	import ctypes
+	import ctypes.util
+
+	class timespec(ctypes.Structure):
+		_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+	CLOCK_MONOTONIC = 1
+	librt = ctypes.CDLL(ctypes.util.find_library("rt"), use_errno = True)
+	librt.clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+	def monotonic():
+		t = timespec()
+		if librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+			raise OSError(ctypes.get_errno(), "clock_gettime")
+		return t.tv_sec + t.tv_nsec * 1e-9
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+names = { DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E" }
+
+
+class Trace(object):
+	SIZE = 4096
+	def __init__(self, size = SIZE, level = OFF, echo = INFO):
+		self.size = size
+		self.entries = [None] * size
+		self.sequence = itertools.count()
+		self.level = level
+		self.echo = echo
+		self.threshold = min(level, echo)
+
+	def set_level(self, level = DEBUG, echo = None):
+		# level: lowest level recorded, echo: lowest level printed (None: unchanged)
+		self.level = level
+		if echo != None:
+			self.echo = echo
+		self.threshold = min(self.level, self.echo)
+
+	def log(self, level, code, message, args):
+		if level < self.threshold:
+			return
+		if level >= self.level:
+			# count() is atomic, concurrent writers never share a slot
+			sequence = next(self.sequence)
+			self.entries[sequence % self.size] = (sequence, time(), threading.current_thread().name, level, code, message, args)
+		if level >= self.echo:
+			out = sys.stderr if level >= ERROR else sys.stdout
+			out.write(format_message(message, args) + "\n")
+
+	def clear(self):
+		self.entries = [None] * self.size
+
+	def records(self):
+		# Oldest first
+		return sorted([entry for entry in self.entries if entry != None])
+
+	def dump(self, out = None):
+		out = out or sys.stderr
+		for (sequence, at, thread, level, code, message, args) in self.records():
+			stamp = "%02d:%02d:%02d.%03d" % (localtime(at)[3:6] + (int(at * 1000) % 1000, ))
+			out.write("%s %-10s %s %-10s %s\n" % (stamp, thread, names.get(level, level), code, format_message(message, args)))
+		out.flush()
+
+
+class Histogram:
+	# Counts of values (seconds) per bucket, a bucket holds the values below its bound
+	BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+	# Unit of the labels of the buckets -> its count in a second
+	UNITS = { "ms": 1000, "s": 1 }
+	def __init__(self, bounds = BOUNDS, unit = "ms"):
+		self.bounds = bounds
+		self.unit = unit
+		self.counts = [0] * (len(bounds) + 1)
+		self.count = 0
+		self.max = 0
+
+	def add(self, value):
+		i = 0
+		while i < len(self.bounds) and value >= self.bounds[i]:
+			i += 1
+		self.counts[i] += 1
+		self.count += 1
+		self.max = max(self.max, value)
+
+	def buckets(self):
+		scale = Histogram.UNITS[self.unit]
+		labels = ["<%g%s" % (bound * scale, self.unit) for bound in self.bounds] + [">=%g%s" % (self.bounds[-1] * scale, self.unit)]
+		return OrderedDict(zip(labels, self.counts))
+
+	def stats(self):
+		return { "count": self.count, "max": self.max, "buckets": self.buckets() }
+
+
+def format_message(message, args):
+	if args:
+		return message % args
+	return message
+
+
+trace = Trace()
+
+def debug(code, message, *args):
+	if DEBUG >= trace.threshold:
+		trace.log(DEBUG, code, message, args)
+
+def info(code, message, *args):
+	if INFO >= trace.threshold:
+		trace.log(INFO, code, message, args)
+
+def warning(code, message, *args):
+	if WARNING >= trace.threshold:
+		trace.log(WARNING, code, message, args)
+
+def error(code, message, *args):
+	if ERROR >= trace.threshold:
+		trace.log(ERROR, code, message, args)
+
+
+class Stamp(object):
+	# One input: where it came from and the monotonic time it reached each stage
+	def __init__(self, ident, source, now):
+		self.ident = ident
+		self.source = source
+		self.marks = OrderedDict([("input", now)])
+
+	def mark(self, stage, now):
+		if stage not in self.marks:
+			self.marks[stage] = now
+
+
+class Latency(object):
+	# Stages, in order: time in the interrupt callback, waiting for the conductor, handling it,
+	# waiting for the display thread, looking the frame up, writing it to the DMA buffer
+	STAGES = ("callback", "queue", "transition", "display", "render", "dma")
+	HISTORY = 1000
+	# Stamps carried by one hand-off at most, the oldest go first
+	CARRIED = 64
+
+	def __init__(self, history = HISTORY):
+		self.enabled = False
+		self.sequence = itertools.count()
+		self.local = threading.local()
+		self.samples = dict([(stage, deque(maxlen = history)) for stage in Latency.STAGES + ("total", )])
+		self.completed = 0
+		# Inputs whose handling ended without writing anything (value unchanged, coalesced away...)
+		self.dropped = 0
+
+	def begin(self, source):
+		# In the interrupt callback: stamps a new input, the current one of this thread
+		if not self.enabled:
+			self.local.stamps = []
+			return None
+		stamp = Stamp(next(self.sequence), source, monotonic())
+		self.local.stamps = [stamp]
+		return stamp
+
+	def current(self):
+		# To hand over along with the value
+		return getattr(self.local, "stamps", [])
+
+	def adopt(self, stamps):
+		# In the thread taking the value over
+		self.local.stamps = list(stamps[-Latency.CARRIED:])
+
+	def mark(self, stage):
+		stamps = self.current()
+		if stamps:
+			now = monotonic()
+			for stamp in stamps:
+				stamp.mark(stage, now)
+
+	def finish(self):
+		for stamp in self.current():
+			if "dma" not in stamp.marks:
+				self.dropped += 1
+				continue
+			marks = stamp.marks.items()
+			for i in range(1, len(marks)):
+				self.samples[marks[i][0]].append(marks[i][1] - marks[i - 1][1])
+			self.samples["total"].append(stamp.marks["dma"] - stamp.marks["input"])
+			self.completed += 1
+		self.local.stamps = []
+
+	def reset(self):
+		for samples in self.samples.values():
+			samples.clear()
+		self.completed = 0
+		self.dropped = 0
+
+	def report(self):
+		# stage -> (count, p50, p90, p99, max) in seconds
+		report = OrderedDict()
+		for stage in Latency.STAGES + ("total", ):
+			samples = sorted(self.samples[stage])
+			if samples:
+				report[stage] = (len(samples), samples[len(samples) / 2], samples[len(samples) * 9 / 10],
+					samples[len(samples) * 99 / 100], samples[-1])
+		return report
+
+	def dump(self, out = None):
+		out = out or sys.stderr
+		out.write("latency: %d inputs on the tubes, %d without effect\n" % (self.completed, self.dropped))
+		for stage, (count, p50, p90, p99, worst) in self.report().items():
+			out.write("%-10s %6d  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  max %7.2fms\n" % (stage, count, p50 * 1000, p90 * 1000, p99 * 1000, worst * 1000))
+		out.flush()
+
+
+latency = Latency()
+
+
+def install_signals(dump = signal.SIGUSR1, toggle = signal.SIGUSR2):
+	# Signal handlers run in the main thread, between two of its bytecodes
+	signal.signal(dump, lambda signum, frame: (trace.dump(), latency.dump()))
+	signal.signal(toggle, lambda signum, frame: trace.set_level(OFF if trace.level <= DEBUG else DEBUG))
@@ -1,6 +1,10 @@
 import sys
-import RPIO
-import MPR121
+import threading
+from collections import deque
+from time import sleep, time
+from hardware import RPIO, MPR121
+import tracing
+from tracing import Histogram, monotonic
 
 
 class UI(object):
@@ -26,87 +30,367 @@ class UI(object):
 
 		self.cap = MPR121.MPR121()
 		if not self.cap.begin():
-			print('Error initializing MPR121.  Check your wiring!')
+			tracing.error("mpr121", "Error initializing MPR121.  Check your wiring!")
 			sys.exit(1)
-		RPIO.add_interrupt_callback(UI.CAPA_IRQ, self.touch_pressed, threaded_callback=False)
+		# I2C reads of the touch status
+		self.reads = 0
+		self.touch = TouchThread(TouchEngine())
+		self.touch.start()
+		# The MPR121 pulls IRQ low on a change of the touch status, until the status is read
+		RPIO.add_interrupt_callback(UI.CAPA_IRQ, self.touch_pressed, edge="falling", pull_up_down=RPIO.PUD_UP, threaded_callback=False)
 
 	def set_wheel_pressed_callback(self, callback=None):
 		self.sw_cb = callback
 
 	def set_tmb_pressed_callback(self, callback=None):
-		self.tmb_cb = callback
+		self.touch.on("chord", (1 << UI.CAPA_TOP) | (1 << UI.CAPA_MID) | (1 << UI.CAPA_BOT), callback)
 
 	def set_top_pressed_callback(self, callback=None):
-		self.top_cb = callback
+		self.touch.on("press", 1 << UI.CAPA_TOP, callback)
 
 	def set_middle_pressed_callback(self, callback=None):
-		self.middle_cb = callback
+		self.touch.on("press", 1 << UI.CAPA_MID, callback)
 
 	def set_bottom_pressed_callback(self, callback=None):
-		self.bottom_cb = callback
+		self.touch.on("press", 1 << UI.CAPA_BOT, callback)
+
+	def set_gesture_callback(self, gesture, pins, callback=None):
+		# gesture: press, release, long, double (one pin) or chord (several pins)
+		mask = 0
+		for pin in pins:
+			mask |= 1 << pin
+		self.touch.on(gesture, mask, callback)
 
 	def wheel_pressed(self, gpio_id, val):
-		print("Wheel: %s" % val)
+		tracing.latency.begin("switch")
+		tracing.debug("wheel", "Wheel: %s", val)
 		if val == 0:
+			tracing.latency.mark("callback")
 			self.sw_cb()
 
 	def touch_pressed(self, gpio_id, val):
-		#print("Touch: %s" % val)
+		tracing.latency.begin("touch")
+		tracing.debug("touch", "Touch: %s", val)
+		# Bug in RPIO? the pull UP of IRQ does not hold, it has to be done again on each interrupt
 		RPIO.set_pullupdn(UI.CAPA_IRQ, RPIO.PUD_UP)
-		if val == 0:
+		# Reading the status releases IRQ: high again means an earlier read got this change already.
+		# Still low after a read means the status changed meanwhile, without a new falling edge.
+		for i in range(0, 3):
+			if RPIO.input(UI.CAPA_IRQ):
+				return
 			current_touched = self.cap.touched()
-			# Check each pin's last and current state to see if it was pressed or released.
-			pin_bit = (1 << UI.CAPA_TOP) | (1 << UI.CAPA_MID) | (1 << UI.CAPA_BOT)
-			if current_touched & pin_bit == pin_bit:
-					self.tmb_cb()
-					print "TMB"
+			self.reads += 1
+			tracing.debug("touch", "%s   %s   %s", "T" if current_touched & (1 << UI.CAPA_TOP) else "-",
+				"M" if current_touched & (1 << UI.CAPA_MID) else "-", "B" if current_touched & (1 << UI.CAPA_BOT) else "-")
+			tracing.latency.mark("callback")
+			self.touch.feed(current_touched, monotonic())
+
+
+def pins_of(mask):
+	return [1 << pin for pin in range(0, 12) if mask & (1 << pin)]
+
+
+class TouchEngine(object):
+	"""
+	Gestures from the successive touch bitmaps of the MPR121, as (gesture, pins mask) events:
+	press and release edges, chord (several pins pressed within chord_window seconds), long
+	(one pin held for long_press seconds) and double (two presses within double_window seconds,
+	only looked for on the pins of doubles, their single presses wait that long).
+	A press is only told once chord_window has passed, so the pins of a chord never fire alone.
+	Pure Python: update() with recorded bitmaps and poll() with the time drive it.
+	"""
+	def __init__(self, chord_window = 0.08, double_window = 0.3, long_press = 0.8):
+		self.chord_window = chord_window
+		self.double_window = double_window
+		self.long_press = long_press
+		# Masks of the chords and pins that are listened to
+		self.chords = set()
+		self.doubles = 0
+		self.touched = 0
+		# [decision time, pins pressed since the first press, time of the first press]
+		self.pending = None
+		# pin -> time of a press waiting for a second one
+		self.taps = {}
+		# pin -> time it is held long enough
+		self.holds = {}
+
+	def update(self, touched, now):
+		events = self.poll(now)
+		pressed = touched & ~self.touched
+		released = self.touched & ~touched
+		self.touched = touched
+		if released:
+			events.append(("release", released))
+			for pin in pins_of(released):
+				self.holds.pop(pin, None)
+		if pressed:
+			if self.pending == None:
+				self.pending = [now + self.chord_window, pressed, now]
 			else:
-				pin_bit = 1 << UI.CAPA_TOP
-				if current_touched & pin_bit:
-						self.top_cb()
-						print "T",
-				else:
-						print "-",
-				print "  ",
-				pin_bit = 1 << UI.CAPA_MID
-				if current_touched & pin_bit:
-						self.middle_cb()
-						print "M",
-				else:
-						print "-",
-				print "  ",
-				pin_bit = 1 << UI.CAPA_BOT
-				if current_touched & pin_bit:
-						self.bottom_cb()
-						print "B",
+				self.pending[1] |= pressed
+			# All the pins of a chord are down, no need to wait any longer
+			if self.pending[1] in self.chords:
+				events += self.decide(now)
+		return events
+
+	def poll(self, now):
+		events = []
+		if self.pending != None and now >= self.pending[0]:
+			events += self.decide(now)
+		for pin, at in list(self.taps.items()):
+			if now >= at + self.double_window:
+				del self.taps[pin]
+				events.append(("press", pin))
+				if self.touched & pin:
+					self.holds[pin] = at + self.long_press
+		for pin, at in list(self.holds.items()):
+			if now >= at:
+				del self.holds[pin]
+				events.append(("long", pin))
+		return events
+
+	def decide(self, now):
+		deadline, mask, start = self.pending
+		self.pending = None
+		if mask in self.chords:
+			return [("chord", mask)]
+		events = []
+		for pin in pins_of(mask):
+			if pin & self.doubles:
+				if pin in self.taps:
+					del self.taps[pin]
+					events.append(("double", pin))
 				else:
-						print "-",
-				print ""
+					self.taps[pin] = start
+				continue
+			events.append(("press", pin))
+			if self.touched & pin:
+				self.holds[pin] = start + self.long_press
+		return events
+
+	def deadline(self):
+		# Time poll() has something to tell at the latest, None: only on a change of the bitmap
+		deadlines = [at + self.double_window for at in self.taps.values()] + list(self.holds.values())
+		if self.pending != None:
+			deadlines.append(self.pending[0])
+		return min(deadlines) if deadlines else None
+
+
+class TouchThread(threading.Thread):
+	# Runs the touch engine and its callbacks out of the interrupt thread, on monotonic time
+	def __init__(self, engine):
+		threading.Thread.__init__(self, name = "touch")
+		self.daemon = True
+		self.engine = engine
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		# (gesture, mask) -> callback
+		self.handlers = {}
+		self.events = []
+		# Latency stamps of the touches behind the events
+		self.stamps = []
+		self.dispatched = 0
+
+	def on(self, gesture, mask, callback):
+		with self.lock:
+			if callback:
+				self.handlers[(gesture, mask)] = callback
+			else:
+				self.handlers.pop((gesture, mask), None)
+			self.engine.chords = set([mask for (kind, mask) in self.handlers if kind == "chord"])
+			self.engine.doubles = 0
+			for (kind, mask) in self.handlers:
+				if kind == "double":
+					self.engine.doubles |= mask
+
+	def feed(self, touched, now):
+		with self.lock:
+			self.events += self.engine.update(touched, now)
+			self.stamps += tracing.latency.current()
+		self.event.set()
+
+	def run(self):
+		while True:
+			with self.lock:
+				deadline = self.engine.deadline()
+			self.event.wait(None if deadline == None else max(deadline - monotonic(), 0))
+			self.event.clear()
+			with self.lock:
+				events = self.events + self.engine.poll(monotonic())
+				self.events = []
+				handled = [event for event in events if event in self.handlers]
+				# The stamps go with the first events that have a callback,
+				# touches that are not waiting for a gesture decision led to nothing
+				stamps = []
+				if handled or self.engine.deadline() == None:
+					stamps = self.stamps
+					self.stamps = []
+			tracing.latency.adopt(stamps)
+			for (gesture, mask) in events:
+				tracing.debug("touch", "%s %s", gesture, mask)
+				callback = self.handlers.get((gesture, mask))
+				if callback:
+					self.dispatched += 1
+					callback()
+			if not handled:
+				tracing.latency.finish()
+
+
+class QuadratureDecoder(object):
+	"""
+	Quadrature decoding of the wheel from the levels of both pins, (a << 1) | b.
+	Going clockwise the pins go 11 -> 01 -> 00 -> 10 -> 11, every edge is a step.
+	Pure Python, recorded edges can be fed to update() without the hardware.
+	"""
+	# (previous << 2) | current -> +1 clockwise, -1 counterclockwise, 0 same state, None both pins changed (edge missed)
+	TRANSITIONS = (0, -1, 1, None, 1, 0, None, -1, -1, None, 0, 1, None, 1, -1, 0)
+	# Edges kept to measure the velocity, one full quadrature cycle
+	WINDOW = 5
+	# Edges per second: below SLOW a step is a step, from FAST on it counts MAX_GAIN steps
+	SLOW = 100
+	FAST = 800
+	MAX_GAIN = 10
+	# Seconds between edges
+	INTERVALS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+
+	def __init__(self, state = 3):
+		self.state = state
+		self.direction = 0
+		self.edges = deque(maxlen = QuadratureDecoder.WINDOW)
+		self.steps = 0
+		self.invalid = 0
+		self.intervals = Histogram(QuadratureDecoder.INTERVALS)
+
+	def update(self, state, now):
+		# Returns the steps to move: 0 when nothing moved, +-1 or more with the acceleration
+		step = QuadratureDecoder.TRANSITIONS[(self.state << 2) | state]
+		self.state = state
+		if step == None:
+			self.invalid += 1
+			self.edges.clear()
+			return 0
+		if step == 0:
+			return 0
+
+		if step != self.direction:
+			self.direction = step
+			self.edges.clear()
+		if self.edges:
+			self.intervals.add(now - self.edges[-1])
+		self.edges.append(now)
+		self.steps += 1
+		return step * self.gain()
+
+	def velocity(self):
+		# Edges per second over the last WINDOW edges in the same direction, 0 until there are that many
+		if len(self.edges) < QuadratureDecoder.WINDOW or self.edges[-1] == self.edges[0]:
+			return 0
+		return (len(self.edges) - 1) / (self.edges[-1] - self.edges[0])
+
+	def gain(self):
+		speed = min(max(self.velocity() - QuadratureDecoder.SLOW, 0), QuadratureDecoder.FAST - QuadratureDecoder.SLOW)
+		return 1 + (QuadratureDecoder.MAX_GAIN - 1) * speed / (QuadratureDecoder.FAST - QuadratureDecoder.SLOW)
+
+	def stats(self):
+		return { "steps": self.steps, "invalid": self.invalid, "intervals": self.intervals.stats() }
+
+
+class RateCounter(object):
+	# Events per second, over the last complete second
+	def __init__(self):
+		self.total = 0
+		self.second = None
+		self.current = 0
+		self.previous = 0
+
+	def add(self, now):
+		second = int(now)
+		if second != self.second:
+			self.previous = self.current if self.second != None and second == self.second + 1 else 0
+			self.second = second
+			self.current = 0
+		self.current += 1
+		self.total += 1
+
+	def per_second(self, now):
+		second = int(now)
+		if second == self.second:
+			return self.previous
+		if self.second != None and second == self.second + 1:
+			return self.current
+		return 0
+
+
+class Courier(threading.Thread):
+	# Hands the latest published value to its callback, at most once per interval seconds (monotonic).
+	# A value published during the wait replaces the previous one, the last one is always delivered.
+	def __init__(self, interval):
+		threading.Thread.__init__(self, name = "wheel")
+		self.daemon = True
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.pending = None
+		self.delivered = 0
+		self.deliveries = RateCounter()
+
+	def publish(self, callback, value):
+		# Called from the interrupt thread: no more than storing the value
+		with self.lock:
+			stamps = self.pending[2] if self.pending else []
+			self.pending = (callback, value, stamps + tracing.latency.current())
+		self.event.set()
+
+	def run(self):
+		while True:
+			self.event.wait()
+			self.event.clear()
+			delay = self.delivered + self.interval - monotonic()
+			if delay > 0:
+				sleep(delay)
+			with self.lock:
+				pending = self.pending
+				self.pending = None
+			if pending:
+				callback, value, stamps = pending
+				tracing.latency.adopt(stamps)
+				callback(value)
+				self.delivered = monotonic()
+				self.deliveries.add(self.delivered)
 
 
 class Wheel(object):
 	CW = 0
 	CCW = 1
+	# Seconds between two values handed to the callback
+	INTERVAL = 1.0 / 40
 
-	def __init__(self, pin_a, pin_b, steps_per_turn = 96):
+	def __init__(self, pin_a, pin_b, steps_per_turn = 96, interval = INTERVAL):
+		# interval: None calls back from the interrupt, on every value (replays)
 		self.pin_a = pin_a
 		self.pin_b = pin_b
 		self.steps_per_turn = steps_per_turn
+		self.edges = RateCounter()
+		self.courier = None
+		if interval != None:
+			self.courier = Courier(interval)
+			self.courier.start()
 		RPIO.setup(pin_a, RPIO.IN, pull_up_down=RPIO.PUD_UP)
 		RPIO.setup(pin_b, RPIO.IN, pull_up_down=RPIO.PUD_UP)
 
-		RPIO.add_interrupt_callback(pin_a, self.pin_a_changed, threaded_callback=False, debounce_timeout_ms=5)
-		RPIO.add_interrupt_callback(pin_b, self.pin_b_changed, threaded_callback=False, debounce_timeout_ms=5)
+		# No debounce: a bounce is a step there and back that the transition table nets out, while a
+		# debounce window drops every other edge of a pin above 1000 / (2 * window) edges per second
+		RPIO.add_interrupt_callback(pin_a, self.pin_changed, threaded_callback=False)
+		RPIO.add_interrupt_callback(pin_b, self.pin_changed, threaded_callback=False)
 
-		self.state_a = RPIO.input(pin_a)
-		self.state_b = RPIO.input(pin_b)
+		self.decoder = QuadratureDecoder((RPIO.input(pin_a) << 1) | RPIO.input(pin_b))
 		self.setup(0, 50, 100, 1, self.steps_per_turn, self.default_cb)
 
 	def default_cb(self, val):
-		print("val %s" % val)
+		tracing.debug("wheel", "val %s", val)
 
 	def setup(self, minimum, initial, maximum, turns, steps_per_turn, callback):
-		print("Setting up wheel encoder: minimum %s initial %s maximum %s turns %s" % ( minimum, initial, maximum, turns))
+		tracing.info("wheel", "Setting up wheel encoder: minimum %s initial %s maximum %s turns %s", minimum, initial, maximum, turns)
 		# raw_max - raw_min = turns * steps_per_turn
 		# ? = 1
 		self.steps_per_turn = steps_per_turn
@@ -117,67 +401,48 @@ class Wheel(object):
 		self.min = minimum
 		self.turns = turns
 		self.cb = callback
+		self.value = initial
 
-	def pin_a_changed(self, gpio_id, val):
-		if self.state_b != RPIO.input(self.pin_b):
-			return
-
-		if self.state_a == val:
-			return
-		self.state_a = val
-
-		if self.state_b == 1:
-			if val == 0:
-				direction = Wheel.CW
-			else:
-				direction = Wheel.CCW
-		else:
-			if val == 0:
-				direction = Wheel.CCW
-			else:
-				direction = Wheel.CW
-
-		if direction == Wheel.CW:
-			self.raw = self.raw + 1
-			if self.raw > self.raw_max:
-				self.raw = self.raw_max
+	def pin_changed(self, gpio_id, val):
+		tracing.latency.begin("wheel")
+		# The level of the other pin is read, so that a missed edge shows as an invalid transition
+		if gpio_id == self.pin_a:
+			state = (val << 1) | RPIO.input(self.pin_b)
 		else:
-			self.raw = self.raw - 1
-			if self.raw < self.raw_min:
-				self.raw = self.raw_min
-
-		self.cb(int(self.raw * (self.max - self.min) / (self.turns * self.steps_per_turn)))
-
-
-	def pin_b_changed(self, gpio_id, val):
-		if self.state_a != RPIO.input(self.pin_a):
-			return
+			state = (RPIO.input(self.pin_a) << 1) | val
+		self.decode(state, time())
 
-		if self.state_b == val:
+	def decode(self, state, now):
+		step = self.decoder.update(state, now)
+		if step == 0:
 			return
-		self.state_b = val
-
-		if self.state_a == 1:
-			if val == 0:
-				direction = Wheel.CCW
-			else:
-				direction = Wheel.CW
-		else:
-			if val == 0:
-				direction = Wheel.CW
+		self.edges.add(now)
+
+		self.raw = min(max(self.raw + step, self.raw_min), self.raw_max)
+		value = int(self.raw * (self.max - self.min) / (self.turns * self.steps_per_turn))
+		# Steps within a value (the raw position is finer than the values) do not bother the callback
+		if value != self.value:
+			self.value = value
+			tracing.latency.mark("callback")
+			if self.courier:
+				self.courier.publish(self.cb, value)
 			else:
-				direction = Wheel.CCW
-
-		if direction == Wheel.CW:
-			self.raw = self.raw + 1
-			if self.raw > self.raw_max:
-				self.raw = self.raw_max
-		else:
-			self.raw = self.raw - 1
-			if self.raw < self.raw_min:
-				self.raw = self.raw_min
-
-		self.cb(int(self.raw * (self.max - self.min) / (self.turns * self.steps_per_turn)))
+				self.cb(value)
+
+	def stats(self):
+		now = time()
+		stats = { "edges_per_second": self.edges.per_second(now), "edges": self.edges.total, "decoder": self.decoder.stats() }
+		if self.courier:
+			stats["interval"] = self.courier.interval
+			stats["deliveries_per_second"] = self.courier.deliveries.per_second(monotonic())
+			stats["deliveries"] = self.courier.deliveries.total
+		return stats
+
+	def feed(self, edges):
+		# Replays recorded (time, a, b) edges
+		for (now, a, b) in edges:
+			tracing.latency.begin("wheel")
+			self.decode((a << 1) | b, now)
 
 
 if __name__ == "__main__":